@@ -17,16 +17,18 @@ by Oscar Najera and in fact uses parts of it's html template for including the
 thumbnails and the download containers"""
 from __future__ import division
 import datetime as dt
+import io
 import os
 import os.path as osp
 import re
 import six
 from itertools import chain
-import nbconvert
-import nbformat
-from shutil import copyfile
-from copy import deepcopy
+from bisect import bisect_left
+from functools import partial
+from fnmatch import fnmatch
+from shutil import copyfile, rmtree
 import warnings
+import threading
 try:
     from sphinx.util import logging
     logger = logging.getLogger(__name__)
@@ -44,6 +46,9 @@ except AttributeError:  # necessary for python 2.7
 import subprocess as spr
 from docutils.parsers.rst import Directive
 from docutils.parsers.rst import directives
+# import the image directives explicitly, they are not loaded together with
+# the directives package
+from docutils.parsers.rst.directives.images import Figure
 from docutils.statemachine import ViewList
 from docutils import nodes
 
@@ -51,6 +56,11 @@ if six.PY2:
     from itertools import imap as map
 
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 try:
     from cyordereddict import OrderedDict
 except ImportError:
@@ -78,17 +88,161 @@ warnings.warn(
     DeprecationWarning,
 )
 
-if nbconvert.__version__ < '5.0':
-    code_blocks = re.compile(r'\.\. code:: python\n(?s)(.+?)(?=\n\S+|$)')
-    inner_code_blocks = re.compile(
-        r'(?<=.. code:: python\n)(?s)(.+?)(?=\n\S+|$)')
-else:
-    code_blocks = re.compile(r'\.\. code:: ipython\d\n(?s)(.+?)(?=\n\S+|$)')
-    inner_code_blocks = re.compile(
-        r'(?<=.. code:: ipython\d\n)(?s)(.+?)(?=\n\S+|$)')
+#: patterns for the code blocks in the rst output of nbconvert (see
+#: :func:`get_code_blocks`)
+_code_blocks = {}
+
 magic_patt = re.compile(r'(?m)^(\s+)(%.*\n)')
 
 
+def get_code_blocks(inner=False):
+    """Get the pattern for code blocks in the rst output of nbconvert
+
+    nbconvert is imported when this function is called for the first time
+
+    Parameters
+    ----------
+    inner: bool
+        If True, get the pattern for the content of the code block only
+
+    Returns
+    -------
+    re.Pattern
+        The compiled pattern"""
+    if not _code_blocks:
+        import nbconvert
+        if nbconvert.__version__ < '5.0':
+            _code_blocks[False] = re.compile(
+                r'\.\. code:: python\n(?s)(.+?)(?=\n\S+|$)')
+            _code_blocks[True] = re.compile(
+                r'(?<=.. code:: python\n)(?s)(.+?)(?=\n\S+|$)')
+        else:
+            _code_blocks[False] = re.compile(
+                r'\.\. code:: ipython\d\n(?s)(.+?)(?=\n\S+|$)')
+            _code_blocks[True] = re.compile(
+                r'(?<=.. code:: ipython\d\n)(?s)(.+?)(?=\n\S+|$)')
+    return _code_blocks[inner]
+
+
+def get_bokeh_version():
+    """Get the version of the installed bokeh package
+
+    The version is taken from the package metadata if possible such that
+    bokeh itself does not have to be imported"""
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        import bokeh
+        return bokeh.__version__
+    return version('bokeh')
+
+
+_environment = {}
+
+
+def _user_cache_dir(*subdirs):
+    """Get a directory in the cache directory of the user
+
+    This is ``$XDG_CACHE_HOME/sphinx-nbexamples`` (by default
+    ``~/.cache/sphinx-nbexamples``) joined with the given `subdirs`"""
+    return os.path.join(
+        os.getenv('XDG_CACHE_HOME', os.path.join(
+            os.path.expanduser('~'), '.cache')),
+        'sphinx-nbexamples', *subdirs)
+
+
+#: The code that computes the fingerprint of a python environment (see
+#: :func:`environment_fingerprint`)
+FINGERPRINT_CODE = """
+import hashlib
+import sys
+try:
+    from importlib.metadata import distributions
+except ImportError:
+    import pkg_resources
+    packages = [str(d.as_requirement()) for d in pkg_resources.working_set]
+else:
+    packages = ['%s==%s' % (d.metadata['Name'], d.version)
+                for d in distributions()]
+content = '\\n'.join([sys.version] + sorted(packages))
+fingerprint = hashlib.sha1(content.encode('utf-8')).hexdigest()
+"""
+
+
+def _kernel_executable(kernel_name):
+    """Get the python interpreter of a kernel if it is not the current one
+
+    Parameters
+    ----------
+    kernel_name: str
+        The name of the jupyter kernel
+
+    Returns
+    -------
+    str or None
+        The interpreter of the kernel or None, if the kernel is not a python
+        kernel, cannot be found or runs the current interpreter"""
+    import sys
+    try:
+        from jupyter_client.kernelspec import get_kernel_spec
+        spec = get_kernel_spec(kernel_name)
+    except Exception:
+        return None
+    if spec.language.lower() != 'python' or not spec.argv:
+        return None
+    executable = spec.argv[0]
+    # jupyter_client runs these kernels with the current interpreter
+    if executable in ['python', 'python%i' % sys.version_info[0],
+                      'python%i.%i' % sys.version_info[:2]]:
+        return None
+    if os.path.realpath(executable) == os.path.realpath(sys.executable):
+        return None
+    return executable
+
+
+def environment_fingerprint(kernel_name=None):
+    """Get a fingerprint of the python environment
+
+    The fingerprint is the sha1 hash of the python version and the names and
+    versions of all installed distributions (see :attr:`FINGERPRINT_CODE`).
+    If the python kernel `kernel_name` runs another interpreter than the
+    current one, the fingerprint is computed with this interpreter. It is
+    computed only once per kernel. For other languages, the fingerprint of the
+    current environment is used
+
+    Parameters
+    ----------
+    kernel_name: str
+        The name of the jupyter kernel. If None, the fingerprint of the
+        current interpreter is returned
+
+    Returns
+    -------
+    str
+        The hexadecimal hash"""
+    if kernel_name not in _environment:
+        executable = None if kernel_name is None else _kernel_executable(
+            kernel_name)
+        fingerprint = None
+        if executable is not None:
+            try:
+                fingerprint = spr.check_output(
+                    [executable, '-c', FINGERPRINT_CODE + 'print(fingerprint)']
+                    ).decode('ascii').strip()
+            except Exception:
+                logger.warning(
+                    'Could not compute the fingerprint of the environment of '
+                    'the %s kernel', kernel_name, exc_info=True)
+        if fingerprint is None:
+            if None not in _environment:
+                ns = {}
+                exec(FINGERPRINT_CODE, ns)
+                _environment[None] = ns['fingerprint']
+            fingerprint = _environment[None]
+        _environment[kernel_name] = fingerprint
+    return _environment[kernel_name]
+
+
 def isstring(s):
     return isinstance(s, six.string_types)
 
@@ -117,6 +271,1124 @@ def nbviewer_link(url):
 NOIMAGE = os.path.join(os.path.dirname(__file__), '_static', 'no_image.png')
 
 
+def _get_json_backend():
+    """Get the functions to load and dump json with a fast json library
+
+    Returns
+    -------
+    tuple or None
+        The ``loads`` and ``dumps`` function (the latter returning bytes) or
+        None if no fast json library is installed"""
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    def default(obj):
+        # nbformat allows base64 encoded bytes as output data
+        if isinstance(obj, bytes):
+            return obj.decode('ascii')
+        raise TypeError
+
+    def dumps(obj):
+        return orjson.dumps(
+            obj, default=default,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS) + b'\n'
+
+    return orjson.loads, dumps
+
+
+#: file keys (path, modification time and size) of the notebooks that have
+#: already been validated (see :func:`read_notebook`)
+_validated_notebooks = set()
+
+
+def _validate_notebook(nb, fname):
+    import nbformat
+    try:
+        nbformat.validate(nb)
+    except nbformat.ValidationError as e:
+        nbformat.get_logger().error(
+            "Notebook JSON of %s is invalid: %s", fname, e)
+
+
+def _split_lines(nb):
+    """Split multiline text of a notebook for writing it to disk
+
+    Other than :func:`nbformat.v4.rwbase.split_lines`, this function does not
+    modify `nb` but returns a new structure that shares all unmodified
+    objects (e.g. the image outputs) with `nb`"""
+    def split(s):
+        return s.splitlines(True) if isstring(s) else s
+
+    def split_mimebundle(data):
+        return {key: split(val) if key.startswith('text/') or key in (
+                    'application/javascript', 'image/svg+xml') else val
+                for key, val in data.items()}
+
+    def split_output(output):
+        output = dict(output)
+        if 'data' in output:
+            output['data'] = split_mimebundle(output['data'])
+        elif output.get('output_type') == 'stream':
+            output['text'] = split(output['text'])
+        return output
+
+    def split_cell(cell):
+        cell = dict(cell)
+        if 'source' in cell:
+            cell['source'] = split(cell['source'])
+        cell['metadata'] = {key: val for key, val in cell['metadata'].items()
+                            if key != 'trusted'}
+        if cell.get('attachments'):
+            cell['attachments'] = {
+                key: split_mimebundle(val)
+                for key, val in cell['attachments'].items()}
+        if 'outputs' in cell:
+            cell['outputs'] = list(map(split_output, cell['outputs']))
+        return cell
+
+    ret = dict(nb)
+    ret['metadata'] = {
+        key: val for key, val in nb['metadata'].items()
+        if key not in ['orig_nbformat', 'orig_nbformat_minor', 'signature']}
+    ret['cells'] = list(map(split_cell, nb['cells']))
+    return ret
+
+
+def read_notebook(infile, validate=True):
+    """Read a notebook file
+
+    This function reads the notebook using the :mod:`orjson` library (if
+    installed), otherwise :func:`nbformat.read` is used.
+
+    Parameters
+    ----------
+    infile: str
+        The path to the notebook file
+    validate: bool or {'once'}
+        Whether the notebook shall be validated. If ``'once'``, it is only
+        validated the first time this file is read (as long as it does not
+        change)
+
+    Returns
+    -------
+    nbformat.NotebookNode
+        The notebook in the current nbformat"""
+    import nbformat
+    if validate == 'once':
+        stat = os.stat(infile)
+        key = (os.path.abspath(infile), stat.st_mtime, stat.st_size)
+        validate = key not in _validated_notebooks
+        _validated_notebooks.add(key)
+    backend = _get_json_backend()
+    if backend is None and validate:
+        return nbformat.read(infile, nbformat.current_nbformat)
+    with open(infile, 'rb') as f:
+        content = f.read()
+    if backend is None:
+        nb_dict = nbformat.reader.parse_json(content.decode('utf-8'))
+    else:
+        nb_dict = backend[0](content)
+    major, minor = nbformat.reader.get_version(nb_dict)
+    nb = nbformat.versions[major].to_notebook_json(nb_dict, minor=minor)
+    if major != nbformat.current_nbformat:
+        nb = nbformat.convert(nb, nbformat.current_nbformat)
+    if validate:
+        _validate_notebook(nb, infile)
+    return nb
+
+
+def write_notebook(nb, outfile, validate=True):
+    """Write a notebook to a file
+
+    This function writes the notebook using the :mod:`orjson` library (if
+    installed), otherwise :func:`nbformat.write` is used.
+
+    Parameters
+    ----------
+    nb: nbformat.NotebookNode
+        The notebook to write
+    outfile: str
+        The path of the target file
+    validate: bool or {'once'}
+        Whether the notebook shall be validated before it is written. As the
+        notebook is not read from a file, ``'once'`` is treated as False"""
+    import nbformat
+    validate = validate is True
+    backend = _get_json_backend()
+    if backend is None and validate:
+        nbformat.write(nb, outfile)
+        return
+    if validate:
+        _validate_notebook(nb, outfile)
+    if backend is None:
+        content = nbformat.versions[nb.nbformat].writes_json(nb).encode(
+            'utf-8')
+    else:
+        content = backend[1](_split_lines(nb))
+    with open(outfile, 'wb') as f:
+        f.write(content)
+
+
+_ws_patt = re.compile(br'\s*')
+_literal_patt = re.compile(br'[^,\]}\s]*')
+_structure_patt = re.compile(br'["\[\]{}]')
+
+
+class _JSONScanner(object):
+    """Incremental scanner for json content in a bytes-like object
+
+    This class is used by :func:`scan_notebook` to walk through the json
+    structure of a notebook and to only decode the parts that are needed"""
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.idx = 0
+
+    def skip_ws(self):
+        self.idx = _ws_patt.match(self.buf, self.idx).end()
+        return self.buf[self.idx:self.idx + 1]
+
+    def expect(self, c):
+        if self.skip_ws() != c:
+            raise ValueError("Expected %r at position %i" % (c, self.idx))
+        self.idx += 1
+
+    def skip_string(self, start):
+        """Get the end of the json string that starts at `start`"""
+        buf = self.buf
+        idx = start + 1
+        while True:
+            idx = buf.find(b'"', idx)
+            if idx == -1:
+                raise ValueError("Unterminated string at position %i" % start)
+            # check if the quote is escaped
+            i = idx
+            while buf[i - 1:i] == b'\\':
+                i -= 1
+            idx += 1
+            if not (idx - 1 - i) % 2:
+                return idx
+
+    def skip_value(self):
+        """Skip the next json value and return its start and end"""
+        c = self.skip_ws()
+        start = self.idx
+        if c == b'"':
+            self.idx = self.skip_string(start)
+        elif c in (b'[', b'{'):
+            depth = 0
+            while True:
+                m = _structure_patt.search(self.buf, self.idx)
+                if m is None:
+                    raise ValueError("Unterminated json structure")
+                c = m.group()
+                if c == b'"':
+                    self.idx = self.skip_string(m.start())
+                    continue
+                depth += 1 if c in (b'[', b'{') else -1
+                self.idx = m.end()
+                if not depth:
+                    break
+        else:
+            self.idx = _literal_patt.match(self.buf, start).end()
+        return start, self.idx
+
+    def load_value(self):
+        """Decode the next json value"""
+        import json
+        start, end = self.skip_value()
+        return json.loads(bytes(self.buf[start:end]).decode('utf-8'))
+
+    def iter_items(self):
+        """Iterate over the keys of the json object at the current position
+
+        The value of each key has to be loaded (or skipped) by the caller"""
+        self.expect(b'{')
+        if self.skip_ws() == b'}':
+            self.idx += 1
+            return
+        while True:
+            key = self.load_value()
+            self.expect(b':')
+            yield key
+            c = self.skip_ws()
+            self.idx += 1
+            if c == b'}':
+                return
+            elif c != b',':
+                raise ValueError("Expected ',' at position %i" % self.idx)
+
+    def iter_array(self):
+        """Iterate over the elements of the json array at the current position
+
+        Each element has to be loaded (or skipped) by the caller"""
+        self.expect(b'[')
+        if self.skip_ws() == b']':
+            self.idx += 1
+            return
+        while True:
+            yield
+            c = self.skip_ws()
+            self.idx += 1
+            if c == b']':
+                return
+            elif c != b',':
+                raise ValueError("Expected ',' at position %i" % self.idx)
+
+
+def scan_notebook(infile, ncells=2):
+    """Get the metadata and the first cells of a notebook
+
+    Other than :func:`read_notebook`, this function does not load the entire
+    notebook into memory but scans the file and only decodes the top-level
+    metadata and the first `ncells` cells (without their outputs and
+    attachments).
+
+    Parameters
+    ----------
+    infile: str
+        The path to the notebook
+    ncells: int
+        The number of cells to load
+
+    Returns
+    -------
+    nbformat.NotebookNode
+        The notebook with the ``'metadata'``, the ``'nbformat'`` and
+        ``'nbformat_minor'`` and the first `ncells` in ``'cells'``"""
+    import mmap
+    from nbformat import from_dict
+    nb = {'metadata': {}, 'cells': []}
+    with open(infile, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise ValueError("%s is empty" % infile)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            scanner = _JSONScanner(buf)
+            for key in scanner.iter_items():
+                if key != 'cells':
+                    nb[key] = scanner.load_value()
+                    continue
+                for i, _ in enumerate(scanner.iter_array()):
+                    if i >= ncells:
+                        scanner.skip_value()
+                        continue
+                    cell = {}
+                    for cell_key in scanner.iter_items():
+                        if cell_key in ['outputs', 'attachments']:
+                            scanner.skip_value()
+                        else:
+                            cell[cell_key] = scanner.load_value()
+                    if isinstance(cell.get('source'), list):
+                        cell['source'] = ''.join(cell['source'])
+                    nb['cells'].append(cell)
+        finally:
+            buf.close()
+    if 'worksheets' in nb:  # nbformat 3
+        nb = read_notebook(infile, validate=False)
+        nb['cells'] = nb['cells'][:ncells]
+        return nb
+    return from_dict(nb)
+
+
+def notebook_description(nb):
+    """Get summary and description of a notebook
+
+    Parameters
+    ----------
+    nb: nbformat.NotebookNode
+        The notebook (or the result of :func:`scan_notebook`)
+
+    Returns
+    -------
+    str
+        The header of the first cell
+    str
+        The description from the first or second cell"""
+    def split_header(s, get_header=True):
+        s = s.lstrip().rstrip()
+        parts = s.splitlines()
+        if parts[0].startswith('#'):
+            if get_header:
+                header = re.sub('#+\s*', '', parts.pop(0))
+                if not parts:
+                    return header, ''
+            else:
+                header = ''
+            rest = '\n'.join(parts).lstrip().split('\n\n')
+            desc = rest[0].replace('\n', ' ')
+            return header, desc
+        else:
+            if get_header:
+                if parts[0].startswith(('=', '-')):
+                    parts = parts[1:]
+                header = parts.pop(0)
+                if parts and parts[0].startswith(('=', '-')):
+                    parts.pop(0)
+                if not parts:
+                    return header, ''
+            else:
+                header = ''
+            rest = '\n'.join(parts).lstrip().split('\n\n')
+            desc = rest[0].replace('\n', ' ')
+            return header, desc
+
+    if not nb['cells']:
+        return '', ''
+    first_cell = nb['cells'][0]
+
+    if not first_cell['cell_type'] == 'markdown':
+        return '', ''
+    header, desc = split_header(first_cell['source'])
+    if not desc and len(nb['cells']) > 1:
+        second_cell = nb['cells'][1]
+        if second_cell['cell_type'] == 'markdown':
+            _, desc = split_header(second_cell['source'], False)
+    return header, desc
+
+
+def copy_notebook_structure(nb):
+    """Copy a notebook without copying the outputs
+
+    The cells, their metadata and their list of outputs are copied such that
+    cells and outputs can be removed (e.g. by the
+    :class:`nbconvert.preprocessors.TagRemovePreprocessor`) without modifying
+    `nb`. The outputs themselves (e.g. images) are shared with `nb`.
+
+    Parameters
+    ----------
+    nb: nbformat.NotebookNode
+        The notebook to copy
+
+    Returns
+    -------
+    nbformat.NotebookNode
+        The copy of `nb`"""
+    from nbformat import NotebookNode
+    ret = NotebookNode(nb)
+    ret.metadata = NotebookNode(nb.metadata)
+    ret.cells = []
+    for cell in nb.cells:
+        cell = NotebookNode(cell)
+        cell.metadata = NotebookNode(cell.get('metadata', {}))
+        if 'outputs' in cell:
+            cell.outputs = list(cell.outputs)
+        ret.cells.append(cell)
+    return ret
+
+
+#: The prefix of the mimetypes of the bokeh outputs in a notebook
+BOKEH_MIMETYPE = 'application/vnd.bokehjs_'
+
+
+def has_bokeh_output(nb):
+    """Check whether a notebook contains a bokeh output
+
+    The outputs are identified by their mimetype (see
+    :data:`BOKEH_MIMETYPE`) and not by the text of their representation
+
+    Parameters
+    ----------
+    nb: nbformat.NotebookNode
+        The notebook to check
+
+    Returns
+    -------
+    bool
+        True, if any output of `nb` has been created by bokeh"""
+    for cell in nb.cells:
+        for output in cell.get('outputs', []):
+            if any(mimetype.startswith(BOKEH_MIMETYPE)
+                   for mimetype in output.get('data', {})):
+                return True
+    return False
+
+
+def get_bokeh_assets(config, static_dir=None):
+    """Get the style sheets and javascript files of bokeh
+
+    Parameters
+    ----------
+    config: dict
+        The :confval:`example_gallery_config` with the ``'insert_bokeh'`` and
+        ``'insert_bokeh_widgets'`` keys
+    static_dir: str
+        A directory with local copies of the files. If given, the names of
+        the files that exist in this directory are returned instead of the
+        urls of the CDN
+
+    Returns
+    -------
+    list of str
+        The style sheets
+    list of str
+        The javascript files"""
+    css_files = []
+    js_files = []
+    for key, css, js in [
+            ('insert_bokeh', NotebookProcessor.BOKEH_STYLE_SHEET,
+             NotebookProcessor.BOKEH_JS),
+            ('insert_bokeh_widgets',
+             NotebookProcessor.BOKEH_WIDGETS_STYLE_SHEET,
+             NotebookProcessor.BOKEH_WIDGETS_JS)]:
+        version = config.get(key)
+        if not version:
+            continue
+        if not isstring(version):
+            version = get_bokeh_version()
+        for files, url in [(css_files, css), (js_files, js)]:
+            url = url.format(version=version)
+            if static_dir is not None:
+                fname = os.path.basename(url)
+                if not os.path.exists(os.path.join(static_dir, fname)):
+                    logger.warning('%s does not exist in %s! Using %s',
+                                   fname, static_dir, url)
+                else:
+                    url = fname
+            if url not in files:
+                files.append(url)
+    return css_files, js_files
+
+
+def insert_bokeh_assets(app, pagename, templatename, context, doctree,
+                        css_files=[], js_files=[]):
+    """Add the bokeh assets to the pages with a bokeh output
+
+    This function is connected to the ``'html-page-context'`` event if the
+    ``'bokeh_assets'`` of the :confval:`example_gallery_config` is
+    ``'page'``. The pages with a bokeh output are marked by the
+    ``:nbexamples-bokeh:`` field in their metadata (see
+    :attr:`NotebookProcessor.BOKEH_FIELD`)"""
+    if 'nbexamples-bokeh' not in app.env.metadata.get(pagename, {}):
+        return
+    for fname in css_files:
+        app.builder.add_css_file(fname)
+    for fname in js_files:
+        app.builder.add_js_file(fname)
+
+
+def optimize_image(data, max_size=None, format='png', cache_dir=None):
+    """Downsample and losslessly recompress a PNG image
+
+    Parameters
+    ----------
+    data: bytes
+        The content of the PNG file
+    max_size: tuple of int
+        The maximum width and height of the image. Larger images are scaled
+        down with the same aspect ratio. If None, the size is not changed
+    format: {'png', 'webp'}
+        The format of the returned image. WebP images are saved losslessly
+    cache_dir: str
+        A directory for the optimized images. The file names in this
+        directory are the hashes of `data` and the other parameters such that
+        each image is only optimized once
+
+    Returns
+    -------
+    bytes
+        The content of the optimized image"""
+    if cache_dir is not None:
+        import hashlib
+        key = hashlib.sha1(data + repr((max_size, format)).encode('utf-8'))
+        cache_file = os.path.join(cache_dir, key.hexdigest() + '.' + format)
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                return f.read()
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    img = Image.open(io.BytesIO(data))
+    resize = max_size is not None and (
+        img.size[0] > max_size[0] or img.size[1] > max_size[1])
+    if resize:
+        img.thumbnail(max_size, Image.LANCZOS)
+    buf = io.BytesIO()
+    if format == 'webp':
+        img.save(buf, 'WEBP', lossless=True)
+    else:
+        img.save(buf, 'PNG', optimize=True)
+    ret = buf.getvalue()
+    if format == 'png' and not resize and len(ret) >= len(data):
+        ret = data
+    if cache_dir is not None:
+        create_dirs(cache_dir)
+        # write into a temporary file first because the same image might be
+        # optimized in another thread
+        tmp_file = '%s.%s.tmp' % (cache_file, threading.current_thread().ident)
+        with open(tmp_file, 'wb') as f:
+            f.write(ret)
+        os.rename(tmp_file, cache_file)
+    return ret
+
+
+def markdown2rst(fname, converter=None, cache_dir=None):
+    """Convert a markdown file into reStructuredText
+
+    Parameters
+    ----------
+    fname: str
+        The path to the markdown file
+    converter: {None, 'mistune', 'pandoc'}
+        The converter to use. ``'mistune'`` converts the file in the running
+        process and requires mistune 3.0 or later (which is installed with
+        nbconvert 7), ``'pandoc'`` calls the pandoc executable. If None,
+        mistune is used if possible and pandoc otherwise
+    cache_dir: str
+        A directory for the converted files. The file names in this
+        directory are the hashes of the content of `fname` and the
+        `converter` such that unchanged files are only converted once
+
+    Returns
+    -------
+    str
+        The content of `fname` as reStructuredText"""
+    import hashlib
+    with open(fname, 'rb') as f:
+        content = f.read()
+    if converter is None:
+        try:
+            from mistune.renderers.rst import RSTRenderer  # noqa: F401
+        except ImportError:
+            converter = 'pandoc'
+        else:
+            converter = 'mistune'
+    key = hashlib.sha1(content + converter.encode('utf-8')).hexdigest()
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, key + '.txt')
+        if os.path.exists(cache_file):
+            with io.open(cache_file, encoding='utf-8') as f:
+                return f.read()
+    if converter == 'pandoc':
+        ret = spr.check_output(['pandoc', fname, '-t', 'rst']).decode('utf-8')
+    else:
+        import mistune
+        from mistune.renderers.rst import RSTRenderer
+        ret = mistune.create_markdown(renderer=RSTRenderer())(
+            content.decode('utf-8'))
+    if cache_file is not None:
+        create_dirs(cache_dir)
+        with io.open(cache_file, 'w', encoding='utf-8') as f:
+            f.write(ret)
+    return ret
+
+
+def walk_directory(top, ignore_patterns=[]):
+    """Walk through a directory tree
+
+    This function is similar to :func:`os.walk` but skips the files and
+    directories that match one of the `ignore_patterns`. As for
+    :func:`os.walk`, symbolic links to directories are not followed.
+
+    Parameters
+    ----------
+    top: str
+        The directory to start from
+    ignore_patterns: list of str
+        Patterns for :func:`fnmatch.fnmatch` of the file and directory names
+        that shall be ignored
+
+    Yields
+    ------
+    str
+        The path to the directory
+    list of str
+        The names of the subdirectories
+    list of str
+        The names of the files in the directory"""
+    dirs = []
+    files = []
+    for entry in scandir(top):
+        if any(fnmatch(entry.name, patt) for patt in ignore_patterns):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            dirs.append(entry.name)
+        else:
+            files.append(entry.name)
+    yield top, dirs, files
+    for d in dirs:
+        for t in walk_directory(os.path.join(top, d), ignore_patterns):
+            yield t
+
+
+def _file_set(files):
+    """Convert a list of files of the :class:`Gallery` options to a set"""
+    if files is True:
+        return True
+    if isstring(files):
+        return {files}
+    return set(files or [])
+
+
+def _file_hash(fname):
+    """Get the sha1 hash of the content of a file"""
+    import hashlib
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(partial(f.read, 1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _files_unchanged(files):
+    """Check whether the recorded `files` have not been modified
+
+    Parameters
+    ----------
+    files: dict
+        A mapping from the path to the size, modification time and sha1 hash
+        of the file (see :meth:`NotebookProcessor.get_dependencies`). The
+        hash is only computed if the size or modification time changed
+
+    Returns
+    -------
+    bool
+        False if one of the files changed or does not exist anymore"""
+    for fname, (size, mtime, sha) in files.items():
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return False
+        if ((stat.st_size, stat.st_mtime) != (size, mtime) and
+                _file_hash(fname) != sha):
+            return False
+    return True
+
+
+def _write_if_changed(fname, content):
+    """Write `content` into `fname` unless the file already contains it
+
+    This keeps the modification time of unchanged files, such that sphinx
+    (or sphinx-autobuild) does not consider them as changed. `content` may be
+    a string (that is written with utf-8 encoding) or bytes
+
+    Returns
+    -------
+    bool
+        True if the file has been written"""
+    if isinstance(content, bytes):
+        mode, kws = 'b', {}
+    else:
+        mode, kws = '', {'encoding': 'utf-8'}
+    if os.path.exists(fname):
+        with io.open(fname, 'r' + mode, **kws) as f:
+            try:
+                if f.read() == content:
+                    return False
+            except UnicodeDecodeError:
+                pass
+    with io.open(fname, 'w' + mode, **kws) as f:
+        f.write(content)
+    return True
+
+
+#: The chunks of a PNG image that are removed by :func:`normalize_png`
+PNG_VOLATILE_CHUNKS = {b'tIME', b'tEXt', b'zTXt', b'iTXt'}
+
+
+def normalize_png(data):
+    """Remove the timestamp and text chunks from a PNG image
+
+    Parameters
+    ----------
+    data: bytes
+        The content of the PNG file
+
+    Returns
+    -------
+    bytes
+        The image without the :data:`PNG_VOLATILE_CHUNKS`. If `data` is not a
+        valid PNG file, it is returned unchanged"""
+    import struct
+    signature = b'\x89PNG\r\n\x1a\n'
+    if not data.startswith(signature):
+        return data
+    chunks = [signature]
+    pos = len(signature)
+    while pos + 8 <= len(data):
+        length, = struct.unpack('>I', data[pos:pos + 4])
+        end = pos + 12 + length
+        if end > len(data):
+            return data
+        if data[pos + 4:pos + 8] not in PNG_VOLATILE_CHUNKS:
+            chunks.append(data[pos:end])
+        pos = end
+    return b''.join(chunks)
+
+
+def get_kernel_name(infile):
+    """Get the name of the kernelspec in the metadata of a notebook
+
+    Parameters
+    ----------
+    infile: str
+        The path to the notebook
+
+    Returns
+    -------
+    str or None
+        The name of the kernel or None if the notebook does not specify one"""
+    nb = scan_notebook(infile, ncells=0)
+    return nb.metadata.get('kernelspec', {}).get('name') or None
+
+
+class KernelPrewarmer(object):
+    """Class to start the kernels of upcoming notebooks in advance
+
+    While one notebook is executed, the kernels for the next notebooks in the
+    queue are already started such that their execution can begin
+    immediately."""
+
+    def __init__(self, queue, depth=1, scratch_dir=None):
+        """
+        Parameters
+        ----------
+        queue: list of str
+            The paths to the notebooks in the order they are processed
+        depth: int
+            The number of notebooks to look ahead
+        scratch_dir: str
+            If not None, each kernel is started in a new temporary directory
+            within `scratch_dir` (see :attr:`scratch_paths`) instead of the
+            directory of the notebook"""
+        self.queue = list(queue)
+        self.depth = depth
+        self.scratch_dir = scratch_dir
+        #: A mapping from the notebooks to the temporary directories in the
+        #: `scratch_dir` that their kernels have been started in. The
+        #: directory of a notebook is removed with its kernel unless it is
+        #: popped from this mapping together with the kernel manager
+        self.scratch_paths = {}
+        self._positions = {f: i for i, f in enumerate(self.queue)}
+        self._pos = 0
+        self._kernels = OrderedDict()
+
+    def get_kernel_manager(self, infile):
+        """Get the kernel manager for the given notebook
+
+        This method returns the already started kernel for `infile` (if
+        available) and starts the kernels for the next notebooks in the
+        queue.
+
+        Parameters
+        ----------
+        infile: str
+            The path to the notebook that is about to be executed
+
+        Returns
+        -------
+        jupyter_client.KernelManager or None
+            The kernel manager with a running kernel or None, if no kernel has
+            been started for `infile`"""
+        pos = self._positions.get(infile)
+        if pos is not None:
+            self._pos = pos + 1
+        km = self._kernels.pop(infile, None)
+        # discard kernels of notebooks that have been skipped
+        for f in list(self._kernels):
+            if self._positions[f] < self._pos:
+                self._discard(f)
+        self.prewarm()
+        return km
+
+    def prewarm(self):
+        """Start the kernels for the next notebooks in the queue"""
+        import tempfile
+        for infile in self.queue[self._pos:self._pos + self.depth]:
+            if infile not in self._kernels:
+                if self.scratch_dir is None:
+                    cwd = os.path.dirname(infile)
+                else:
+                    cwd = self.scratch_paths[infile] = tempfile.mkdtemp(
+                        prefix='nbexamples_', dir=self.scratch_dir)
+                self._kernels[infile] = self.start_kernel(infile, cwd)
+
+    @staticmethod
+    def start_kernel(infile, cwd=None):
+        """Start the kernel for the given notebook
+
+        Parameters
+        ----------
+        infile: str
+            The path to the notebook
+        cwd: str
+            The working directory of the kernel. If None, the directory of
+            the notebook is used
+
+        Returns
+        -------
+        jupyter_client.KernelManager or None
+            The kernel manager or None if the kernel could not be started"""
+        if cwd is None:
+            cwd = os.path.dirname(infile)
+        try:
+            kernel_name = get_kernel_name(infile)
+            if kernel_name is None:
+                return None
+            from jupyter_client import KernelManager
+            km = KernelManager(kernel_name=kernel_name)
+            km.start_kernel(cwd=cwd)
+        except Exception:
+            logger.debug('Could not start the kernel for %s', infile,
+                         exc_info=True)
+            return None
+        logger.debug('Started kernel %s for %s', kernel_name, infile)
+        return km
+
+    @staticmethod
+    def _shutdown_kernel(km):
+        if km is None:
+            return
+        try:
+            km.shutdown_kernel(now=True)
+        except Exception:
+            logger.debug('Could not shutdown kernel', exc_info=True)
+
+    def _discard(self, infile):
+        self._shutdown_kernel(self._kernels.pop(infile))
+        path = self.scratch_paths.pop(infile, None)
+        if path is not None:
+            rmtree(path, ignore_errors=True)
+
+    def shutdown(self):
+        """Shutdown all kernels that have not been used"""
+        for infile in list(self._kernels):
+            self._discard(infile)
+
+
+class OutputLimiter(object):
+    """Class to truncate large text outputs while a notebook is executed
+
+    An instance of this class wraps the ``output`` method of the
+    :class:`nbconvert.preprocessors.ExecutePreprocessor` that handles the
+    outputs sent by the kernel (see :meth:`install`). Text outputs that exceed
+    the limits are truncated and a :attr:`TRUNCATED` marker is appended.
+    Other text representations than ``'text/plain'`` (e.g. html) are not
+    truncated but removed from the output if they exceed the limits. Outputs
+    that have been cleared (e.g. via ``IPython.display.clear_output``) do not
+    count for the limits."""
+
+    #: The marker that is inserted where the output has been truncated
+    TRUNCATED = '\n[... output truncated ...]\n'
+
+    def __init__(self, output, max_output_size=None,
+                 max_notebook_output_size=None):
+        """
+        Parameters
+        ----------
+        output: callable
+            The ``output`` method of the ExecutePreprocessor
+        max_output_size: int
+            The maximum number of characters of one output. The consecutive
+            outputs of one stream (e.g. stdout) in one cell are considered as
+            one output
+        max_notebook_output_size: int
+            The maximum number of characters of all text outputs in the
+            notebook"""
+        self._output = output
+        self.max_output_size = max_output_size
+        self.max_notebook_output_size = max_notebook_output_size
+        #: The number of characters of all text outputs in the notebook
+        self.notebook_output_size = 0
+        self._sizes = {}
+        self._truncated = set()
+        #: The number of outputs of the cells after the last call
+        self._counts = {}
+
+    @classmethod
+    def install(cls, ep, *args, **kwargs):
+        """Limit the outputs of an ExecutePreprocessor
+
+        Parameters
+        ----------
+        ep: nbconvert.preprocessors.ExecutePreprocessor
+            The preprocessor to use the limiter for
+        ``*args, **kwargs``
+            Any other parameter for the :class:`OutputLimiter` class
+
+        Returns
+        -------
+        OutputLimiter or None
+            The installed limiter or None if the preprocessor does not handle
+            the outputs via an ``output`` method (nbconvert<5.5)"""
+        if not hasattr(ep, 'output'):
+            return None
+        ep.output = ret = cls(ep.output, *args, **kwargs)
+        return ret
+
+    def _allowed_size(self, key):
+        sizes = []
+        if self.max_output_size is not None:
+            sizes.append(self.max_output_size - self._sizes.get(key, 0))
+        if self.max_notebook_output_size is not None:
+            sizes.append(self.max_notebook_output_size -
+                         self.notebook_output_size)
+        return max(min(sizes), 0) if sizes else None
+
+    def _truncate(self, text, key):
+        """Truncate the given `text` and account for its size"""
+        allowed = self._allowed_size(key)
+        if allowed is not None and len(text) > allowed:
+            text = text[:allowed]
+            if key not in self._truncated:
+                self._truncated.add(key)
+                text += self.TRUNCATED
+        self._sizes[key] = self._sizes.get(key, 0) + len(text)
+        self.notebook_output_size += len(text)
+        return text
+
+    def _clear(self, cell_index):
+        """Forget the sizes of the cleared outputs of a cell"""
+        for key in [key for key in self._sizes if key[0] == cell_index]:
+            self.notebook_output_size -= self._sizes.pop(key)
+            self._truncated.discard(key)
+
+    def __call__(self, outs, msg, display_id, cell_index):
+        try:
+            return self._limit(outs, msg, display_id, cell_index)
+        finally:
+            self._counts[cell_index] = len(outs)
+
+    def _limit(self, outs, msg, display_id, cell_index):
+        out = self._output(outs, msg, display_id, cell_index)
+        # the outputs have been cleared since the last call, either
+        # immediately or before the new output (``clear_output(wait=True)``)
+        if len(outs) < self._counts.get(cell_index, 0) + bool(out):
+            self._clear(cell_index)
+        if out is None:
+            return out
+        if out.get('output_type') == 'stream':
+            key = (cell_index, out.get('name'))
+            out['text'] = text = self._truncate(out.get('text', ''), key)
+            if not text and outs and outs[-1] is out:
+                # the stream has been truncated already
+                outs.pop()
+        elif 'data' in out:
+            data = out['data']
+            key = (cell_index, len(outs), id(out))
+            for mime in sorted(data, key=lambda m: m != 'text/plain'):
+                val = data[mime]
+                if not mime.startswith('text/') or not isstring(val):
+                    continue
+                elif mime == 'text/plain':
+                    data[mime] = self._truncate(val, key)
+                    continue
+                allowed = self._allowed_size(key)
+                if allowed is not None and len(val) > allowed:
+                    del data[mime]
+                    if 'text/plain' not in data:
+                        data['text/plain'] = self.TRUNCATED
+                else:
+                    self._truncate(val, key)
+        return out
+
+
+class SnapshotCache(object):
+    """Cache for the kernel states of partially executed notebooks
+
+    Each snapshot consists of the pickled namespace of the kernel after a code
+    cell (``<key>.pkl``) and the outputs of this and all preceding code cells
+    together with the files that these cells read (``<key>.json``). The key
+    is the hash of the sources of these cells (see
+    :meth:`NotebookProcessor.execute_with_snapshots`). The least recently
+    used snapshots are removed when the cache exceeds its maximum size."""
+
+    def __init__(self, cache_dir, max_size=1024 ** 3):
+        """
+        Parameters
+        ----------
+        cache_dir: str
+            The directory for the snapshots
+        max_size: int
+            The maximum number of bytes of the snapshots in the cache"""
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def get_path(self, key):
+        """Get the path to the pickled kernel state of the snapshot `key`"""
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        """Get the outputs of the snapshot `key`
+
+        Returns
+        -------
+        dict or None
+            The ``'cells'`` with the ``'execution_count'`` and ``'outputs'``
+            of the code cells until the snapshot and the ``'dependencies'``
+            of these cells (see :meth:`put`) or None if there is no complete
+            snapshot"""
+        import json
+        fname = os.path.join(self.cache_dir, key + '.json')
+        if not os.path.exists(fname) or not os.path.exists(
+                self.get_path(key)):
+            return None
+        with io.open(fname, encoding='utf-8') as f:
+            try:
+                ret = json.load(f)
+            except ValueError:
+                return None
+        if not isinstance(ret, dict):
+            return None
+        # mark the snapshot as recently used
+        for path in [fname, self.get_path(key)]:
+            os.utime(path, None)
+        return ret
+
+    def put(self, key, cells, dependencies={}):
+        """Save the outputs of the snapshot `key`
+
+        Parameters
+        ----------
+        key: str
+            The key of the snapshot. The kernel state must already have been
+            saved at :meth:`get_path`
+        cells: list of dict
+            The ``'execution_count'`` and ``'outputs'`` of the code cells
+            until the snapshot
+        dependencies: dict
+            The files that have been read by these cells (see
+            :meth:`NotebookProcessor.get_dependencies`)"""
+        import json
+        fname = os.path.join(self.cache_dir, key + '.json')
+        tmp_file = '%s.%s.tmp' % (fname, threading.current_thread().ident)
+        with io.open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(json.dumps(
+                {'cells': cells, 'dependencies': dependencies})))
+        os.rename(tmp_file, fname)
+
+    def remove(self, key):
+        """Remove the snapshot `key`"""
+        for fname in [self.get_path(key),
+                      os.path.join(self.cache_dir, key + '.json')]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def prune(self):
+        """Remove the least recently used snapshots if the cache is too
+        large"""
+        with self._lock:
+            files = {}
+            for entry in scandir(self.cache_dir):
+                key, ext = os.path.splitext(entry.name)
+                if ext not in ['.pkl', '.json']:
+                    continue
+                stat = entry.stat()
+                size, used = files.get(key, (0, 0))
+                files[key] = (size + stat.st_size, max(used, stat.st_mtime))
+            size = sum(size for size, used in files.values())
+            for key in sorted(files, key=lambda key: files[key][1]):
+                if size <= self.max_size:
+                    break
+                self.remove(key)
+                size -= files[key][0]
+
+
 class NotebookProcessor(object):
     """Class to run process one ipython notebook and create the necessary files
     """
@@ -216,49 +1488,203 @@ class NotebookProcessor(object):
     BOKEH_WIDGETS_TEMPLATE = _BOKEH_TEMPLATE % (BOKEH_WIDGETS_STYLE_SHEET,
                                                 BOKEH_WIDGETS_JS)
 
+    #: The field in the rst file that marks a notebook with bokeh outputs if
+    #: :attr:`bokeh_per_page` is True
+    BOKEH_FIELD = ':nbexamples-bokeh: 1\n\n'
+
+    #: The code that records the files that are opened for reading while the
+    #: notebook is executed (see :attr:`track_dependencies`)
+    DEPENDENCIES_SETUP = """
+import sys
+if hasattr(sys, 'addaudithook'):
+    sys._nbexamples_files = set()
+
+    def _nbexamples_audit(event, args, files=sys._nbexamples_files):
+        if event == 'open' and isinstance(args[0], str):
+            if isinstance(args[1], str):
+                if not any(c in args[1] for c in 'wax+'):
+                    files.add(args[0])
+            elif not args[2] & 3:  # neither O_WRONLY nor O_RDWR
+                files.add(args[0])
+
+    sys.addaudithook(_nbexamples_audit)
+    del _nbexamples_audit
+"""
+
+    #: The code that prints the files recorded by the
+    #: :attr:`DEPENDENCIES_SETUP`, except for the files of the python
+    #: installation and in hidden directories (e.g. ``~/.ipython``)
+    DEPENDENCIES_CODE = """
+def _nbexamples_dependencies():
+    import json
+    import os
+    import site
+    import sys
+    prefixes = {sys.prefix, sys.exec_prefix, '/dev', '/proc', '/sys',
+                getattr(sys, 'base_prefix', sys.prefix),
+                site.getusersitepackages()}
+    prefixes.update(getattr(site, 'getsitepackages', list)())
+    prefixes = tuple(os.path.join(os.path.realpath(p), '')
+                     for p in prefixes)
+    files = set()
+    for f in getattr(sys, '_nbexamples_files', []):
+        f = os.path.realpath(f)
+        if (os.path.isfile(f) and not f.startswith(prefixes) and
+                os.path.sep + '.' not in f):
+            files.add(f)
+    print('nbexamples-dependencies: ' + json.dumps(sorted(files)))
+
+
+_nbexamples_dependencies()
+del _nbexamples_dependencies
+"""
+
+    #: The default rules of :meth:`normalize_notebook` for the text outputs
+    NORMALIZE_RULES = [
+        # memory addresses in reprs, e.g. <object at 0x7f3b2c1d0e80>
+        (r'\bat 0x[0-9a-fA-F]+', 'at 0x...'),
+        ]
+
+    #: The code that saves the namespace of the kernel into a snapshot (see
+    #: :meth:`execute_with_snapshots`)
+    SNAPSHOT_CODE = """
+def _nbexamples_snapshot(fname):
+    import os
+    import types
+    try:
+        import dill as pickle
+    except ImportError:
+        import pickle
+    from IPython import get_ipython
+    shell = get_ipython()
+    modules = {}
+    state = {}
+    for key, val in list(shell.user_ns.items()):
+        # skip the variables that IPython defines (In, Out, exit, etc.)
+        if key.startswith('_') or (key in shell.user_ns_hidden and
+                                   shell.user_ns_hidden[key] is val):
+            continue
+        if isinstance(val, types.ModuleType):
+            modules[key] = val.__name__
+            continue
+        try:
+            state[key] = pickle.dumps(val)
+        except Exception:  # the snapshot would be incomplete
+            return
+    with open(fname + '.tmp', 'wb') as f:
+        pickle.dump({'modules': modules, 'state': state}, f)
+    os.rename(fname + '.tmp', fname)
+
+
+_nbexamples_snapshot(%r)
+del _nbexamples_snapshot
+"""
+
+    #: The code that restores the namespace of the kernel from a snapshot (see
+    #: :meth:`execute_with_snapshots`)
+    RESTORE_CODE = """
+def _nbexamples_restore(fname, execution_count):
+    import importlib
+    try:
+        import dill as pickle
+    except ImportError:
+        import pickle
+    from IPython import get_ipython
+    ns = get_ipython().user_ns
+    with open(fname, 'rb') as f:
+        snapshot = pickle.load(f)
+    for key, name in snapshot['modules'].items():
+        ns[key] = importlib.import_module(name)
+    for key, val in snapshot['state'].items():
+        ns[key] = pickle.loads(val)
+    get_ipython().execution_count = execution_count + 1
+
+
+_nbexamples_restore(%r, %i)
+del _nbexamples_restore
+"""
+
+    #: The files that have been read while the notebook was executed. A
+    #: mapping from the path to the size, modification time and sha1 hash of
+    #: the file (see :meth:`get_dependencies`)
+    dependencies = {}
+
+    #: base string for the html file of an externalized output
+    EXTERNAL_HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+{head}
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+    #: base string that replaces an externalized output in the rst file
+    EXTERNAL_HTML_PLACEHOLDER = (
+        '<iframe class="sphx-nbexamples-external" src="{src}" '
+        'loading="lazy" frameborder="0" style="width: 100%; border: none;" '
+        'onload="this.style.height = '
+        'this.contentWindow.document.documentElement.scrollHeight + \'px\'">'
+        '</iframe>')
+
     #: Path to the thumbnail image
     thumb_file = NOIMAGE
 
     #: Paths to the pictures of this notebook
     pictures = []
 
+    #: The processed notebook. It is set to None after all files have been
+    #: created
+    nb = None
+
+    #: The metadata of the notebook
+    metadata = {}
+
+    #: The seconds needed to execute the notebook (None if it has not been
+    #: preprocessed)
+    seconds = None
+
     @property
     def thumbnail_div(self):
         """The string for creating the thumbnail of this example"""
-        return self.THUMBNAIL_TEMPLATE.format(
-            snippet=self.get_description()[1], thumbnail=self.thumb_file,
-            ref_name=self.reference)
+        return self.get_entry().thumbnail_div
 
     @property
     def code_div(self):
         """The string for creating a code example for the gallery"""
-        code_example = self.code_example
-        if code_example is None:
-            return None
-        return self.CODE_TEMPLATE.format(
-            snippet=self.get_description()[1], code=code_example,
-            ref_name=self.reference)
+        return self.get_entry().code_div
 
     @property
     def code_example(self):
         """The code example out of the notebook metadata"""
         if self._code_example is not None:
             return self._code_example
-        return getattr(self.nb.metadata, 'code_example', None)
+        return self.metadata.get('code_example')
 
     @property
     def supplementary_files(self):
         """The supplementary files of this notebook"""
         if self._supplementary_files is not None:
             return self._supplementary_files
-        return getattr(self.nb.metadata, 'supplementary_files', None)
+        return self.metadata.get('supplementary_files')
 
     @property
     def other_supplementary_files(self):
         """The supplementary files of this notebook"""
         if self._other_supplementary_files is not None:
             return self._other_supplementary_files
-        return getattr(self.nb.metadata, 'other_supplementary_files', None)
+        return self.metadata.get('other_supplementary_files')
+
+    @property
+    def output_files(self):
+        """The files created by this notebook that shall be copied to the
+        output directory"""
+        if self._output_files is not None:
+            return self._output_files
+        return self.metadata.get('output_files')
 
     @property
     def reference(self):
@@ -271,7 +1697,7 @@ class NotebookProcessor(object):
         if self._url is not None:
             url = self._url
         else:
-            url = getattr(self.nb.metadata, 'url', None)
+            url = self.metadata.get('url')
         if url is not None:
             return nbviewer_link(url)
 
@@ -284,7 +1710,14 @@ class NotebookProcessor(object):
                  supplementary_files=None, other_supplementary_files=None,
                  thumbnail_figure=None, url=None, insert_bokeh=False,
                  insert_bokeh_widgets=False, tag_options={},
-                 binder_url=None):
+                 binder_url=None, kernel_manager=None, validate=True,
+                 max_output_size=None, max_notebook_output_size=None,
+                 external_html_size=None, bokeh_per_page=False,
+                 optimize_images=None, image_pool=None,
+                 figure_settings=None, create_thumbnail=True,
+                 scratch_dir=None, output_files=None,
+                 track_dependencies=False, normalize_outputs=None,
+                 snapshots=None, scratch_path=None):
         """
         Parameters
         ----------
@@ -323,6 +1756,80 @@ class NotebookProcessor(object):
             :class:`nbconvert.preprocessors.TagRemovePreprocessor`
         binder_url: str
             Link to the repository on mybinder.org or equivalent
+        kernel_manager: jupyter_client.KernelManager
+            A kernel manager with an already started kernel that shall be used
+            for processing the notebook (see :class:`KernelPrewarmer`). It is
+            shut down after the notebook has been processed
+        validate: bool or {'once'}
+            Whether the notebook shall be validated when it is read and
+            written (see :func:`read_notebook` and :func:`write_notebook`)
+        max_output_size: int
+            The maximum number of characters of a text output when the notebook
+            is executed (see :class:`OutputLimiter`)
+        max_notebook_output_size: int
+            The maximum number of characters of all text outputs when the
+            notebook is executed (see :class:`OutputLimiter`)
+        external_html_size: int
+            The number of characters above which a html output is moved into a
+            separate file that is loaded lazily in the html page (see
+            :meth:`externalize_html`). If None, all outputs are inserted into
+            the rst file
+        bokeh_per_page: bool
+            If True, the bokeh style sheets and javascript are not inserted
+            into the rst file. Instead, the rst file is marked with the
+            :attr:`BOKEH_FIELD` if the notebook contains a bokeh output (see
+            :func:`has_bokeh_output`) and the files are added to the html page
+            by :func:`insert_bokeh_assets`
+        optimize_images: dict
+            Keyword arguments for the :func:`optimize_image` function to
+            optimize the PNG images of the notebook (see
+            :meth:`optimize_outputs`). If None or if the ``'optimize_images'``
+            key in the metadata of the notebook is False, the images are
+            written as they are
+        image_pool: multiprocessing.pool.ThreadPool
+            The worker pool to optimize the images. If None, the images are
+            optimized one after another
+        figure_settings: dict
+            Settings for the figures of the kernel that are applied in a
+            hidden cell before the notebook is executed (see
+            :meth:`get_figure_settings_code`). The ``'figure_settings'`` key
+            in the metadata of the notebook updates these settings or
+            disables them if it is False
+        create_thumbnail: bool
+            If False, no thumbnail is created for the gallery (e.g. for
+            builders that do not produce html)
+        scratch_dir: str
+            If not None, the notebook is executed in a new temporary
+            directory within `scratch_dir` instead of the directory of the
+            notebook (see :meth:`create_scratch_dir`)
+        output_files: list of str
+            Glob patterns for the files that are created when the notebook is
+            executed and shall be copied to the output directory (see
+            :meth:`copy_output_files`). Note that you can also include an
+            ``'output_files'`` key in the metadata of the notebook
+        track_dependencies: bool
+            If True, the files that a python notebook reads while it is
+            executed are recorded in the :attr:`dependencies`. This requires
+            python 3.8 or later in the kernel
+        normalize_outputs: list of tuple
+            If not None, the volatile data in the notebook is removed after
+            it has been executed (see :meth:`normalize_notebook`). Each tuple
+            contains a regular expression and its replacement for the text
+            outputs
+        snapshots: SnapshotCache
+            If not None, the namespace of the kernel of a python notebook is
+            saved after each code cell and the execution starts from the
+            snapshot before the first modified cell (see
+            :meth:`execute_with_snapshots`). The ``'snapshots'`` key in the
+            metadata of the notebook can disable this if it is False. The
+            snapshots are not used if the notebook is executed in a
+            `scratch_dir` because the files of the previous execution are
+            not available there
+        scratch_path: str
+            The temporary directory within `scratch_dir` that the
+            `kernel_manager` has been started in (see
+            :attr:`KernelPrewarmer.scratch_paths`). If None, a new one is
+            created
             """
         self.infile = infile
         self.outfile = outfile
@@ -337,8 +1844,27 @@ class NotebookProcessor(object):
         self.insert_bokeh_widgets = insert_bokeh_widgets
         self.tag_options = tag_options
         self.binder_url = binder_url
+        self.kernel_manager = kernel_manager
+        self.validate = validate
+        self.max_output_size = max_output_size
+        self.max_notebook_output_size = max_notebook_output_size
+        self.external_html_size = external_html_size
+        self.bokeh_per_page = bokeh_per_page
+        self.optimize_images = optimize_images
+        self.image_pool = image_pool
+        self.figure_settings = figure_settings
+        self.scratch_dir = scratch_dir
+        self._output_files = output_files
+        self.track_dependencies = track_dependencies
+        self.normalize_outputs = normalize_outputs
+        self.snapshots = snapshots
+        self.scratch_path = scratch_path
         self.process_notebook(disable_warnings)
-        self.create_thumb()
+        if create_thumbnail:
+            self.create_thumb()
+        self.description = self.get_description()
+        # free the memory of the outputs
+        self.nb = None
 
     def get_out_file(self, ending='rst'):
         """get the output file with the specified `ending`"""
@@ -350,6 +1876,7 @@ class NotebookProcessor(object):
         This method runs the notebook using the :mod:`nbconvert` and
         :mod:`nbformat` modules. It creates the :attr:`outfile` notebook,
         a python and a rst file"""
+        import nbconvert
         infile = self.infile
         outfile = self.outfile
         in_dir = os.path.dirname(infile) + os.path.sep
@@ -359,8 +1886,13 @@ class NotebookProcessor(object):
             timeout=300)
         cp = nbconvert.preprocessors.ClearOutputPreprocessor(
             timeout=300)
+        if (self.max_output_size is not None or
+                self.max_notebook_output_size is not None):
+            OutputLimiter.install(ep, self.max_output_size,
+                                  self.max_notebook_output_size)
 
-        self.nb = nb = nbformat.read(infile, nbformat.current_nbformat)
+        self.nb = nb = read_notebook(infile, self.validate)
+        self.metadata = nb.metadata
 
         language_info = getattr(nb.metadata, 'language_info', {})
         ext = language_info.get('file_extension', 'py')
@@ -371,38 +1903,88 @@ class NotebookProcessor(object):
         # write and process rst_file
         if self.preprocess:
 
+            path = in_dir
+            if self.scratch_dir is not None:
+                path = self.create_scratch_dir(in_dir, self.scratch_path)
+            km = self.kernel_manager
+            setup_code = ''
+            if path != in_dir and path != self.scratch_path:
+                if self.script.endswith('.py'):
+                    # a pre-started kernel runs in the directory of the
+                    # notebook
+                    setup_code += "\nimport os\nos.chdir(%r)\n" % path
+                elif km is not None:
+                    KernelPrewarmer._shutdown_kernel(km)
+                    km = self.kernel_manager = None
             # disable warnings in the rst file
             if disable_warnings:
-                for i, cell in enumerate(nb.cells):
-                    if cell['cell_type'] == 'code':
-                        cell = cell.copy()
-                        break
-                cell = cell.copy()
-                cell.source = """
+                setup_code += """
 import logging
 logging.captureWarnings(True)
 logging.getLogger('py.warnings').setLevel(logging.ERROR)
 """
-                nb.cells.insert(i, cell)
+            track_dependencies = (self.track_dependencies and
+                                  self.script.endswith('.py'))
+            if self.script.endswith('.py'):
+                setup_code += self.get_figure_settings_code()
+            if track_dependencies:
+                setup_code += self.DEPENDENCIES_SETUP
+            from nbformat.v4 import new_code_cell
+            if setup_code:
+                # insert the setup cell before the first code cell
+                i = next((i for i, cell in enumerate(nb.cells)
+                          if cell['cell_type'] == 'code'), 0)
+                nb.cells.insert(i, new_code_cell(setup_code))
+            if track_dependencies:
+                nb.cells.append(new_code_cell(self.DEPENDENCIES_CODE))
 
             t = dt.datetime.now()
             logger.info('Processing %s', self.infile)
+            kws = {'km': km} if km is not None else {}
+            hidden = ([i] if setup_code else []) + (
+                [len(nb.cells) - 1] if track_dependencies else [])
+            snapshot_dependencies = {}
             try:
-                ep.preprocess(nb, {'metadata': {'path': in_dir}})
+                if (self.snapshots is not None and path == in_dir and
+                        self.script.endswith('.py') and
+                        self.metadata.get('snapshots', True)):
+                    snapshot_dependencies = self.execute_with_snapshots(
+                        ep, nb, {'metadata': {'path': path}}, kws, hidden,
+                        track_dependencies)
+                else:
+                    ep.preprocess(nb, {'metadata': {'path': path}}, **kws)
             except nbconvert.preprocessors.execute.CellExecutionError:
                 logger.critical(
                     'Error while processing %s!', self.infile, exc_info=True)
             else:
                 logger.info('Done. Seconds needed: %i',
                             (dt.datetime.now() - t).seconds)
-            if disable_warnings:
+            finally:
+                if km is not None:
+                    # we own the pre-started kernel, so we have to stop it
+                    if getattr(ep, 'kc', None) is not None:
+                        ep.kc.stop_channels()
+                    KernelPrewarmer._shutdown_kernel(km)
+                    self.kernel_manager = None
+                if track_dependencies:
+                    self.dependencies = dict(snapshot_dependencies)
+                    self.dependencies.update(self.get_dependencies(
+                        nb.cells.pop(), path, in_dir))
+                self.copy_output_files(path, odir)
+                if path != in_dir:
+                    rmtree(path, ignore_errors=True)
+            self.seconds = (dt.datetime.now() - t).total_seconds()
+            if setup_code:
                 nb.cells.pop(i)
 
+        if self.normalize_outputs is not None:
+            self.normalize_notebook(nb)
+
         if self.remove_tags:
             tp = nbconvert.preprocessors.TagRemovePreprocessor(timeout=300)
             for key, val in self.tag_options.items():
                 setattr(tp, key, set(val))
-            nb4rst = deepcopy(nb)
+            nb4rst = copy_notebook_structure(nb)
             tp.preprocess(nb4rst, {'metadata': {'path': in_dir}})
         else:
             nb4rst = nb
@@ -412,11 +1994,414 @@ logging.getLogger('py.warnings').setLevel(logging.ERROR)
         if self.clear:
             cp.preprocess(nb, {'metadata': {'path': in_dir}})
         # write notebook file
-        nbformat.write(nb, outfile)
+        write_notebook(nb, outfile, self.validate)
         self.create_py(nb)
 
+    def execute_with_snapshots(self, ep, nb, resources, kws, hidden=[],
+                               track_dependencies=False):
+        """Execute the notebook from the last snapshot of the kernel
+
+        Each code cell is identified by the hash of its source and the
+        sources of all preceding code cells (and the path of the notebook,
+        the kernel, the
+        :func:`environment_fingerprint` and the figure settings). The latest
+        snapshot in the :attr:`snapshots` whose hash matches is restored,
+        its outputs are used for the unchanged cells and only the remaining
+        cells are executed. After each executed code cell, a new snapshot is
+        saved (with :mod:`dill` if it is installed in the kernel, otherwise
+        with :mod:`pickle`). If the snapshot cannot be restored, the entire
+        notebook is executed in a new kernel.
+
+        If `track_dependencies` is True, the files that the cells read until
+        a snapshot (see :meth:`get_dependencies`) are stored with it, and a
+        snapshot is not used if one of these files changed. Otherwise,
+        changes of files that are read by the unchanged cells (e.g. data
+        files) are not detected.
+
+        Parameters
+        ----------
+        ep: nbconvert.preprocessors.ExecutePreprocessor
+            The preprocessor to execute the notebook
+        nb: nbformat.NotebookNode
+            The notebook. It is modified in place
+        resources: dict
+            The resources for the `ep`
+        kws: dict
+            Further keyword arguments for the ``preprocess`` method of `ep`
+        hidden: list of int
+            The indices of the hidden cells (e.g. the setup cell) that are
+            always executed and not part of the hashes
+        track_dependencies: bool
+            Whether the files that are read by the notebook are recorded
+            with the :attr:`DEPENDENCIES_CODE`
+
+        Returns
+        -------
+        dict
+            The dependencies of the cells that have not been executed (see
+            :meth:`get_dependencies`)"""
+        import hashlib
+        import nbconvert
+        from nbformat import NotebookNode, from_dict
+        from nbformat.v4 import new_code_cell
+        cache = self.snapshots
+        create_dirs(cache.cache_dir)
+        code_cells = [cell for i, cell in enumerate(nb.cells)
+                      if cell.cell_type == 'code' and i not in hidden]
+        h = hashlib.sha1('\n'.join([
+            os.path.abspath(self.infile),
+            nb.metadata.get('kernelspec', {}).get('name', ''),
+            environment_fingerprint(
+                nb.metadata.get('kernelspec', {}).get('name')),
+            self.get_figure_settings_code()]).encode('utf-8'))
+        keys = []
+        for cell in code_cells:
+            h.update(cell.source.encode('utf-8'))
+            keys.append(h.hexdigest())
+            h = h.copy()
+
+        path = resources['metadata']['path']
+        start = 0
+        dependencies = {}
+        for k in range(len(code_cells) - 1, -1, -1):
+            cached = cache.get(keys[k])
+            if cached is not None and _files_unchanged(
+                    cached['dependencies']):
+                for cell, cached_cell in zip(code_cells, cached['cells']):
+                    cell.execution_count = cached_cell['execution_count']
+                    cell.outputs = [from_dict(output)
+                                    for output in cached_cell['outputs']]
+                dependencies = cached['dependencies']
+                start = k + 1
+                break
+        if start == len(code_cells):
+            logger.info('Using the snapshot of the entire notebook')
+            return dependencies
+
+        # the inserted cells must not increase the execution count
+        internal = set()
+        preprocess_cell = ep.preprocess_cell
+
+        def run_cell(cell, resources, index):
+            if id(cell) in internal:
+                return (ep.execute_cell(cell, index, store_history=False),
+                        ep.resources)
+            return preprocess_cell(cell, resources, index)
+
+        ep.preprocess_cell = run_cell
+        snapshot_code = self.SNAPSHOT_CODE + (
+            self.DEPENDENCIES_CODE if track_dependencies else '')
+        snapshot_cells = {}
+
+        def execute(start, kws):
+            """Execute the code cells starting from `start` and return
+            False if the snapshot could not be restored"""
+            skipped = set(map(id, code_cells[:start]))
+            snapshot_cells.clear()
+            positions = {id(cell): k for k, cell in enumerate(code_cells)}
+            cells = []
+            restore_cell = None
+            for cell in nb.cells:
+                if id(cell) in skipped:
+                    continue
+                if start and restore_cell is None and \
+                        positions.get(id(cell)) == start:
+                    restore_cell = new_code_cell(self.RESTORE_CODE % (
+                        cache.get_path(keys[start - 1]),
+                        code_cells[start - 1].execution_count or 0))
+                    internal.add(id(restore_cell))
+                    cells.append(restore_cell)
+                cells.append(cell)
+                if id(cell) in positions:
+                    k = positions[id(cell)]
+                    snapshot_cells[k] = new_code_cell(
+                        snapshot_code % cache.get_path(keys[k]))
+                    internal.add(id(snapshot_cells[k]))
+                    cells.append(snapshot_cells[k])
+            exec_nb = NotebookNode(nb)
+            exec_nb.cells = cells
+
+            def restored():
+                return restore_cell is None or not any(
+                    output.output_type == 'error'
+                    for output in restore_cell.outputs)
+
+            try:
+                ep.preprocess(exec_nb, resources, **kws)
+            except nbconvert.preprocessors.execute.CellExecutionError:
+                if restored():
+                    raise
+            return restored()
+
+        if start:
+            logger.info('Restoring the snapshot after code cell %i', start)
+        try:
+            if not execute(start, kws):
+                logger.warning(
+                    'Could not restore the snapshot of %s. Executing the '
+                    'entire notebook.', self.infile)
+                for key in keys[start - 1:]:
+                    cache.remove(key)
+                if kws.get('km') is not None and \
+                        getattr(ep, 'kc', None) is not None:
+                    ep.kc.stop_channels()
+                for cell in code_cells:
+                    cell.outputs = []
+                    cell.execution_count = None
+                start = 0
+                dependencies = {}
+                execute(start, {})
+        finally:
+            ep.preprocess_cell = preprocess_cell
+            for k in range(start, len(code_cells)):
+                if (code_cells[k].execution_count is not None and
+                        os.path.exists(cache.get_path(keys[k]))):
+                    # the kernel only recorded the files since the restore
+                    deps = dict(dependencies)
+                    if track_dependencies:
+                        deps.update(self.get_dependencies(
+                            snapshot_cells.get(k, {}), path, path))
+                    cache.put(keys[k], [
+                        {'execution_count': cell.execution_count,
+                         'outputs': cell.outputs}
+                        for cell in code_cells[:k + 1]], deps)
+            cache.prune()
+        return dependencies
+
+    def normalize_notebook(self, nb):
+        """Remove the volatile data from the notebook
+
+        This method makes the outputs of the notebook independent of the
+        execution, such that the created files only change if the content
+        changes. It
+
+        - removes the ``'execution'`` metadata (timestamps) of the cells
+        - numbers the execution counts consecutively
+        - applies the :attr:`normalize_outputs` rules to the text outputs
+        - replaces the ids of the jupyter widgets with ids that depend on
+          their order
+        - removes the timestamp and text chunks of the PNG images (see
+          :func:`normalize_png`)
+
+        Parameters
+        ----------
+        nb: nbformat.NotebookNode
+            The notebook. It is modified in place"""
+        import base64
+        import hashlib
+        import json
+        rules = [(re.compile(pattern) if isstring(pattern) else pattern, repl)
+                 for pattern, repl in self.normalize_outputs]
+
+        def normalize_text(text):
+            if isinstance(text, list):
+                text = ''.join(text)
+            for pattern, repl in rules:
+                text = pattern.sub(repl, text)
+            return text
+
+        widget_key = 'application/vnd.jupyter.widget-state+json'
+        state = nb.metadata.get('widgets', {}).get(widget_key, {}).get(
+            'state', {})
+        widget_ids = {
+            model_id: hashlib.sha1(str(i).encode('utf-8')).hexdigest()[:32]
+            for i, model_id in enumerate(state)}
+
+        def replace_widget_ids(obj):
+            if not widget_ids:
+                return obj
+            s = json.dumps(obj)
+            for old, new in widget_ids.items():
+                s = s.replace(old, new)
+            return json.loads(s)
+
+        count = 0
+        for cell in nb.cells:
+            cell.metadata.pop('execution', None)
+            if cell.cell_type != 'code':
+                continue
+            if cell.get('execution_count') is not None:
+                count += 1
+                cell.execution_count = count
+            for output in cell.get('outputs', []):
+                if 'execution_count' in output:
+                    output['execution_count'] = cell.execution_count
+                if 'text' in output:
+                    output['text'] = normalize_text(output['text'])
+                data = output.get('data', {})
+                for mimetype, val in list(data.items()):
+                    if mimetype.startswith('text/'):
+                        data[mimetype] = normalize_text(val)
+                    elif mimetype == 'image/png':
+                        png = base64.b64decode(val)
+                        normalized = normalize_png(png)
+                        if normalized != png:
+                            data[mimetype] = base64.b64encode(
+                                normalized).decode('ascii')
+                if widget_ids and data:
+                    output['data'] = replace_widget_ids(data)
+        if widget_ids:
+            nb.metadata.widgets[widget_key] = replace_widget_ids(
+                nb.metadata.widgets[widget_key])
+
+    def create_scratch_dir(self, in_dir, path=None):
+        """Create a temporary directory to execute the notebook in
+
+        The directory is created in the :attr:`scratch_dir` and contains the
+        :attr:`supplementary_files` and :attr:`other_supplementary_files` of
+        the notebook. They are hard linked if possible, otherwise symlinked or
+        copied, so the notebook should not modify them.
+
+        Parameters
+        ----------
+        in_dir: str
+            The directory of the notebook
+        path: str
+            An existing empty directory to use (e.g. the directory that a
+            pre-started kernel runs in). If None, a new directory is created
+
+        Returns
+        -------
+        str
+            The path to the directory. It is removed after the notebook has
+            been executed"""
+        import tempfile
+        if path is None:
+            path = tempfile.mkdtemp(prefix='nbexamples_',
+                                    dir=self.scratch_dir)
+        for f in (self.supplementary_files or []) + (
+                self.other_supplementary_files or []):
+            src = os.path.abspath(os.path.join(in_dir, f))
+            target = os.path.join(path, f)
+            create_dirs(os.path.dirname(target))
+            try:
+                os.link(src, target)
+            except (OSError, AttributeError):
+                try:
+                    os.symlink(src, target)
+                except (OSError, AttributeError, NotImplementedError):
+                    copyfile(src, target)
+        return path
+
+    def get_dependencies(self, cell, path, in_dir):
+        """Get the files that have been read by the notebook
+
+        Parameters
+        ----------
+        cell: nbformat.NotebookNode
+            The executed cell with the :attr:`DEPENDENCIES_CODE`
+        path: str
+            The directory where the notebook has been executed
+        in_dir: str
+            The directory of the notebook. Files in the scratch directory
+            `path` are replaced by the corresponding files in `in_dir`
+
+        Returns
+        -------
+        dict
+            A mapping from the path to the size, modification time and sha1
+            hash of the file"""
+        import json
+        marker = 'nbexamples-dependencies: '
+        files = []
+        for output in cell.get('outputs', []):
+            for line in output.get('text', '').splitlines():
+                if line.startswith(marker):
+                    files = json.loads(line[len(marker):])
+        ret = {}
+        scratch = os.path.join(os.path.realpath(path), '')
+        # the snapshots are read and written by the kernel, too
+        ignore = () if self.snapshots is None else (os.path.join(
+            os.path.realpath(self.snapshots.cache_dir), ''), )
+        for f in files:
+            if f.startswith(ignore):
+                continue
+            if path != in_dir and f.startswith(scratch):
+                f = os.path.join(os.path.abspath(in_dir), f[len(scratch):])
+            if os.path.isfile(f) and f != os.path.abspath(self.infile):
+                stat = os.stat(f)
+                ret[f] = [stat.st_size, stat.st_mtime, _file_hash(f)]
+        return ret
+
+    #: The files copied by :meth:`copy_output_files`
+    copied_output_files = []
+
+    def copy_output_files(self, path, odir):
+        """Copy the :attr:`output_files` of the executed notebook
+
+        Parameters
+        ----------
+        path: str
+            The directory where the notebook has been executed
+        odir: str
+            The output directory. The files keep their path relative to
+            `path`"""
+        import glob
+        self.copied_output_files = []
+        for pattern in self.output_files or []:
+            for src in sorted(glob.glob(os.path.join(path, pattern))):
+                target = os.path.join(odir, os.path.relpath(src, path))
+                create_dirs(os.path.dirname(target))
+                copyfile(src, target)
+                self.copied_output_files.append(target)
+
+    def get_figure_settings_code(self):
+        """Get the code to configure the figures in the kernel
+
+        The settings are taken from the :attr:`figure_settings` and the
+        ``'figure_settings'`` key in the notebook metadata. Possible keys are
+
+        formats: list of str
+            The formats of the matplotlib figures (the
+            ``InlineBackend.figure_formats``), e.g. ``['png']``
+        dpi: int
+            The resolution of the matplotlib figures
+        mimetypes: list of str
+            The mimetypes that are computed for the outputs (the
+            ``active_types`` of the IPython display formatter), e.g.
+            ``['text/plain', 'text/html', 'image/png']``
+
+        Returns
+        -------
+        str
+            The python code for the hidden setup cell or an empty string if
+            there are no settings"""
+        settings = self.metadata.get('figure_settings', {})
+        if settings is False or self.figure_settings is None:
+            return ''
+        settings = dict(self.figure_settings, **settings)
+        lines = []
+        if settings.get('formats'):
+            lines.append("_ip.run_line_magic('config', %r)" % (
+                'InlineBackend.figure_formats = %r' % (
+                    list(settings['formats']), ), ))
+        if settings.get('dpi'):
+            rc = {'figure.dpi': settings['dpi']}
+            lines.append("_ip.run_line_magic('config', %r)" % (
+                'InlineBackend.rc = %r' % (rc, ), ))
+            lines.append("if 'matplotlib' in sys.modules:")
+            lines.append(
+                "    sys.modules['matplotlib'].rcParams.update(%r)" % (rc, ))
+        if settings.get('mimetypes'):
+            lines.append("_ip.display_formatter.active_types = %r" % (
+                list(settings['mimetypes']), ))
+        if not lines:
+            return ''
+        return """
+import sys
+from IPython import get_ipython
+_ip = get_ipython()
+if _ip is not None:
+%s
+del _ip
+""" % '\n'.join('    ' + line for line in lines)
+
     def create_rst(self, nb, in_dir, odir):
         """Create the rst file from the notebook node"""
+        import nbconvert
+        bokeh = self.bokeh_per_page and has_bokeh_output(nb)
+        if self.external_html_size is not None:
+            nb = self.externalize_html(nb, odir)
         exporter = nbconvert.RSTExporter()
         raw_rst, resources = exporter.from_notebook_node(nb)
         # remove ipython magics
@@ -427,13 +2412,14 @@ logging.getLogger('py.warnings').setLevel(logging.ERROR)
         # themes (e.g. the sphinx_rtd_theme) it is not sufficient to include
         # the style sheets only via app.add_stylesheet
         bokeh_str = ''
-        if 'bokeh' in raw_rst and self.insert_bokeh:
+        insert_bokeh = not self.bokeh_per_page and 'bokeh' in raw_rst
+        if insert_bokeh and self.insert_bokeh:
             bokeh_str += self.BOKEH_TEMPLATE.format(
                 version=self.insert_bokeh)
-        if 'bokeh' in raw_rst and self.insert_bokeh_widgets:
+        if insert_bokeh and self.insert_bokeh_widgets:
             bokeh_str += self.BOKEH_WIDGETS_TEMPLATE.format(
                 version=self.insert_bokeh_widgets)
-        for m in code_blocks.finditer(raw_rst):
+        for m in get_code_blocks().finditer(raw_rst):
             lines = m.group().splitlines(True)
             header, content = lines[0], ''.join(lines[1:])
             no_magics = magic_patt.sub('\g<1>', content)
@@ -452,6 +2438,8 @@ logging.getLogger('py.warnings').setLevel(logging.ERROR)
             rst_content = raw_rst
         rst_content = '.. _%s:\n\n' % self.reference + \
             rst_content
+        if bokeh:
+            rst_content = self.BOKEH_FIELD + rst_content
         language_info = getattr(nb.metadata, 'language_info', {})
         url = self.url
         if url is not None:
@@ -480,27 +2468,117 @@ logging.getLogger('py.warnings').setLevel(logging.ERROR)
 
         rst_file = self.get_out_file()
         outputs = sorted(resources['outputs'], key=rst_content.find)
+        optimized = self.optimize_outputs(outputs, resources)
         base = os.path.join('images', os.path.splitext(
-            os.path.basename(self.infile))[0] + '_%i.png')
-        out_map = {os.path.basename(original): base % i
+            os.path.basename(self.infile))[0] + '_%i.')
+        out_map = {os.path.basename(original): base % i + (
+                       self.optimize_images.get('format', 'png')
+                       if original in optimized else 'png')
                    for i, original in enumerate(outputs)}
         for original, final in six.iteritems(out_map):
             rst_content = rst_content.replace(original, final)
-        with open(rst_file, 'w') \
-                as f:
-            f.write(rst_content.rstrip() + '\n')
+        _write_if_changed(rst_file, rst_content.rstrip() + '\n')
         pictures = []
         for original in outputs:
             fname = os.path.join(odir, out_map[os.path.basename(original)])
             pictures.append(fname)
-            if six.PY3:
-                f = open(fname, 'w+b')
-            else:
-                f = open(fname, 'w')
-            f.write(resources['outputs'][original])
-            f.close()
+            _write_if_changed(fname, optimized.get(
+                original, resources['outputs'][original]))
         self.pictures = pictures
 
+    def optimize_outputs(self, outputs, resources):
+        """Optimize the PNG images of the notebook
+
+        The images are downsampled and recompressed in the :attr:`image_pool`
+        using the :func:`optimize_image` function with the
+        :attr:`optimize_images` settings
+
+        Parameters
+        ----------
+        outputs: list of str
+            The names of the extracted outputs
+        resources: dict
+            The resources of the :class:`nbconvert.RSTExporter` with the
+            ``'outputs'``
+
+        Returns
+        -------
+        dict
+            A mapping from the names of the optimized PNG images in `outputs`
+            to the content of the optimized image"""
+        if (self.optimize_images is None or
+                not self.metadata.get('optimize_images', True)):
+            return {}
+        pngs = [original for original in outputs if original.endswith('.png')]
+        func = partial(optimize_image, **self.optimize_images)
+        data = [resources['outputs'][original] for original in pngs]
+        if self.image_pool is None:
+            return dict(zip(pngs, map(func, data)))
+        return dict(zip(pngs, self.image_pool.map(func, data)))
+
+    #: The files created by :meth:`externalize_html`
+    external_files = []
+
+    def externalize_html(self, nb, odir):
+        """Move large html outputs into separate files
+
+        The html outputs with more than :attr:`external_html_size` characters
+        are written into the ``'external'`` directory next to the rst file
+        and replaced by an iframe that loads them when they are scrolled into
+        view (see :attr:`EXTERNAL_HTML_PLACEHOLDER`). The files are copied
+        into the html build by the :func:`copy_external_outputs` function.
+
+        Parameters
+        ----------
+        nb: nbformat.NotebookNode
+            The notebook to create the rst file from. It is not modified
+        odir: str
+            The output directory for the rst file
+
+        Returns
+        -------
+        nbformat.NotebookNode
+            A copy of `nb` with the placeholders instead of the large outputs
+        """
+        from nbformat import NotebookNode
+        nb = copy_notebook_structure(nb)
+        head = []
+        for version, css, js in [
+                (self.insert_bokeh, self.BOKEH_STYLE_SHEET, self.BOKEH_JS),
+                (self.insert_bokeh_widgets, self.BOKEH_WIDGETS_STYLE_SHEET,
+                 self.BOKEH_WIDGETS_JS)]:
+            if version:
+                head.append(
+                    '<link href="%s" rel="stylesheet" type="text/css">\n'
+                    '<script src="%s"></script>' % (
+                        css.format(version=version),
+                        js.format(version=version)))
+        head = '\n'.join(head)
+        base = os.path.join('external', os.path.splitext(
+            os.path.basename(self.infile))[0] + '_%i.html')
+        self.external_files = []
+        i = 0
+        for cell in nb.cells:
+            for j, output in enumerate(cell.get('outputs', [])):
+                html = output.get('data', {}).get('text/html')
+                if html is None or len(html) <= self.external_html_size:
+                    continue
+                fname = base % i
+                i += 1
+                self.external_files.append(os.path.join(odir, fname))
+                create_dirs(os.path.join(odir, 'external'))
+                with io.open(os.path.join(odir, fname), 'w',
+                             encoding='utf-8') as f:
+                    f.write(self.EXTERNAL_HTML_TEMPLATE.format(
+                        head=head, body=html))
+                output = NotebookNode(output)
+                output.data = NotebookNode(output.data)
+                output.data['text/html'] = \
+                    self.EXTERNAL_HTML_PLACEHOLDER.format(
+                        src=fname.replace(os.path.sep, '/'))
+                cell.outputs[j] = output
+        return nb
+
     def create_py(self, nb, force=False):
         """Create the python script from the notebook node"""
         # Although we would love to simply use ``nbconvert.export_python(nb)``
@@ -508,6 +2586,7 @@ logging.getLogger('py.warnings').setLevel(logging.ERROR)
         # directive. Instead of getting something like ``Out [5]:``, we get
         # some weird like '[0;31mOut[[1;31m5[0;31m]: [0m' which look like
         # color information if we allow the call of nbconvert.export_python
+        import nbconvert
         if list(map(int, re.findall('\d+', nbconvert.__version__))) >= [4, 2]:
             script = os.path.basename(self.script)
         else:
@@ -548,50 +2627,16 @@ logging.getLogger('py.warnings').setLevel(logging.ERROR)
             self.save_thumbnail(pic)
         else:
             for pic in self.pictures[::-1]:
-                if pic.endswith('png'):
+                if pic.endswith(('png', 'webp')):
                     self.save_thumbnail(pic)
                     return
 
     def get_description(self):
         """Get summary and description of this notebook"""
-        def split_header(s, get_header=True):
-            s = s.lstrip().rstrip()
-            parts = s.splitlines()
-            if parts[0].startswith('#'):
-                if get_header:
-                    header = re.sub('#+\s*', '', parts.pop(0))
-                    if not parts:
-                        return header, ''
-                else:
-                    header = ''
-                rest = '\n'.join(parts).lstrip().split('\n\n')
-                desc = rest[0].replace('\n', ' ')
-                return header, desc
-            else:
-                if get_header:
-                    if parts[0].startswith(('=', '-')):
-                        parts = parts[1:]
-                    header = parts.pop(0)
-                    if parts and parts[0].startswith(('=', '-')):
-                        parts.pop(0)
-                    if not parts:
-                        return header, ''
-                else:
-                    header = ''
-                rest = '\n'.join(parts).lstrip().split('\n\n')
-                desc = rest[0].replace('\n', ' ')
-                return header, desc
-
-        first_cell = self.nb['cells'][0]
-
-        if not first_cell['cell_type'] == 'markdown':
-            return '', ''
-        header, desc = split_header(first_cell['source'])
-        if not desc and len(self.nb['cells']) > 1:
-            second_cell = self.nb['cells'][1]
-            if second_cell['cell_type'] == 'markdown':
-                _, desc = split_header(second_cell['source'], False)
-        return header, desc
+        nb = self.nb
+        if nb is None:
+            nb = scan_notebook(self.infile)
+        return notebook_description(nb)
 
     def scale_image(self, in_fname, out_fname, max_width, max_height):
         """Scales an image with the same aspect ratio centered in an
@@ -642,6 +2687,34 @@ logging.getLogger('py.warnings').setLevel(logging.ERROR)
             self.scale_image(image_path, thumb_file, 400, 280)
         self.thumb_file = thumb_file
 
+    def get_entry(self):
+        """Get the compact record of this notebook for the gallery
+
+        Returns
+        -------
+        GalleryEntry
+            The record that does not keep a reference to the notebook"""
+        description = getattr(self, 'description', None)
+        if description is None:
+            description = self.get_description()
+        script = getattr(self, 'script', None)
+        files = [self.outfile, self.get_out_file()]
+        if script is not None:
+            files.append(script)
+        files.extend(self.pictures)
+        if self.thumb_file != NOIMAGE:
+            files.append(self.thumb_file)
+        files.extend(self.external_files)
+        files.extend(self.copied_output_files)
+        return GalleryEntry(
+            reference=self.reference, infile=self.infile,
+            outfile=self.outfile, rst_file=self.get_out_file(),
+            script=script, thumb_file=self.thumb_file,
+            description=description[1], code_example=self.code_example,
+            pictures=list(self.pictures), seconds=self.seconds,
+            templates=self, files=files, dependencies=self.dependencies,
+            kernel=self.metadata.get('kernelspec', {}).get('name') or None)
+
     def get_thumb_path(self, base_dir):
         """Get the relative path to the thumb nail of this notebook"""
         return os.path.relpath(self.thumb_file, base_dir)
@@ -657,18 +2730,115 @@ logging.getLogger('py.warnings').setLevel(logging.ERROR)
                                osp.basename(self._thumbnail_figure))
                 copyfile(self._thumbnail_figure, ret)
                 return ret
-        elif hasattr(self.nb.metadata, 'thumbnail_figure'):
-            if not isstring(self.nb.metadata.thumbnail_figure):
-                ret = self.nb.metadata.thumbnail_figure
+        elif 'thumbnail_figure' in self.metadata:
+            thumbnail_figure = self.metadata['thumbnail_figure']
+            if not isstring(thumbnail_figure):
+                ret = thumbnail_figure
             else:
                 ret = osp.join(osp.dirname(self.outfile), 'images',
-                               osp.basename(self.nb.metadata.thumbnail_figure))
-                copyfile(osp.join(osp.dirname(self.infile),
-                                  self.nb.metadata.thumbnail_figure),
+                               osp.basename(thumbnail_figure))
+                copyfile(osp.join(osp.dirname(self.infile), thumbnail_figure),
                          ret)
         return ret
 
 
+class GalleryEntry(object):
+    """Compact record of a processed notebook
+
+    This class holds the information that is needed for the gallery index of
+    a notebook that has been processed by the :class:`NotebookProcessor`"""
+
+    __slots__ = ['reference', 'infile', 'outfile', 'rst_file', 'script',
+                 'thumb_file', 'description', 'code_example', 'pictures',
+                 'seconds', 'thumbnail_template', 'code_template', 'files',
+                 'placeholder', 'dependencies', 'kernel']
+
+    def __init__(self, reference, infile, outfile, rst_file, script=None,
+                 thumb_file=NOIMAGE, description='', code_example=None,
+                 pictures=[], seconds=None, templates=None, files=None,
+                 placeholder=False, dependencies={}, kernel=None):
+        """
+        Parameters
+        ----------
+        reference: str
+            The rst label of the notebook
+        infile: str
+            The path to the source notebook
+        outfile: str
+            The path to the processed notebook
+        rst_file: str
+            The path to the rst file of the notebook
+        script: str
+            The path to the script created from the notebook
+        thumb_file: str
+            The path to the thumbnail image
+        description: str
+            The description that is used as tooltip in the gallery
+        code_example: str
+            The code example that is used instead of the thumbnail
+        pictures: list of str
+            The paths of the pictures that have been created
+        seconds: float
+            The seconds needed to execute the notebook
+        templates: object
+            An object with ``THUMBNAIL_TEMPLATE`` and ``CODE_TEMPLATE``
+            attribute (by default, the :class:`NotebookProcessor`)
+        files: list of str
+            All files that have been created for the notebook. If None, the
+            `outfile`, `rst_file`, `script`, `pictures` and `thumb_file` are
+            used
+        placeholder: bool
+            True if the files have not been created from the current version
+            of the notebook (see :meth:`Gallery.get_placeholder_entry`)
+        dependencies: dict
+            The files that have been read while the notebook was executed
+            (see :attr:`NotebookProcessor.dependencies`)
+        kernel: str
+            The name of the kernelspec in the metadata of the notebook"""
+        if templates is None:
+            templates = NotebookProcessor
+        self.reference = reference
+        self.infile = infile
+        self.outfile = outfile
+        self.rst_file = rst_file
+        self.script = script
+        self.thumb_file = thumb_file
+        self.description = description
+        self.code_example = code_example
+        self.pictures = pictures
+        self.seconds = seconds
+        self.thumbnail_template = templates.THUMBNAIL_TEMPLATE
+        self.code_template = templates.CODE_TEMPLATE
+        if files is None:
+            files = [outfile, rst_file] + ([script] if script else []) + \
+                list(pictures) + ([thumb_file] if thumb_file != NOIMAGE
+                                  else [])
+        self.files = files
+        self.placeholder = placeholder
+        self.dependencies = dependencies
+        self.kernel = kernel
+
+    @property
+    def thumbnail_div(self):
+        """The string for creating the thumbnail of this example"""
+        return self.thumbnail_template.format(
+            snippet=self.description, thumbnail=self.thumb_file,
+            ref_name=self.reference)
+
+    @property
+    def code_div(self):
+        """The string for creating a code example for the gallery"""
+        if self.code_example is None:
+            return None
+        return self.code_template.format(
+            snippet=self.description, code=self.code_example,
+            ref_name=self.reference)
+
+    def get_out_file(self, ending='rst'):
+        """get the output file with the specified `ending`"""
+        return os.path.splitext(self.outfile)[0] + os.path.extsep + ending
+
+
 class Gallery(object):
     """Class to create one or more example gallerys"""
 
@@ -694,7 +2864,18 @@ class Gallery(object):
                  urls=None, insert_bokeh=False, insert_bokeh_widgets=False,
                  remove_all_outputs_tags=set(), remove_cell_tags=set(),
                  remove_input_tags=set(), remove_single_output_tags=set(),
-                 toctree_depth=-1, binder_url=None):
+                 toctree_depth=-1, binder_url=None, kernel_lookahead=0,
+                 background=False, validate_notebooks=True,
+                 max_output_size=None, max_notebook_output_size=None,
+                 external_html_size=None, bokeh_assets='global',
+                 bokeh_static_dir=None, optimize_images=False,
+                 figure_settings=None, readme_converter=None,
+                 ignore_patterns=['.*', '_build', '__pycache__'],
+                 remove_orphans=True, remote_thumbnails=False,
+                 builder_policies={}, include=None, exclude=None,
+                 incremental=False, scratch_dir=False, output_files={},
+                 track_dependencies=False, normalize_outputs=False,
+                 snapshots=False, cache_dir=None):
         """
         Parameters
         ----------
@@ -776,6 +2957,160 @@ class Gallery(object):
             For automatic depth, set to -1. Default: -1
         binder_url: str
             Link to the notebook on mybinder.org or equivalent
+        kernel_lookahead: int
+            The number of queued notebooks whose kernels shall already be
+            started while the current notebook is executed (see the
+            :class:`KernelPrewarmer`). The kernel is chosen from the
+            ``kernelspec`` in the notebook metadata. If 0 (the default), each
+            kernel is started when the notebook is processed
+        background: bool
+            If True and the gallery is created within a sphinx build (see
+            :meth:`from_sphinx`), the notebooks are processed in a background
+            thread while sphinx reads the documents that do not belong to the
+            gallery. The build only waits for the gallery when the first
+            gallery document is read (see :meth:`start_background`). Parallel
+            builds wait for the gallery before reading any document
+        validate_notebooks: bool or {'once'}
+            Whether the notebooks shall be validated against the nbformat
+            schema when they are read and written. If ``'once'``, a notebook
+            is only validated when it is read for the first time since it
+            changed and the processed notebook is not validated. Note that
+            the notebooks are read and written with the :mod:`orjson` library
+            if it is installed
+        max_output_size: int
+            The maximum number of characters of one text output (e.g. the
+            printed output of one cell) when a notebook is executed. Larger
+            outputs are truncated (see :class:`OutputLimiter`). If None, the
+            outputs are not limited
+        max_notebook_output_size: int
+            The maximum number of characters of all text outputs of one
+            notebook when it is executed. If None, the outputs are not limited
+        external_html_size: int
+            The number of characters above which a html output (e.g. from
+            bokeh or plotly) is moved into a separate file that is loaded in
+            an iframe when it is scrolled into view. If None, all outputs are
+            inserted into the page
+        bokeh_assets: {'global', 'page'}
+            How the bokeh files of `insert_bokeh` and `insert_bokeh_widgets`
+            are added to the documentation. If ``'global'``, they are added
+            to every page of the documentation and additionally inserted into
+            the rst files that mention bokeh. If ``'page'``, they are only
+            added once to the pages of the notebooks with a bokeh output
+            (see :func:`insert_bokeh_assets`)
+        bokeh_static_dir: str
+            A directory (relative to the configuration directory) with local
+            copies of the bokeh files that shall be used instead of the CDN.
+            The files must have the same names as on the CDN, e.g.
+            ``'bokeh-2.3.0.min.js'``
+        optimize_images: bool or dict
+            If True or a dictionary, the PNG images of the notebooks are
+            downsampled and losslessly recompressed in a worker pool (see
+            :func:`optimize_image`). A dictionary may contain the
+            ``'max_size'`` (an int or a tuple with the maximum width and
+            height of the images), the ``'format'`` (``'png'`` or
+            ``'webp'``), the ``'cache_dir'`` (by default the ``'images'``
+            directory in the `cache_dir` of the gallery) and the number of
+            worker threads ``'processes'``. Single notebooks can disable it
+            via the ``'optimize_images'`` key in their metadata
+        figure_settings: dict
+            Settings for the figures that are applied in a hidden cell before
+            the notebooks are executed, e.g. ``{'formats': ['png'], 'dpi':
+            72, 'mimetypes': ['text/plain', 'text/html', 'image/png']}`` (see
+            :meth:`NotebookProcessor.get_figure_settings_code`). Single
+            notebooks can change them via the ``'figure_settings'`` key in
+            their metadata
+        readme_converter: {None, 'mistune', 'pandoc'}
+            The converter for the ``README.md`` files (see
+            :func:`markdown2rst`). If None, mistune is used if it is
+            installed in version 3.0 or later and pandoc otherwise. The
+            converted files are cached in the ``'readme'`` directory in the
+            `cache_dir`
+        ignore_patterns: list of str
+            Patterns for the names of files and directories in the
+            `examples_dirs` that shall be ignored (e.g. the
+            ``.ipynb_checkpoints`` directories). See :attr:`index`
+        remove_orphans: bool
+            If True, the files of the last build that are not created
+            anymore (e.g. because a notebook has been renamed or removed) are
+            deleted from the gallery directories. The files are taken from the
+            manifest of the last build (see :meth:`write_manifest`)
+        remote_thumbnails: bool or dict
+            If True or a dictionary, the thumbnails of the galleries in other
+            projects that are inserted by the :rst:dir:`linkgalleries`
+            directive are downloaded into a persistent cache and copied into
+            the build instead of being linked (see :class:`ThumbnailCache`).
+            A dictionary may contain the ``'cache_dir'`` (by default
+            ``~/.cache/sphinx-nbexamples/thumbnails``), the ``'max_size'`` of
+            the cache in bytes, the ``'timeout'`` of the requests and the
+            number of concurrent downloads (``'processes'``)
+        builder_policies: dict
+            A mapping from the name of a sphinx builder to the policy that
+            controls which parts of the gallery are created for this builder.
+            The policies update the defaults of :meth:`get_builder_policy`,
+            e.g. ``{'latex': {'execute': 'cached'}}``
+        include: list of str
+            Glob patterns for the notebooks that shall be processed. The
+            patterns are matched against the path of the notebook relative to
+            its examples directory and against its file name. If None, all
+            notebooks are processed. The patterns can also be set via the
+            comma-separated ``SPHINX_NBEXAMPLES_INCLUDE`` environment variable
+        exclude: list of str
+            Glob patterns for the notebooks that shall not be processed (see
+            `include`). They can also be set via the
+            ``SPHINX_NBEXAMPLES_EXCLUDE`` environment variable. Notebooks that
+            are not processed get a placeholder page (see
+            :meth:`get_placeholder_entry`)
+        incremental: bool
+            If True, only the notebooks that changed since the last build are
+            processed. The files of the other notebooks are taken from the
+            manifest of the last build (see :meth:`get_cached_entry`). Note
+            that changes of the configuration are not detected. This is
+            useful when the documentation is rebuilt on every change, e.g.
+            with sphinx-autobuild or :meth:`watch`
+        scratch_dir: bool or str
+            If True or a directory, each notebook is executed in its own
+            temporary directory within this directory instead of the
+            directory of the notebook (see
+            :meth:`NotebookProcessor.create_scratch_dir`). If True,
+            ``/dev/shm`` is used if it is available. Only the supplementary
+            files of the notebook are available in this directory
+        output_files: dict
+            A mapping from filename to a list of glob patterns of files that
+            are created by the notebook and shall be copied to the gallery
+            directory. Note that you can also include an ``'output_files'``
+            key in the metadata of the notebook
+        track_dependencies: bool
+            If True, the files that the notebooks read while they are
+            executed (e.g. data files or local modules) are recorded in the
+            manifest. A notebook is then also considered as changed (see
+            :meth:`get_changes` and the `incremental` mode) if one of these
+            files changed. This requires python 3.8 or later in the kernel
+        normalize_outputs: bool or list of tuple
+            If True or a list, the volatile data (execution counts and
+            timestamps, memory addresses, widget ids and the metadata of PNG
+            images) is removed from the notebooks after they have been
+            executed, such that the created files only change if the outputs
+            change (see :meth:`NotebookProcessor.normalize_notebook`). A list
+            may contain additional tuples of a regular expression and its
+            replacement for the text outputs, e.g.
+            ``[(r'\\d{4}-\\d\\d-\\d\\d', 'YYYY-MM-DD')]``
+        snapshots: bool or dict
+            If True or a dictionary, the namespace of the kernel is saved after
+            each code cell of a python notebook and the next build only
+            executes the cells starting from the first modified one (see
+            :meth:`NotebookProcessor.execute_with_snapshots`). A dictionary
+            may contain the ``'cache_dir'`` (by default the ``'snapshots'``
+            directory in the `cache_dir` of the gallery) and the
+            ``'max_size'`` of the cache in bytes (see :class:`SnapshotCache`).
+            Single notebooks can disable it via the ``'snapshots'`` key in
+            their metadata. It has no effect if a `scratch_dir` is used
+        cache_dir: str
+            The directory for the caches of the gallery (the converted
+            README files, the optimized images and the snapshots). It should
+            not be part of the sphinx source directory. If None, the
+            ``'nbexamples'`` directory in the doctree directory is used if the
+            gallery is created by :meth:`from_sphinx` and
+            ``~/.cache/sphinx-nbexamples`` otherwise
 
         References
         ----------
@@ -805,15 +3140,70 @@ class Gallery(object):
             pattern = re.compile(pattern)
         self.pattern = pattern
         self.disable_warnings = disable_warnings
-        self.dont_preprocess = dont_preprocess
-        self.preprocess = preprocess
-        self.clear = clear
-        self.dont_clear = dont_clear
+        self.dont_preprocess = _file_set(dont_preprocess)
+        self.preprocess = _file_set(preprocess)
+        self.clear = _file_set(clear)
+        self.dont_clear = _file_set(dont_clear)
+        self.ignore_patterns = ignore_patterns
+        self.remove_orphans = remove_orphans
+        self.remote_thumbnails = remote_thumbnails
+        self.builder_policies = builder_policies
+        if os.getenv(self.INCLUDE_ENV):
+            include = os.environ[self.INCLUDE_ENV].split(',')
+        if os.getenv(self.EXCLUDE_ENV):
+            exclude = os.environ[self.EXCLUDE_ENV].split(',')
+        if isstring(include):
+            include = [include]
+        if isstring(exclude):
+            exclude = [exclude]
+        self.include = include
+        self.exclude = exclude or []
+        self.incremental = incremental
+        self.output_files = output_files
+        if cache_dir is None:
+            cache_dir = _user_cache_dir()
+        self.cache_dir = cache_dir
+        if snapshots:
+            snapshots = dict({} if snapshots is True else snapshots)
+            snapshots = SnapshotCache(snapshots.pop('cache_dir', os.path.join(
+                cache_dir, 'snapshots')), **snapshots)
+            if scratch_dir:
+                logger.warning(
+                    'The snapshots are not used for notebooks that are '
+                    'executed in a scratch directory.')
+        else:
+            snapshots = None
+        if normalize_outputs:
+            normalize_outputs = NotebookProcessor.NORMALIZE_RULES + (
+                [] if normalize_outputs is True else list(normalize_outputs))
+        else:
+            normalize_outputs = None
+        if scratch_dir is True:
+            import tempfile
+            scratch_dir = (
+                '/dev/shm' if os.access('/dev/shm', os.W_OK) else
+                tempfile.gettempdir())
         self.code_examples = code_examples
         self.supplementary_files = supplementary_files
         self.osf = other_supplementary_files
         self.thumbnail_figures = thumbnail_figures
         self.toctree_depth = toctree_depth
+        self.kernel_lookahead = kernel_lookahead
+        self.background = background
+        self.bokeh_assets = bokeh_assets
+        self.bokeh_static_dir = bokeh_static_dir
+        self.readme_converter = readme_converter
+        if optimize_images:
+            optimize_images = dict(
+                {} if optimize_images is True else optimize_images)
+            self._image_processes = optimize_images.pop('processes', None)
+            max_size = optimize_images.get('max_size')
+            if isinstance(max_size, six.integer_types):
+                optimize_images['max_size'] = (max_size, max_size)
+            optimize_images.setdefault(
+                'cache_dir', os.path.join(cache_dir, 'images'))
+        else:
+            optimize_images = None
         if urls is None or isstring(urls) or isinstance(urls, dict):
             urls = [urls] * len(self.in_dir)
         if binder_url is None or isstring(binder_url) or isinstance(
@@ -822,11 +3212,9 @@ class Gallery(object):
         self._all_urls = urls
         self._all_binder_urls = binder_url
         if insert_bokeh and not isstring(insert_bokeh):
-            import bokeh
-            insert_bokeh = bokeh.__version__
+            insert_bokeh = get_bokeh_version()
         if insert_bokeh_widgets and not isstring(insert_bokeh_widgets):
-            import bokeh
-            insert_bokeh_widgets = bokeh.__version__
+            insert_bokeh_widgets = get_bokeh_version()
         tag_options = {
             'remove_all_outputs_tags': remove_all_outputs_tags,
             'remove_cell_tags': remove_cell_tags,
@@ -835,17 +3223,698 @@ class Gallery(object):
         self._nbp_kws = {'insert_bokeh': insert_bokeh,
                          'insert_bokeh_widgets': insert_bokeh_widgets,
                          'tag_options': tag_options,
+                         'validate': validate_notebooks,
+                         'max_output_size': max_output_size,
+                         'max_notebook_output_size': max_notebook_output_size,
+                         'external_html_size': external_html_size,
+                         'bokeh_per_page': bokeh_assets == 'page',
+                         'optimize_images': optimize_images,
+                         'figure_settings': figure_settings,
+                         'scratch_dir': scratch_dir or None,
+                         'track_dependencies': track_dependencies,
+                         'normalize_outputs': normalize_outputs,
+                         'snapshots': snapshots,
                          }
 
+    #: The environment variable with the `include` patterns
+    INCLUDE_ENV = 'SPHINX_NBEXAMPLES_INCLUDE'
+
+    #: The environment variable with the `exclude` patterns
+    EXCLUDE_ENV = 'SPHINX_NBEXAMPLES_EXCLUDE'
+
+    #: The rst file for the notebooks that are not processed and have not
+    #: been processed before (see :meth:`get_placeholder_entry`)
+    PLACEHOLDER_TEMPLATE = """.. _{reference}:
+
+{title}
+{underline}
+
+.. note::
+
+    This example has not been processed in this build of the documentation.
+"""
+
+    #: The policy of the current builder (see :meth:`get_builder_policy`)
+    policy = {'execute': True, 'thumbnails': True, 'html_assets': True}
+
+    #: The policies of the builders that differ from the defaults of their
+    #: format (see :meth:`get_builder_policy`)
+    BUILDER_POLICIES = {
+        'linkcheck': {'execute': 'cached'},
+        'spelling': {'execute': 'cached'},
+        'gettext': {'execute': 'cached'},
+        'dummy': {'execute': 'cached'},
+        'changes': {'execute': 'cached'},
+        }
+
+    #: The :class:`KernelPrewarmer` that is used during
+    #: :meth:`process_directories`
+    _prewarmer = None
+
+    #: The manifest of the last build of the gallery directory that is
+    #: currently processed (see :meth:`get_cached_entry`)
+    _manifest = None
+
+    _index = None
+
+    @property
+    def index(self):
+        """The directories and files in the :attr:`in_dir` directories
+
+        An ordered mapping from the path of each directory to the names of
+        its subdirectories and files. It is created on the first access
+        (see :func:`walk_directory`) and reused afterwards, e.g. by
+        :meth:`iter_directories` and :meth:`recursive_processing`"""
+        if self._index is None:
+            index = OrderedDict()
+            for base_dir in self.in_dir:
+                for file_dir, dirs, files in walk_directory(
+                        base_dir, self.ignore_patterns):
+                    index[file_dir] = (dirs, files)
+            self._index = index
+        return self._index
+
+    #: The worker pool that optimizes the images during
+    #: :meth:`process_directories`
+    _image_pool = None
+
+    #: The number of threads in the :attr:`_image_pool`
+    _image_processes = None
+
+    #: The thread that processes the notebooks if :attr:`background` is True
+    _thread = None
+
+    #: The exception that has been raised in the :attr:`_thread`
+    _thread_error = None
+
+    #: The event that stops the :attr:`_thread` before the next notebook
+    _stop = None
+
+    #: The rst files that the :attr:`_thread` rewrites
+    _outdated_rst_files = set()
+
+    def iter_directories(self):
+        """Iterate over the gallery directories in the order they are processed
+
+        Yields
+        ------
+        str
+            The path to the input directory
+        str
+            The path to the output directory
+        list of str
+            The paths to the notebooks in the input directory"""
+        for base_dir, target_dir in zip(self.in_dir, self.out_dir):
+            for t in self._iter_gallery_directories(base_dir, target_dir):
+                yield t
+
+    def _iter_gallery_directories(self, base_dir, target_dir):
+        """Iterate over the directories of one gallery
+
+        See Also
+        --------
+        iter_directories"""
+        readme_files = {'README.md', 'README.rst', 'README.txt'}
+        stack = [base_dir]
+        while stack:
+            file_dir = stack.pop()
+            dirs, files = self.index[file_dir]
+            if not readme_files.intersection(files):
+                continue
+            yield (file_dir, file_dir.replace(base_dir, target_dir),
+                   [os.path.join(file_dir, f)
+                    for f in filter(self.pattern.match, files)])
+            stack.extend(os.path.join(file_dir, d) for d in dirs[::-1])
+
+    def iter_notebooks(self):
+        """Iterate over the notebooks in the order they are processed
+
+        Yields
+        ------
+        str
+            The path to the notebook file"""
+        for file_dir, foutdir, nbfiles in self.iter_directories():
+            for f in nbfiles:
+                yield f
+
+    def iter_rst_files(self):
+        """Iterate over the rst files that are created by this gallery
+
+        Yields
+        ------
+        str
+            The path to the rst file"""
+        for file_dir, foutdir, nbfiles in self.iter_directories():
+            yield os.path.join(foutdir, 'index.rst')
+            for f in nbfiles:
+                yield os.path.join(foutdir, os.path.splitext(
+                    os.path.basename(f))[0] + '.rst')
+
+    @classmethod
+    def get_builder_policy(cls, name, format='html', builder_policies={}):
+        """Get the policy for a sphinx builder
+
+        The policy is a dictionary with the following keys:
+
+        execute: bool or {'cached'}
+            Whether the notebooks are executed (see :meth:`is_preprocessed`).
+            If ``'cached'``, the files of the last build are reused for the
+            notebooks that did not change (see :meth:`get_cached_entry`) and
+            the other notebooks are converted without being executed
+        thumbnails: bool
+            Whether the thumbnails for the gallery are created
+        html_assets: bool
+            Whether the bokeh files are added and large html outputs are
+            moved into separate files
+
+        By default, everything is created for the builders with the html
+        format. The other builders do not create the thumbnails and html
+        assets and the builders that only need the text of the documents
+        (e.g. ``'linkcheck'`` and ``'spelling'``, see
+        :attr:`BUILDER_POLICIES`) do not execute the notebooks.
+
+        Parameters
+        ----------
+        name: str
+            The name of the builder
+        format: str
+            The format of the builder
+        builder_policies: dict
+            A mapping from builder name to a dictionary that updates the
+            default policy (see the `builder_policies` parameter of the
+            :class:`Gallery`)
+
+        Returns
+        -------
+        dict
+            The policy for the builder"""
+        policy = dict(cls.policy)
+        if format != 'html':
+            policy.update(thumbnails=False, html_assets=False)
+        policy.update(cls.BUILDER_POLICIES.get(name, {}))
+        policy.update(builder_policies.get(name, {}))
+        return policy
+
+    def set_builder_policy(self, policy):
+        """Set the :attr:`policy` for the builder
+
+        Parameters
+        ----------
+        policy: dict
+            The policy (see :meth:`get_builder_policy`)"""
+        self.policy = policy
+        if not policy['html_assets']:
+            self._nbp_kws.update(
+                insert_bokeh=False, insert_bokeh_widgets=False,
+                external_html_size=None, bokeh_per_page=False)
+
+    def is_selected(self, f):
+        """Check whether the given notebook file matches the `include` and
+        `exclude` patterns of this gallery"""
+        if self.include is None and not self.exclude:
+            return True
+        rel = f
+        for base_dir in self.in_dir:
+            if f.startswith(base_dir):
+                rel = f[len(base_dir):]
+                break
+        names = [rel.replace(os.path.sep, '/'), os.path.basename(f)]
+
+        def match(patterns):
+            return any(fnmatch(name, pattern) for pattern in patterns
+                       for name in names)
+
+        return ((self.include is None or match(self.include)) and
+                not match(self.exclude))
+
+    def is_preprocessed(self, f):
+        """Check whether the given notebook file shall be preprocessed"""
+        return (self.policy['execute'] is True and self.is_selected(f) and
+                (self.preprocess is True or f in self.preprocess) and
+                not (self.dont_preprocess is True or
+                     f in self.dont_preprocess))
+
+    def is_cleared(self, f):
+        """Check whether the output of the given notebook file shall be
+        cleared in the download notebook"""
+        return ((self.clear is True or f in self.clear) and
+                not (self.dont_clear is True or f in self.dont_clear))
+
+    def get_kernel_manager(self, f):
+        """Get the pre-started kernel for the given notebook file or None"""
+        if self._prewarmer is None or not self.is_preprocessed(f):
+            return None
+        return self._prewarmer.get_kernel_manager(f)
+
+    def get_scratch_path(self, f):
+        """Get the scratch directory that the pre-started kernel of the given
+        notebook runs in or None (see :attr:`KernelPrewarmer.scratch_paths`)"""
+        if self._prewarmer is None:
+            return None
+        return self._prewarmer.scratch_paths.pop(f, None)
+
     def process_directories(self):
         """Create the rst files from the input directories in the
         :attr:`in_dir` attribute"""
-        for i, (base_dir, target_dir, paths) in enumerate(zip(
-                self.in_dir, self.out_dir, map(os.walk, self.in_dir))):
-            self._in_dir_count = i
-            self.recursive_processing(base_dir, target_dir, paths)
+        if self.kernel_lookahead > 0:
+            # only start the kernels of the notebooks that are executed
+            nbfiles = [f for f in self.get_outdated_notebooks()
+                       if self.is_selected(f) and self.is_preprocessed(f)]
+            self._prewarmer = KernelPrewarmer(
+                nbfiles, self.kernel_lookahead, self._nbp_kws['scratch_dir'])
+        if self._nbp_kws['optimize_images'] is not None:
+            from multiprocessing.pool import ThreadPool
+            self._image_pool = ThreadPool(self._image_processes)
+        try:
+            for i, (base_dir, target_dir) in enumerate(zip(
+                    self.in_dir, self.out_dir)):
+                self._in_dir_count = i
+                self._manifest = old = self.read_manifest(target_dir)
+                label, entries = self.recursive_processing(
+                    base_dir, target_dir)
+                self.keep_policy_files(old, entries)
+                index_files = [
+                    os.path.join(foutdir, 'index.rst') for file_dir, foutdir, _
+                    in self._iter_gallery_directories(base_dir, target_dir)]
+                if label:
+                    self.write_manifest(
+                        target_dir, label, entries, index_files,
+                        self.incremental or
+                        self._nbp_kws['track_dependencies'])
+                if self.remove_orphans:
+                    self.remove_orphaned_files(
+                        target_dir, old, entries, index_files)
+        finally:
+            self._manifest = None
+            if self._prewarmer is not None:
+                self._prewarmer.shutdown()
+                self._prewarmer = None
+            if self._image_pool is not None:
+                self._image_pool.close()
+                self._image_pool.join()
+                self._image_pool = None
+
+    #: The name of the manifest file in the gallery directories (see
+    #: :meth:`write_manifest`)
+    MANIFEST_FILE = '.nbexamples_manifest.json'
+
+    #: The name of the file in the html build directory that lists the
+    #: externalized html outputs that have been copied by
+    #: :func:`copy_external_outputs`
+    EXTERNAL_MANIFEST_FILE = '.nbexamples_external.json'
+
+    #: The keys of the paths in the entries of the manifest
+    _manifest_paths = ['infile', 'outfile', 'rst_file', 'script', 'thumb_file']
+
+    @classmethod
+    def write_manifest(cls, target_dir, label, entries, index_files,
+                       fingerprint=False):
+        """Write the manifest of a gallery directory
+
+        The manifest is a JSON file (see :attr:`MANIFEST_FILE`) in the
+        `target_dir` that records the label of the gallery and, for each
+        notebook, the attributes of its :class:`GalleryEntry`, the files that
+        have been created and the size, modification time and sha1 hash of
+        the source notebook, the files that the notebook read while it was
+        executed, the kernel and, if `fingerprint` is True, the
+        :func:`environment_fingerprint` of the kernel. Relative paths are
+        stored relative to `target_dir`.
+
+        Parameters
+        ----------
+        target_dir: str
+            The gallery directory
+        label: str
+            The label of the gallery index
+        entries: list of GalleryEntry
+            The processed notebooks of the gallery
+        index_files: list of str
+            The index files of the gallery directories
+        fingerprint: bool
+            If True, store the fingerprint of the environment, such that
+            the notebooks are considered as changed when the environment
+            of their kernel changes (see :meth:`get_changes`)"""
+        import json
+
+        def relpath(path):
+            if os.path.isabs(path):
+                return path
+            return os.path.relpath(path, target_dir)
+
+        records = []
+        for entry in entries:
+            stat = os.stat(entry.infile)
+            record = {
+                'reference': entry.reference,
+                'description': entry.description,
+                'code_example': entry.code_example,
+                'seconds': entry.seconds,
+                'placeholder': entry.placeholder,
+                'dependencies': entry.dependencies,
+                'kernel': entry.kernel,
+                'pictures': list(map(relpath, entry.pictures)),
+                'files': list(map(relpath, entry.files)),
+                'source_size': stat.st_size,
+                'source_mtime': stat.st_mtime,
+                'source_hash': _file_hash(entry.infile)}
+            for key in cls._manifest_paths:
+                path = getattr(entry, key)
+                record[key] = None if path is None else relpath(path)
+            if fingerprint:
+                record['environment'] = environment_fingerprint(entry.kernel)
+            records.append(record)
+        manifest = {'version': 1, 'label': label, 'entries': records,
+                    'index_files': list(map(relpath, index_files))}
+        _write_if_changed(os.path.join(target_dir, cls.MANIFEST_FILE),
+                          json.dumps(manifest, indent=1))
+
+    @classmethod
+    def read_manifest(cls, target_dir):
+        """Read the manifest of a gallery directory
+
+        Parameters
+        ----------
+        target_dir: str
+            The gallery directory
+
+        Returns
+        -------
+        dict
+            The manifest (see :meth:`write_manifest`). The ``'entries'`` are
+            an ordered mapping from the normalized path of the notebook to its
+            record. The paths in the manifest are relative to the current
+            working directory. If there is no manifest (or it cannot be
+            read), the ``'label'`` is an empty string and the ``'entries'``
+            and ``'index_files'`` are empty"""
+        import json
+        fname = os.path.join(target_dir, cls.MANIFEST_FILE)
+        empty = {'version': 1, 'label': '', 'entries': OrderedDict(),
+                 'index_files': []}
+        if not os.path.exists(fname):
+            return empty
+
+        def path(p):
+            return os.path.normpath(os.path.join(target_dir, p))
+
+        try:
+            with io.open(fname, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except ValueError:
+            logger.warning('Ignoring the corrupt manifest %s', fname)
+            return empty
+        entries = OrderedDict()
+        for record in manifest['entries']:
+            for key in cls._manifest_paths:
+                if record[key] is not None:
+                    record[key] = path(record[key])
+            record['pictures'] = list(map(path, record['pictures']))
+            record['files'] = list(map(path, record['files']))
+            entries[record['infile']] = record
+        manifest['entries'] = entries
+        manifest['index_files'] = list(map(path, manifest['index_files']))
+        return manifest
+
+    def get_changes(self):
+        """Compare the notebooks with the manifests of the last build
+
+        This method only needs the :attr:`index` of the examples directories
+        and the manifests (see :meth:`read_manifest`). The hash of a notebook
+        is only computed if its size or modification time changed.
+
+        Returns
+        -------
+        dict
+            A mapping with the ``'added'``, ``'changed'`` and ``'removed'``
+            notebooks"""
+        changes = {'added': [], 'changed': [], 'removed': []}
+        for base_dir, target_dir in zip(self.in_dir, self.out_dir):
+            old = self.read_manifest(target_dir)['entries']
+            seen = set()
+            for file_dir, foutdir, nbfiles in self._iter_gallery_directories(
+                    base_dir, target_dir):
+                for f in nbfiles:
+                    key = os.path.normpath(f)
+                    seen.add(key)
+                    record = old.get(key)
+                    if record is None:
+                        changes['added'].append(f)
+                        continue
+                    if not self._is_unchanged(f, record):
+                        changes['changed'].append(f)
+            changes['removed'].extend(f for f in old if f not in seen)
+        return changes
+
+    @staticmethod
+    def _is_unchanged(f, record):
+        """Check whether the notebook `f` matches its `record` in the manifest
+
+        The notebook is considered as changed if the notebook itself, one of
+        its recorded dependencies or the recorded
+        :func:`environment_fingerprint` of its kernel changed. The hash of a
+        file is only computed if its size or modification time changed"""
+        stat = os.stat(f)
+        if ((stat.st_size, stat.st_mtime) != (
+                record['source_size'], record['source_mtime']) and
+                _file_hash(f) != record['source_hash']):
+            return False
+        if 'environment' in record and record['environment'] != \
+                environment_fingerprint(record.get('kernel')):
+            return False
+        return _files_unchanged(record.get('dependencies', {}))
+
+    def get_cached_entry(self, f, check_changes=True):
+        """Get the entry of a notebook from the manifest of the last build
+
+        Parameters
+        ----------
+        f: str
+            The path to the notebook
+        check_changes: bool
+            If True, the entry is only returned if the files of the last build
+            have been created from the current version of the notebook
+
+        Returns
+        -------
+        GalleryEntry or None
+            The entry of the notebook if all its files still exist (and the
+            notebook did not change since the last build if `check_changes` is
+            True). Otherwise None"""
+        if self._manifest is None:
+            return None
+        record = self._manifest['entries'].get(os.path.normpath(f))
+        if record is None or not all(map(os.path.exists, record['files'])):
+            return None
+        outdated = (record.get('placeholder', False) or
+                    not self._is_unchanged(f, record))
+        if outdated and check_changes:
+            return None
+        return GalleryEntry(
+            reference=record['reference'], infile=f,
+            outfile=record['outfile'], rst_file=record['rst_file'],
+            script=record['script'], thumb_file=record['thumb_file'],
+            description=record['description'],
+            code_example=record['code_example'],
+            pictures=record['pictures'], seconds=record['seconds'],
+            files=record['files'], placeholder=outdated,
+            dependencies=record.get('dependencies', {}),
+            kernel=record.get('kernel'))
+
+    def get_reusable_entry(self, f):
+        """Get the entry of the last build if a notebook is not converted again
+
+        The files of the last build are reused for notebooks that are not
+        selected (see :meth:`get_placeholder_entry`) and, in `incremental`
+        mode or with the ``'cached'`` builder policy, for the unchanged
+        notebooks (see :meth:`get_cached_entry`). In `incremental` mode,
+        notebooks that have only been converted in the last build are
+        executed again.
+
+        Parameters
+        ----------
+        f: str
+            The path to the notebook
+
+        Returns
+        -------
+        GalleryEntry or None
+            The entry of the last build or None if the notebook is
+            (re)converted"""
+        if not self.is_selected(f):
+            return self.get_cached_entry(f, check_changes=False)
+        if self.policy['execute'] == 'cached' or self.incremental:
+            entry = self.get_cached_entry(f)
+            if entry is not None and (
+                    self.policy['execute'] == 'cached' or
+                    entry.seconds is not None or not self.is_preprocessed(f)):
+                return entry
+        return None
+
+    def get_outdated_notebooks(self):
+        """Get the notebooks that :meth:`process_directories` converts
+
+        Returns
+        -------
+        list of str
+            The notebooks whose entry of the last build cannot be reused (see
+            :meth:`get_reusable_entry`), in the order they are processed"""
+        ret = []
+        for base_dir, target_dir in zip(self.in_dir, self.out_dir):
+            self._manifest = self.read_manifest(target_dir)
+            try:
+                for file_dir, foutdir, nbfiles in \
+                        self._iter_gallery_directories(base_dir, target_dir):
+                    ret.extend(f for f in nbfiles
+                               if self.get_reusable_entry(f) is None)
+            finally:
+                self._manifest = None
+        return ret
+
+    def get_placeholder_entry(self, f, foutdir):
+        """Get the entry for a notebook that is not processed
+
+        The files of the last build are reused if they still exist (see
+        :meth:`get_cached_entry`). Otherwise, a rst file with the label and
+        the title of the notebook is created from the
+        :attr:`PLACEHOLDER_TEMPLATE`, such that the references to the
+        notebook and the toctree of the gallery stay valid.
+
+        Parameters
+        ----------
+        f: str
+            The path to the notebook
+        foutdir: str
+            The output directory for the notebook
+
+        Returns
+        -------
+        GalleryEntry
+            The record of the placeholder"""
+        entry = self.get_cached_entry(f, check_changes=False)
+        if entry is not None:
+            logger.info('Reusing the files of the last build for %s', f)
+            return entry
+        outfile = os.path.join(foutdir, os.path.basename(f))
+        entry = GalleryEntry(
+            reference='gallery_' + outfile.replace(os.path.sep, '_').lower(),
+            infile=f, outfile=outfile,
+            rst_file=os.path.splitext(outfile)[0] + '.rst', placeholder=True)
+        nb = scan_notebook(f)
+        title, entry.description = notebook_description(nb)
+        entry.kernel = nb.metadata.get('kernelspec', {}).get('name') or None
+        title = title or os.path.splitext(os.path.basename(f))[0]
+        entry.files = [entry.rst_file]
+        logger.info('Creating a placeholder for %s', f)
+        with io.open(entry.rst_file, 'w', encoding='utf-8') as fh:
+            fh.write(six.text_type(self.PLACEHOLDER_TEMPLATE.format(
+                reference=entry.reference, title=title,
+                underline='=' * len(title))))
+        return entry
+
+    def process_notebook(self, f, base_dir, foutdir):
+        """Process one notebook of the gallery
+
+        Parameters
+        ----------
+        f: str
+            The path to the notebook
+        base_dir: str
+            Path to the base example directory of the notebook
+        foutdir: str
+            The output directory for the notebook
+
+        Returns
+        -------
+        GalleryEntry
+            The record of the processed notebook. It is taken from the last
+            build if possible (see :meth:`get_cached_entry`) or a placeholder
+            if the notebook is not selected (see :meth:`is_selected`)"""
+        if self._stop is not None and self._stop.is_set():
+            raise RuntimeError('The processing of the gallery was stopped')
+        if not self.is_selected(f):
+            return self.get_placeholder_entry(f, foutdir)
+        entry = self.get_reusable_entry(f)
+        if entry is not None:
+            logger.info('Reusing the files of the last build for %s', f)
+            return entry
+        return NotebookProcessor(
+            infile=f,
+            outfile=os.path.join(foutdir, os.path.basename(f)),
+            disable_warnings=self.disable_warnings,
+            preprocess=self.is_preprocessed(f),
+            clear=self.is_cleared(f),
+            code_example=self.code_examples.get(f),
+            supplementary_files=self.supplementary_files.get(f),
+            other_supplementary_files=self.osf.get(f),
+            output_files=self.output_files.get(f),
+            thumbnail_figure=self.thumbnail_figures.get(f),
+            url=self.get_url(f.replace(base_dir, '')),
+            binder_url=self.get_binder_url(f.replace(base_dir, '')),
+            kernel_manager=self.get_kernel_manager(f),
+            scratch_path=self.get_scratch_path(f),
+            image_pool=self._image_pool,
+            create_thumbnail=self.policy['thumbnails'],
+            **self._nbp_kws).get_entry()
+
+    def keep_policy_files(self, old, entries):
+        """Keep the files of the last build that the :attr:`policy` skips
+
+        A build whose :attr:`policy` does not create thumbnails or html
+        assets (e.g. a latex build) keeps the thumbnails and externalized
+        html outputs of a previous html build. These files are added to the
+        `entries`, such that they are listed in the manifest and not removed
+        as orphaned files.
+
+        Parameters
+        ----------
+        old: dict
+            The manifest of the last build (see :meth:`read_manifest`)
+        entries: list of GalleryEntry
+            The processed notebooks of the gallery. Their ``files`` are
+            modified in place"""
+        if self.policy['thumbnails'] and self.policy['html_assets']:
+            return
+        for entry in entries:
+            record = old['entries'].get(os.path.normpath(entry.infile))
+            if record is None:
+                continue
+            files = []
+            if (not self.policy['thumbnails'] and
+                    record['thumb_file'] in record['files']):
+                files.append(record['thumb_file'])
+            if not self.policy['html_assets']:
+                files.extend(
+                    f for f in record['files']
+                    if os.path.basename(os.path.dirname(f)) == 'external')
+            current = set(map(os.path.normpath, entry.files))
+            entry.files.extend(f for f in files if f not in current and
+                               os.path.exists(f))
+
+    @staticmethod
+    def remove_orphaned_files(target_dir, old, entries, index_files):
+        """Remove the files of the last build that have not been recreated
 
-    def recursive_processing(self, base_dir, target_dir, it):
+        Parameters
+        ----------
+        target_dir: str
+            The gallery directory. Only files within this directory are
+            removed
+        old: dict
+            The manifest of the last build (see :meth:`read_manifest`)
+        entries: list of GalleryEntry
+            The processed notebooks of the gallery
+        index_files: list of str
+            The index files of the gallery directories"""
+        keep = set(map(os.path.normpath, chain(
+            index_files, *(entry.files for entry in entries))))
+        target_dir = os.path.abspath(target_dir) + os.path.sep
+        for f in chain(old['index_files'], *(
+                record['files'] for record in old['entries'].values())):
+            if (f not in keep and os.path.exists(f) and
+                    os.path.abspath(f).startswith(target_dir)):
+                logger.info('Removing orphaned file %s', f)
+                os.remove(f)
+
+    def recursive_processing(self, base_dir, target_dir, file_dir=None):
         """Method to recursivly process the notebooks in the `base_dir`
 
         Parameters
@@ -856,35 +3925,27 @@ class Gallery(object):
         target_dir: str
             Path to the output directory for the rst files (see the
             `gallery_dirs` parameter for the :class:`Gallery` class)
-        it: iterable
-            The iterator over the subdirectories and files in `base_dir`
-            generated by the :func:`os.walk` function"""
-        try:
-            file_dir, dirs, files = next(it)
-        except StopIteration:
-            return '', []
+        file_dir: str
+            The directory in `base_dir` to process. If None, the `base_dir`
+            itself is processed. The subdirectories and files are taken from
+            the :attr:`index`
+
+        Returns
+        -------
+        str
+            The label of the index file in the directory
+        list of GalleryEntry
+            The records of the processed notebooks in this directory and its
+            subdirectories"""
+        if file_dir is None:
+            file_dir = base_dir
+        dirs, files = self.index[file_dir]
         readme_files = {'README.md', 'README.rst', 'README.txt'}
         if readme_files.intersection(files):
             foutdir = file_dir.replace(base_dir, target_dir)
             create_dirs(foutdir)
             this_nbps = [
-                NotebookProcessor(
-                    infile=f,
-                    outfile=os.path.join(foutdir, os.path.basename(f)),
-                    disable_warnings=self.disable_warnings,
-                    preprocess=(
-                        (self.preprocess is True or f in self.preprocess) and
-                        not (self.dont_preprocess is True or
-                             f in self.dont_preprocess)),
-                    clear=((self.clear is True or f in self.clear) and not
-                           (self.dont_clear is True or f in self.dont_clear)),
-                    code_example=self.code_examples.get(f),
-                    supplementary_files=self.supplementary_files.get(f),
-                    other_supplementary_files=self.osf.get(f),
-                    thumbnail_figure=self.thumbnail_figures.get(f),
-                    url=self.get_url(f.replace(base_dir, '')),
-                    binder_url=self.get_binder_url(f.replace(base_dir, '')),
-                    **self._nbp_kws)
+                self.process_notebook(f, base_dir, foutdir)
                 for f in map(lambda f: os.path.join(file_dir, f),
                              filter(self.pattern.match, files))]
             readme_file = next(iter(readme_files.intersection(files)))
@@ -896,15 +3957,15 @@ class Gallery(object):
             this_label = this_label[:-1]
         for d in dirs:
             label, nbps = self.recursive_processing(
-                base_dir, target_dir, it)
+                base_dir, target_dir, os.path.join(file_dir, d))
             if label:
                 labels[label] = nbps
         s = ".. _%s:\n\n" % this_label
 
         if readme_file.endswith('.md'):
-            s += spr.check_output(
-                ['pandoc', os.path.join(file_dir, readme_file),
-                 '-t', 'rst']).decode('utf-8').rstrip() + '\n\n'
+            s += markdown2rst(
+                os.path.join(file_dir, readme_file), self.readme_converter,
+                os.path.join(self.cache_dir, 'readme')).rstrip() + '\n\n'
         else:
             with open(os.path.join(file_dir, readme_file)) as f:
                 s += f.read().rstrip() + '\n\n'
@@ -915,7 +3976,7 @@ class Gallery(object):
                 s += "\n    :maxdepth: %d" % self.toctree_depth
             s += "\n\n"
             s += ''.join('    %s\n' % os.path.splitext(os.path.basename(
-                nbp.get_out_file()))[0] for nbp in this_nbps)
+                nbp.rst_file))[0] for nbp in this_nbps)
             for d in dirs:
                 findex = os.path.join(d, 'index.rst')
                 if os.path.exists(os.path.join(foutdir, findex)):
@@ -943,8 +4004,7 @@ class Gallery(object):
 
         s += '\n'
 
-        with open(os.path.join(foutdir, 'index.rst'), 'w') as f:
-            f.write(s)
+        _write_if_changed(os.path.join(foutdir, 'index.rst'), s)
         return this_label, list(chain(this_nbps, *labels.values()))
 
     @classmethod
@@ -954,44 +4014,241 @@ class Gallery(object):
         app.config.html_static_path.append(os.path.join(
             os.path.dirname(__file__), '_static'))
         config = app.config.example_gallery_config
+        policy = cls.get_builder_policy(
+            app.builder.name, app.builder.format,
+            config.get('builder_policies', {}))
+
+        static_dir = config.get('bokeh_static_dir')
+        if static_dir is not None:
+            static_dir = os.path.join(str(app.confdir), static_dir)
+            app.config.html_static_path.append(static_dir)
+        if policy['html_assets']:
+            css_files, js_files = get_bokeh_assets(config, static_dir)
+        else:
+            css_files = js_files = []
+        # the files can only be added to a specific page since sphinx 3.5
+        if (config.get('bokeh_assets') == 'page' and
+                sphinx.version_info >= (3, 5)):
+            app.connect('html-page-context', partial(
+                insert_bokeh_assets, css_files=css_files, js_files=js_files))
+        else:
+            for fname in css_files:
+                if int(sphinx.__version__.split('.')[0]) >= 3:
+                    app.add_css_file(fname)
+                else:
+                    app.add_stylesheet(fname)
+            for fname in js_files:
+                app.add_js_file(fname)
+
+        if not app.config.process_examples:
+            return
+        config = dict(config)
+        # keep the caches out of the source directory
+        config.setdefault('cache_dir', os.path.join(
+            str(app.doctreedir), 'nbexamples'))
+        gallery = cls(**config)
+        gallery.set_builder_policy(policy)
+        if gallery.background:
+            gallery.start_background(app)
+        else:
+            gallery.process_directories()
 
-        insert_bokeh = config.get('insert_bokeh')
-        if insert_bokeh:
-            if not isstring(insert_bokeh):
-                import bokeh
-                insert_bokeh = bokeh.__version__
+    def start_background(self, app):
+        """Process the directories in a background thread
 
-            if int(sphinx.__version__.split('.')[0]) >= 3:
-                app.add_css_file(
-                    NotebookProcessor.BOKEH_STYLE_SHEET.format(
-                        version=insert_bokeh))
-            else:
-                app.add_stylesheet(
-                    NotebookProcessor.BOKEH_STYLE_SHEET.format(
-                        version=insert_bokeh))
-            app.add_js_file(
-                NotebookProcessor.BOKEH_JS.format(version=insert_bokeh))
-
-        insert_bokeh_widgets = config.get('insert_bokeh_widgets')
-        if insert_bokeh_widgets:
-            if not isstring(insert_bokeh_widgets):
-                import bokeh
-                insert_bokeh_widgets = bokeh.__version__
-            if int(sphinx.__version__.split('.')[0]) >= 3:
-                app.add_css_file(
-                    NotebookProcessor.BOKEH_WIDGETS_STYLE_SHEET.format(
-                        version=insert_bokeh_widgets))
-            else:
-                app.add_stylesheet(
-                    NotebookProcessor.BOKEH_WIDGETS_STYLE_SHEET.format(
-                        version=insert_bokeh_widgets))
-            app.add_js_file(
-                NotebookProcessor.BOKEH_WIDGETS_JS.format(
-                    version=insert_bokeh_widgets))
+        This method creates empty placeholders for the rst files that do not
+        exist yet, such that sphinx can find them, and starts
+        :meth:`process_directories` in a separate thread. The gallery
+        documents are then read after all other documents and the sphinx
+        build waits for the thread when the first gallery document or a
+        document with the :rst:dir:`linkgalleries` directive is read. If the
+        build fails, the remaining notebooks are not processed.
 
-        if not app.config.process_examples:
+        Only the rst files of the notebooks that are converted (see
+        :meth:`get_outdated_notebooks`) are marked as outdated for sphinx,
+        together with the index files if one of these notebooks or a README
+        file changed.
+
+        Parameters
+        ----------
+        app: sphinx.application.Sphinx
+            The sphinx application"""
+        self._rst_files = {}
+        for fname in self.iter_rst_files():
+            fname = os.path.abspath(fname)
+            self._rst_files[fname] = None
+            if not os.path.exists(fname):
+                create_dirs(os.path.dirname(fname))
+                open(fname, 'w').close()
+
+        # the files that the thread rewrites have to be read by sphinx
+        outdated_notebooks = set(self.get_outdated_notebooks())
+        self._outdated_rst_files = outdated = set()
+        index_files = set()
+        readme_changed = False
+        for file_dir, foutdir, nbfiles in self.iter_directories():
+            index_file = os.path.abspath(os.path.join(foutdir, 'index.rst'))
+            index_files.add(index_file)
+            index_mtime = os.stat(index_file).st_mtime
+            readme_changed = readme_changed or any(
+                os.stat(os.path.join(file_dir, f)).st_mtime > index_mtime
+                for f in self.index[file_dir][1] if f.startswith('README.'))
+            outdated.update(
+                os.path.abspath(os.path.join(foutdir, os.path.splitext(
+                    os.path.basename(f))[0] + '.rst'))
+                for f in nbfiles if f in outdated_notebooks)
+        if outdated or readme_changed:
+            outdated.update(index_files)
+
+        self._stop = stop = threading.Event()
+
+        def target():
+            try:
+                self.process_directories()
+            except BaseException as e:
+                if not stop.is_set():
+                    self._thread_error = e
+
+        self._thread = threading.Thread(
+            target=target, name='sphinx-nbexamples')
+        self._thread.daemon = True
+        self._thread.start()
+
+        app.connect('env-get-outdated', self._get_outdated_docs)
+        app.connect('env-before-read-docs', self._sort_docs)
+        app.connect('source-read', self._wait_for_source)
+        app.connect('build-finished',
+                    lambda app, exc: self.wait(stop=exc is not None))
+
+    def wait(self, stop=False):
+        """Wait for the background thread of :meth:`start_background`
+
+        Parameters
+        ----------
+        stop: bool
+            If True, the thread stops after the current notebook (e.g. if the
+            sphinx build failed) and the remaining notebooks are not
+            processed"""
+        if self._thread is None:
             return
-        cls(**app.config.example_gallery_config).process_directories()
+        if stop:
+            logger.info('Stopping the example gallery...')
+            self._stop.set()
+        else:
+            logger.info('Waiting for the example gallery...')
+        self._thread.join()
+        self._thread = None
+        if self._thread_error is not None:
+            e, self._thread_error = self._thread_error, None
+            raise e
+
+    def _get_docnames(self, env):
+        """Get the docnames of the gallery documents"""
+        if self._rst_files and any(
+                docname is None for docname in self._rst_files.values()):
+            for fname in self._rst_files:
+                self._rst_files[fname] = env.path2doc(fname)
+        return {docname for docname in self._rst_files.values() if docname}
+
+    def _get_outdated_docs(self, app, env, added, changed, removed):
+        """Mark the gallery documents as outdated that the background thread
+        rewrites (`env-get-outdated` event)"""
+        self._get_docnames(env)
+        return {self._rst_files[fname] for fname in self._outdated_rst_files
+                if self._rst_files.get(fname)} - added
+
+    def _sort_docs(self, app, env, docnames):
+        """Read the gallery documents last (`env-before-read-docs` event)"""
+        gallery_docs = self._get_docnames(env)
+        docnames.sort(key=lambda docname: docname in gallery_docs)
+        if app.parallel > 1:
+            # the documents are read in forked processes, so we have to wait
+            # for the gallery here
+            self.wait()
+
+    def _wait_for_source(self, app, docname, source):
+        """Wait for the gallery and update the source of a gallery document
+        (`source-read` event)"""
+        if self._thread is None:
+            return
+        if docname not in self._get_docnames(app.env):
+            # the linkgalleries directive lists the files of the gallery
+            if re.search(r'^\s*\.\. linkgalleries::', source[0], re.M):
+                self.wait()
+            return
+        self.wait()
+        # the file might have been changed, so we have to read it again
+        with io.open(app.env.doc2path(docname),
+                     encoding=app.config.source_encoding) as f:
+            source[0] = f.read()
+
+    def watch(self, interval=1., debounce=0.5, callback=None, stop=None):
+        """Process the gallery again whenever a file in the examples changes
+
+        This method polls the modification times of the files in the
+        :attr:`in_dir` directories. After a change, it waits until the files
+        did not change for `debounce` seconds and then processes the gallery
+        in :attr:`incremental` mode, i.e. only the changed notebooks are
+        executed and the index files are only written if their content
+        changed. Running this together with sphinx-autobuild then rebuilds
+        and reloads only the changed pages, provided that the sphinx build
+        does not process the entire gallery again, i.e. the configuration
+        sets :attr:`incremental` or disables ``process_examples``.
+
+        Parameters
+        ----------
+        interval: float
+            The seconds between two checks for changes
+        debounce: float
+            The seconds without further changes before the gallery is
+            processed
+        callback: callable
+            A function that is called with the list of changed files after
+            the gallery has been processed, e.g. to rebuild the documentation
+        stop: threading.Event
+            An event to stop watching. If None, this method runs until it is
+            interrupted"""
+        if stop is None:
+            stop = threading.Event()
+
+        def snapshot():
+            self._index = None
+            ret = {}
+            for file_dir, (dirs, files) in self.index.items():
+                for f in files:
+                    fname = os.path.join(file_dir, f)
+                    try:
+                        ret[fname] = os.stat(fname).st_mtime
+                    except OSError:  # the file has been removed meanwhile
+                        pass
+            return ret
+
+        self.incremental = True
+        last = snapshot()
+        logger.info('Watching %s for changes', ', '.join(self.in_dir))
+        while not stop.wait(interval):
+            current = snapshot()
+            if current == last:
+                continue
+            while not stop.wait(debounce):
+                new = snapshot()
+                if new == current:
+                    break
+                current = new
+            else:
+                return
+            changed = sorted(f for f in set(current).union(last)
+                             if current.get(f) != last.get(f))
+            last = current
+            logger.info('Processing the gallery after changes of %s',
+                        ', '.join(changed))
+            try:
+                self.process_directories()
+            except Exception:
+                logger.error('Could not process the gallery!', exc_info=True)
+                continue
+            if callback is not None:
+                callback(changed)
 
     def get_url(self, nbfile):
         """Return the url corresponding to the given notebook file
@@ -1038,6 +4295,279 @@ class Gallery(object):
             return urls + nbfile
 
 
+def copy_external_outputs(app, exception):
+    """Copy the externalized html outputs into the html build directory
+
+    This function is connected to the ``'build-finished'`` event and copies
+    the files in the ``'external'`` directories of the galleries (see
+    :meth:`NotebookProcessor.externalize_html`) that are listed in their
+    manifests next to the html pages. The copied files are recorded in the
+    :attr:`Gallery.EXTERNAL_MANIFEST_FILE` of the build directory, such that
+    the files of the previous build that are no longer needed are removed"""
+    import json
+    if (exception is not None or app.builder.format != 'html' or
+            not app.config.process_examples):
+        return
+    srcdir = os.path.abspath(str(app.srcdir))
+    outdir = os.path.abspath(str(app.outdir))
+    copied = []
+    for out_dir in Gallery(**app.config.example_gallery_config).out_dir:
+        out_dir = os.path.abspath(out_dir)
+        if os.path.relpath(out_dir, srcdir).startswith(os.pardir):
+            continue
+        for record in Gallery.read_manifest(out_dir)['entries'].values():
+            for f in record['files']:
+                if (os.path.basename(os.path.dirname(f)) != 'external' or
+                        not os.path.exists(f)):
+                    continue
+                target = os.path.join(outdir, os.path.relpath(
+                    os.path.abspath(f), srcdir))
+                create_dirs(os.path.dirname(target))
+                copyfile(f, target)
+                copied.append(os.path.relpath(target, outdir))
+    manifest_file = os.path.join(outdir, Gallery.EXTERNAL_MANIFEST_FILE)
+    old = []
+    if os.path.exists(manifest_file):
+        try:
+            with io.open(manifest_file, encoding='utf-8') as f:
+                old = json.load(f)
+        except ValueError:
+            pass
+    for f in set(old) - set(copied):
+        if os.path.exists(os.path.join(outdir, f)):
+            os.remove(os.path.join(outdir, f))
+    _write_if_changed(manifest_file, json.dumps(sorted(copied), indent=1))
+
+
+class ThumbnailCache(object):
+    """Persistent cache for the thumbnails of other projects
+
+    The :class:`LinkGalleriesDirective` uses this cache to download the
+    thumbnails of the galleries in other projects such that they are copied
+    into the build instead of being linked. Each file is revalidated once per
+    instance via its ETag or modification time. If the server cannot be
+    reached, the cached file is used. The least recently used files are
+    removed when the cache exceeds its maximum size."""
+
+    #: The name of the file with the information on the cached files
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, cache_dir, max_size=50 * 1024 ** 2, timeout=10):
+        """
+        Parameters
+        ----------
+        cache_dir: str
+            The directory for the downloaded files
+        max_size: int
+            The maximum number of bytes of the files in the cache
+        timeout: float
+            The timeout in seconds for the requests"""
+        import json
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._validated = set()
+        self._failed = set()
+        index_file = os.path.join(cache_dir, self.INDEX_FILE)
+        self.index = {}
+        if os.path.exists(index_file):
+            try:
+                with io.open(index_file, encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except ValueError:
+                logger.warning('Could not read %s', index_file)
+
+    def __getstate__(self):
+        # the lock cannot be pickled, e.g. for the parallel reading of
+        # sphinx-build -j
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_file(self, url):
+        """Get the cached file of `url` and download it if necessary
+
+        If the download fails, the `url` is not requested again by this
+        instance.
+
+        Parameters
+        ----------
+        url: str
+            The url of the file
+
+        Returns
+        -------
+        str or None
+            The path to the cached file or None if the file could not be
+            downloaded"""
+        import hashlib
+        from six.moves.urllib.request import Request, urlopen
+        from six.moves.urllib.error import HTTPError
+        with self._lock:
+            info = dict(self.index.get(url, {}))
+        fname = os.path.join(self.cache_dir, hashlib.sha1(
+            url.encode('utf-8')).hexdigest() + os.path.splitext(url)[1])
+        if not os.path.exists(fname):
+            info = {}
+        if info and url in self._validated:
+            return self._touch(url, fname)
+        if url in self._failed:
+            return fname if info else None
+        headers = {}
+        if info.get('etag'):
+            headers['If-None-Match'] = info['etag']
+        if info.get('last_modified'):
+            headers['If-Modified-Since'] = info['last_modified']
+        try:
+            response = urlopen(Request(url, headers=headers),
+                               timeout=self.timeout)
+            content = response.read()
+        except HTTPError as e:
+            if e.code == 304 and info:
+                self._validated.add(url)
+                return self._touch(url, fname)
+            logger.warning('Could not download %s: %s', url, e)
+            self._failed.add(url)
+            return fname if info else None
+        except Exception as e:
+            logger.warning('Could not download %s: %s', url, e)
+            self._failed.add(url)
+            return fname if info else None
+        create_dirs(self.cache_dir)
+        tmp_file = '%s.%s.tmp' % (fname, threading.current_thread().ident)
+        with open(tmp_file, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_file, fname)
+        with self._lock:
+            self.index[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'size': len(content)}
+        self._validated.add(url)
+        return self._touch(url, fname)
+
+    def _touch(self, url, fname):
+        """Mark the file of `url` as used"""
+        import time
+        with self._lock:
+            self.index[url]['used'] = time.time()
+        return fname
+
+    def get_files(self, urls, processes=4):
+        """Get the cached files of multiple urls
+
+        The files are downloaded concurrently (see :meth:`get_file`) and the
+        cache is saved afterwards (see :meth:`save`)
+
+        Parameters
+        ----------
+        urls: list of str
+            The urls of the files
+        processes: int
+            The number of concurrent downloads
+
+        Returns
+        -------
+        list
+            The paths to the cached files (or None) for each url"""
+        from multiprocessing.pool import ThreadPool
+        urls = list(urls)
+        if not urls:
+            return []
+        pool = ThreadPool(min(processes, len(urls)))
+        try:
+            ret = pool.map(self.get_file, urls)
+        finally:
+            pool.close()
+            pool.join()
+        self.save()
+        return ret
+
+    def save(self):
+        """Remove the least recently used files if the cache is too large and
+        save the index"""
+        import json
+        import hashlib
+        with self._lock:
+            index = self.index
+            size = sum(info.get('size', 0) for info in index.values())
+            for url in sorted(index, key=lambda url: index[url].get('used',
+                                                                    0)):
+                if size <= self.max_size:
+                    break
+                fname = os.path.join(self.cache_dir, hashlib.sha1(
+                    url.encode('utf-8')).hexdigest() + os.path.splitext(
+                        url)[1])
+                if os.path.exists(fname):
+                    os.remove(fname)
+                size -= index.pop(url).get('size', 0)
+                self._validated.discard(url)
+            create_dirs(self.cache_dir)
+            index_file = os.path.join(self.cache_dir, self.INDEX_FILE)
+            tmp_file = '%s.%s.tmp' % (index_file, os.getpid())
+            with io.open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(six.text_type(json.dumps(index)))
+            os.rename(tmp_file, index_file)
+
+
+class gallery_thumbnail(nodes.General, nodes.Element):
+    """A thumbnail of the :class:`LinkGalleriesDirective`
+
+    The node contains the image (possibly wrapped in a reference) and a
+    paragraph with the reference to the example. It is rendered as thumbnail
+    container by the html builders and converted into a figure for the other
+    builders (see :class:`GalleryThumbnailFallback`)"""
+
+
+def visit_gallery_thumbnail_html(self, node):
+    classes = ['figure'] + node['classes']
+    if node.get('align'):
+        classes.append('align-' + node['align'])
+    self.body.append(
+        '<div class="sphx-glr-thumbContainer"><div class="%s">' % (
+            ' '.join(classes), ))
+
+
+def depart_gallery_thumbnail_html(self, node):
+    self.body.append('</div></div>\n')
+
+
+try:
+    from sphinx.transforms.post_transforms import SphinxPostTransform
+except ImportError:  # sphinx < 2.0
+    from sphinx.transforms import SphinxTransform as SphinxPostTransform
+
+
+class GalleryThumbnailFallback(SphinxPostTransform):
+    """Convert the :class:`gallery_thumbnail` nodes into figures
+
+    This transform is applied for all builders that do not produce html and
+    creates the same figure as the :dudir:`figure` directive"""
+
+    default_priority = 5
+
+    def apply(self, **kwargs):
+        builder = getattr(self.env, '_builder_cls', None)
+        if builder is None:
+            builder = self.app.builder
+        if builder.format == 'html':
+            return
+        findall = getattr(self.document, 'findall', self.document.traverse)
+        for node in list(findall(gallery_thumbnail)):
+            image, paragraph = node.children
+            figure = nodes.figure('', image, nodes.caption(
+                paragraph.rawsource, '', *paragraph.children))
+            figure['classes'] = node['classes']
+            if node.get('align'):
+                figure['align'] = node['align']
+            node.replace_self(figure)
+
+
 def align(argument):
     """Conversion function for the "align" option."""
     return directives.choice(argument, ('left', 'center', 'right'))
@@ -1047,34 +4577,130 @@ class LinkGalleriesDirective(Directive):
 
     has_content = True
 
-    if hasattr(directives, 'images'):
-        option_spec = directives.images.Figure.option_spec
-    else:
-        option_spec = {'alt': directives.unchanged,
-                       'height': directives.nonnegative_int,
-                       'width': directives.nonnegative_int,
-                       'scale': directives.nonnegative_int,
-                       'align': align
-                       }
+    option_spec = Figure.option_spec
 
     def create_image_nodes(self, header, thumb_url, key, link_url=None):
-        options = {'target': link_url} if link_url else {}
-        options.update(self.options)
-        d1 = directives.misc.Raw(
-            'raw', ['html'], {}, ViewList([
-                '<div class="sphx-glr-thumbContainer">']
-                ),
-            self.lineno, self.content_offset, self.block_text, self.state,
-            self.state_machine)
-        d = directives.images.Figure(
-            'image', [thumb_url], options, ViewList([':ref:`%s`' % key]),
-            self.lineno, self.content_offset, self.block_text, self.state,
-            self.state_machine)
-        d2 = directives.misc.Raw(
-            'raw', ['html'], {}, ViewList(['</div>']),
-            self.lineno, self.content_offset, self.block_text, self.state,
-            self.state_machine)
-        return list(chain(d1.run(), d.run(), d2.run()))
+        """Create the :class:`gallery_thumbnail` node for one example"""
+        options = self.options
+        image = nodes.image(thumb_url, uri=directives.uri(thumb_url),
+                            classes=list(options.get('class', [])))
+        for option in ['alt', 'height', 'width', 'scale']:
+            if option in options:
+                image[option] = options[option]
+        target = options.get('target', link_url)
+        if target:
+            image = nodes.reference('', '', image, refuri=target)
+        text = ':ref:`%s`' % key
+        inodes, messages = self.state.inline_text(text, self.lineno)
+        node = gallery_thumbnail(
+            '', image, nodes.paragraph(text, '', *inodes),
+            classes=list(options.get('figclass', [])))
+        if 'align' in options:
+            node['align'] = options['align']
+        return [node] + messages
+
+    def get_link_index(self):
+        """Get the cache of the directive for the current build
+
+        The cache is stored as ``nbexamples_link_index`` attribute of the
+        build environment and removed by :func:`clear_link_index` before the
+        environment is pickled"""
+        try:
+            return self.env.nbexamples_link_index
+        except AttributeError:
+            self.env.nbexamples_link_index = {}
+            return self.env.nbexamples_link_index
+
+    def get_local_thumbnails(self, directory):
+        """Get the labels and thumbnails of a gallery in this project
+
+        The gallery directory is only walked through once per build.
+
+        Parameters
+        ----------
+        directory: str
+            The gallery directory
+
+        Returns
+        -------
+        list of tuple
+            The label and the path to the thumbnail for each notebook"""
+        index = self.get_link_index()
+        key = ('local', directory)
+        if key in index:
+            return index[key]
+        ret = index[key] = []
+        for file_dir, dirs, files in os.walk(directory):
+            if not file_dir.endswith(osp.sep):
+                file_dir += osp.sep
+            file_dir_ = file_dir.replace(osp.sep, '_').lower()
+            if 'index.rst' in files:
+                for f in files:
+                    if f.endswith('.ipynb'):
+                        ref = 'gallery_' + file_dir_ + f
+                        thumb = osp.join(
+                            file_dir, 'images', 'thumb', ref + '_thumb.png')
+                        if osp.isabs(thumb):
+                            thumb = osp.relpath(thumb, self.env.srcdir)
+                        ret.append((ref, thumb))
+        return ret
+
+    def get_remote_labels(self, pkg, refs, prefix):
+        """Get the gallery labels of another project with the given prefix
+
+        The gallery labels of the inventory are sorted once per build such
+        that the labels with the given `prefix` can be found via bisection.
+
+        Parameters
+        ----------
+        pkg: str
+            The name of the project in the intersphinx mapping
+        refs: dict
+            The ``'std:label'`` entries of the inventory of `pkg`
+        prefix: str
+            The prefix of the labels
+
+        Returns
+        -------
+        list of str
+            The labels of the notebooks that start with `prefix` in the order
+            of the inventory"""
+        index = self.get_link_index()
+        key = ('remote', pkg)
+        if key not in index:
+            index[key] = sorted(
+                (label, i) for i, label in enumerate(refs)
+                if label.startswith('gallery_') and label.endswith('.ipynb'))
+        labels = index[key]
+        matches = []
+        for i in range(bisect_left(labels, (prefix, )), len(labels)):
+            label, pos = labels[i]
+            if not label.startswith(prefix):
+                break
+            matches.append((pos, label))
+        return [label for pos, label in sorted(matches)]
+
+    def get_thumbnail_cache(self):
+        """Get the cache for the thumbnails of other projects
+
+        Returns
+        -------
+        ThumbnailCache or None
+            The cache for the current build or None if the
+            ``'remote_thumbnails'`` are not cached (see :class:`Gallery`)"""
+        settings = self.env.config.example_gallery_config.get(
+            'remote_thumbnails')
+        if not settings:
+            return None
+        index = self.get_link_index()
+        if 'thumbnail_cache' not in index:
+            settings = dict({} if settings is True else settings)
+            settings.pop('processes', None)
+            cache_dir = settings.pop('cache_dir', None)
+            if cache_dir is None:
+                cache_dir = _user_cache_dir('thumbnails')
+            index['thumbnail_cache'] = ThumbnailCache(cache_dir, **settings)
+        return index['thumbnail_cache']
 
     def get_outdirs(self):
         conf = self.env.config.example_gallery_config
@@ -1114,23 +4740,10 @@ class LinkGalleriesDirective(Directive):
                 else:
                     directories = [directory]
                 for directory in directories:
-                    for file_dir, dirs, files in os.walk(directory):
-                        if not file_dir.endswith(osp.sep):
-                            file_dir += osp.sep
-                        file_dir_ = file_dir.replace(osp.sep, '_').lower()
-                        if 'index.rst' in files:
-                            for f in files:
-                                if f.endswith('.ipynb'):
-                                    ref = 'gallery_' + file_dir_ + f
-                                    thumb = osp.join(
-                                        file_dir, 'images', 'thumb',
-                                        ref + '_thumb.png')
-                                    if osp.isabs(thumb):
-                                        thumb = osp.relpath(thumb,
-                                                            self.env.srcdir)
-                                    header = ':ref:`%s`' % (ref, )
-                                    ret.extend(self.create_image_nodes(
-                                        header, thumb, ref))
+                    for ref, thumb in self.get_local_thumbnails(directory):
+                        header = ':ref:`%s`' % (ref, )
+                        ret.extend(self.create_image_nodes(
+                            header, thumb, ref))
             else:
                 try:
                     refs = inventory[pkg]['std:label']
@@ -1143,15 +4756,29 @@ class LinkGalleriesDirective(Directive):
                     base_url = self.env.config.intersphinx_mapping[pkg][1][0]
                 if not base_url.endswith('/'):
                     base_url += '/'
-                for key, val in refs.items():
-                    if (key.startswith('gallery_' + directory_) and
-                            key.endswith('.ipynb')):
-                        link_url = val[2]
-                        header = val[3]
-                        thumb_url = base_url + '_images/%s_thumb.png' % key
-                        ret.extend(self.create_image_nodes(
-                            header, thumb_url, '%s:%s' % (pkg, key),
-                            link_url))
+                keys = self.get_remote_labels(
+                    pkg, refs, 'gallery_' + directory_)
+                thumb_urls = [base_url + '_images/%s_thumb.png' % key
+                              for key in keys]
+                cache = self.get_thumbnail_cache()
+                if cache is not None:
+                    doc_dir = os.path.dirname(str(self.env.doc2path(
+                        self.env.docname)))
+                    settings = conf.example_gallery_config['remote_thumbnails']
+                    processes = 4 if settings is True else settings.get(
+                        'processes', 4)
+                    thumb_urls = [
+                        url if fname is None else os.path.relpath(
+                            fname, doc_dir)
+                        for url, fname in zip(thumb_urls, cache.get_files(
+                            thumb_urls, processes))]
+                for key, thumb_url in zip(keys, thumb_urls):
+                    val = refs[key]
+                    link_url = val[2]
+                    header = val[3]
+                    ret.extend(self.create_image_nodes(
+                        header, thumb_url, '%s:%s' % (pkg, key),
+                        link_url))
         ret.extend(directives.misc.Raw(
             'raw', ['html'], {}, ViewList(["<div style='clear:both'></div>"]),
             self.lineno, self.content_offset, self.block_text, self.state,
@@ -1159,6 +4786,16 @@ class LinkGalleriesDirective(Directive):
         return [ret]
 
 
+def clear_link_index(app, env):
+    """Remove the cache of the :class:`LinkGalleriesDirective`
+
+    This function is connected to the ``'env-updated'`` event such that the
+    cache is not pickled with the environment and rebuilt in the next
+    build"""
+    if hasattr(env, 'nbexamples_link_index'):
+        del env.nbexamples_link_index
+
+
 #: dictionary containing the configuration of the example gallery.
 #:
 #: Possible keys for the dictionary are the initialization keys of the
@@ -1194,5 +4831,10 @@ def setup(app):
         app.add_stylesheet('example_gallery_styles.css')
 
     app.add_directive('linkgalleries', LinkGalleriesDirective)
+    app.add_node(gallery_thumbnail, html=(visit_gallery_thumbnail_html,
+                                          depart_gallery_thumbnail_html))
+    app.add_post_transform(GalleryThumbnailFallback)
+    app.connect('env-updated', clear_link_index)
 
     app.connect('builder-inited', Gallery.from_sphinx)
+    app.connect('build-finished', copy_external_outputs)
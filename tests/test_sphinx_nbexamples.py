@@ -1,5 +1,7 @@
 import os
 import re
+import sys
+import subprocess
 import os.path as osp
 import unittest
 from tempfile import mkdtemp
@@ -8,10 +10,15 @@ import sphinx
 import glob
 import shutil
 import six
+from collections import OrderedDict
 try:
     import pathlib
 except ImportError:
     pathlib = None
+try:
+    from mistune.renderers.rst import RSTRenderer
+except ImportError:
+    RSTRenderer = None
 
 
 if six.PY2:
@@ -43,11 +50,18 @@ def find_files(src_dir, pattern, skip_private=True):
 
 class BaseTest(unittest.TestCase):
 
+    #: items to update the ``example_gallery_config`` in the ``conf.py``
+    gallery_config = {}
+
     def setUp(self):
         self.src_dir = mkdtemp(prefix='tmp_nbexamples_')
         os.rmdir(self.src_dir)
         self.out_dir = osp.join(self.src_dir, 'build', 'html')
         shutil.copytree(sphinx_supp, self.src_dir)
+        if self.gallery_config:
+            with open(osp.join(self.src_dir, 'conf.py'), 'a') as f:
+                f.write('\nexample_gallery_config.update(%r)\n' % (
+                    self.gallery_config, ))
 
         self.app = Sphinx(
             srcdir=self.src_dir, confdir=self.src_dir, outdir=self.out_dir,
@@ -58,11 +72,8 @@ class BaseTest(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.src_dir)
 
-
-class TestGallery(BaseTest):
-
-    def test_files_exist(self):
-        """Test if all notebooks are processed correctly"""
+    def check_files_exist(self):
+        """Check that the files of all notebooks have been created"""
         raw_dir = osp.join(self.src_dir, 'raw_examples')
         for f in find_files(raw_dir,
                             'example_*.ipynb'):
@@ -80,6 +91,13 @@ class TestGallery(BaseTest):
                     self.out_dir, 'examples')))[0] + '.html'
             self.assertTrue(osp.exists(html), msg=html + ' is missing!')
 
+
+class TestGallery(BaseTest):
+
+    def test_files_exist(self):
+        """Test if all notebooks are processed correctly"""
+        self.check_files_exist()
+
     def test_thumbnail(self):
         """Test if the thumbnail has been inserted correctly"""
         base = osp.join(self.src_dir, 'examples', 'example_mpl_test.ipynb')
@@ -92,6 +110,14 @@ class TestGallery(BaseTest):
             index_html = f.read()
         self.assertIn(osp.basename(thumb), index_html)
 
+    def test_cache_dir(self):
+        """Test that the caches are in the doctree directory"""
+        cache_dir = osp.join(self.src_dir, 'build', 'doctrees', 'nbexamples')
+        self.assertEqual(len(os.listdir(osp.join(cache_dir, 'readme'))), 1)
+        for dirname, dirs, files in os.walk(osp.join(self.src_dir,
+                                                     'examples')):
+            self.assertFalse([d for d in dirs if d.endswith('_cache')])
+
     def test_failure(self):
         """Test if a failed notebook is anyway existent"""
         base = 'example_failure'
@@ -220,6 +246,1517 @@ class TestGallery(BaseTest):
         self.assertIn('hello, world', rst)
 
 
+class TestKernelLookahead(BaseTest):
+
+    gallery_config = {'kernel_lookahead': 2}
+
+    def setUp(self):
+        """Record the kernels that are started, passed to the processors and
+        used for the execution"""
+        import sphinx_nbexamples as sne
+        from nbconvert.preprocessors import ExecutePreprocessor
+        self.started, self.passed, self.used = [], [], []
+        start_kernel = sne.KernelPrewarmer.start_kernel
+        init = sne.NotebookProcessor.__init__
+        preprocess = ExecutePreprocessor.preprocess
+
+        def start(infile, *args):
+            km = start_kernel(infile, *args)
+            self.started.append(km)
+            return km
+
+        def init_processor(nbp, *args, **kwargs):
+            self.passed.append(kwargs.get('kernel_manager'))
+            init(nbp, *args, **kwargs)
+
+        def execute(ep, nb, resources=None, km=None):
+            self.used.append(km)
+            return preprocess(ep, nb, resources, km=km)
+
+        sne.KernelPrewarmer.start_kernel = staticmethod(start)
+        sne.NotebookProcessor.__init__ = init_processor
+        ExecutePreprocessor.preprocess = execute
+        try:
+            super(TestKernelLookahead, self).setUp()
+        finally:
+            sne.KernelPrewarmer.start_kernel = staticmethod(start_kernel)
+            sne.NotebookProcessor.__init__ = init
+            ExecutePreprocessor.preprocess = preprocess
+
+    def test_kernel_managers(self):
+        """Test if the pre-started kernels are used by the processors"""
+        passed = [km for km in self.passed if km is not None]
+        self.assertTrue(passed)
+        for km in passed:
+            self.assertTrue(any(km is started for started in self.started))
+            self.assertTrue(any(km is used for used in self.used))
+
+    def test_prestarted_kernels(self):
+        """Test if the notebooks are processed with pre-started kernels"""
+        for base, output in [('example_bash', 'hello, world'),
+                             ('example_hello_world', 'Hello World!')]:
+            rst_path = osp.join(self.src_dir, 'examples', base) + '.rst'
+            with open(rst_path) as f:
+                self.assertIn(output, f.read())
+        self.assertTrue(glob.glob(osp.join(
+            self.src_dir, 'examples', 'images', 'example_mpl_test_*.png')))
+
+
+class TestBackground(BaseTest):
+
+    gallery_config = {'background': True}
+
+    def test_files_exist(self):
+        """Test if all notebooks are processed in the background"""
+        self.check_files_exist()
+
+    def test_index(self):
+        """Test if the gallery index has been read after it was created"""
+        with open(osp.join(self.out_dir, 'examples', 'index.html')) as f:
+            index_html = f.read()
+        self.assertIn('Some examples for testing', index_html)
+        self.assertIn('example_mpl_test.ipynb_thumb.png', index_html)
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def _imported_modules(self, *modules):
+        """Get the modules that are loaded by importing sphinx_nbexamples in
+        a new interpreter
+
+        The `modules` are imported in addition to sphinx_nbexamples"""
+        code = '; '.join([
+            'import sys, warnings',
+            'warnings.simplefilter("ignore")',
+            'import sphinx_nbexamples%s' % ''.join(', ' + m for m in modules),
+            'print(" ".join(sorted(sys.modules)))'])
+        out = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=osp.dirname(osp.dirname(osp.abspath(__file__))))
+        return set(out.decode('utf-8').split())
+
+    def test_lazy_imports(self):
+        """Test that heavy dependencies are only imported when necessary"""
+        modules = self._imported_modules()
+        for mod in ['nbconvert', 'nbformat', 'bokeh']:
+            self.assertNotIn(mod, modules)
+        modules = self._imported_modules('nbconvert', 'nbformat')
+        self.assertIn('nbconvert', modules)
+
+
+class TestNotebookIO(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _test_roundtrip(self, validate):
+        import nbformat
+        import sphinx_nbexamples as sne
+        for f in find_files(osp.join(sphinx_supp, 'raw_examples'),
+                            'example_*.ipynb'):
+            ref = nbformat.read(f, nbformat.current_nbformat)
+            nb = sne.read_notebook(f, validate)
+            self.assertEqual(nb, ref, msg='Wrong notebook read from ' + f)
+            target = osp.join(self.tmp_dir, osp.basename(f))
+            sne.write_notebook(nb, target, validate)
+            self.assertEqual(nb, ref, msg='Notebook changed when writing')
+            self.assertEqual(
+                nbformat.read(target, nbformat.current_nbformat), ref,
+                msg='Wrong notebook written from ' + f)
+
+    def test_roundtrip(self):
+        """Test reading and writing notebooks"""
+        self._test_roundtrip(True)
+        self._test_roundtrip(False)
+        self._test_roundtrip('once')
+
+    def test_roundtrip_stdlib(self):
+        """Test reading and writing notebooks without a fast json library"""
+        import sphinx_nbexamples as sne
+        get_backend = sne._get_json_backend
+        sne._get_json_backend = lambda: None
+        try:
+            self._test_roundtrip(True)
+            self._test_roundtrip(False)
+        finally:
+            sne._get_json_backend = get_backend
+
+
+class TestScanNotebook(unittest.TestCase):
+
+    def test_scan(self):
+        """Test scanning the metadata and description of the notebooks"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        for f in find_files(osp.join(sphinx_supp, 'raw_examples'),
+                            'example_*.ipynb'):
+            ref = nbformat.read(f, nbformat.current_nbformat)
+            nb = sne.scan_notebook(f)
+            self.assertEqual(nb.metadata, ref.metadata)
+            self.assertEqual(len(nb.cells), min(2, len(ref.cells)))
+            for cell in nb.cells:
+                self.assertNotIn('outputs', cell)
+            self.assertEqual(sne.notebook_description(nb),
+                             sne.notebook_description(ref))
+
+    def test_escaped(self):
+        """Test scanning a notebook with escaped characters"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        nb = nbformat.v4.new_notebook(
+            metadata={'a': 'x\\"y\\\\', 'b': [1.5, True, None, {'c': ']}'}]})
+        cell = nbformat.v4.new_code_cell('print("]}")')
+        cell.outputs.append(nbformat.v4.new_output(
+            'stream', text='"\\"]}{[\\"'))
+        nb.cells.append(cell)
+        nb.cells.append(nbformat.v4.new_markdown_cell('# T\\"itle\n\n"desc"'))
+        tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+        try:
+            fname = osp.join(tmp_dir, 'test.ipynb')
+            nbformat.write(nb, fname)
+            scanned = sne.scan_notebook(fname, 3)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(scanned.metadata, nb.metadata)
+        self.assertEqual([c.source for c in scanned.cells],
+                         [c.source for c in nb.cells])
+
+
+class TestGalleryEntry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_entry(self):
+        """Test the record of a processed notebook"""
+        import sphinx_nbexamples as sne
+        infile = osp.join(sphinx_supp, 'raw_examples',
+                          'example_code_example.ipynb')
+        nbp = sne.NotebookProcessor(
+            infile, osp.join(self.tmp_dir, osp.basename(infile)),
+            preprocess=False)
+        self.assertIsNone(nbp.nb)
+        entry = nbp.get_entry()
+        self.assertFalse(hasattr(entry, '__dict__'))
+        self.assertEqual(entry.reference, nbp.reference)
+        self.assertEqual(entry.rst_file, nbp.get_out_file())
+        self.assertTrue(osp.exists(entry.rst_file))
+        self.assertEqual(entry.description, nbp.get_description()[1])
+        self.assertEqual(entry.code_div, nbp.code_div)
+        self.assertIn('somecode', entry.code_div)
+        self.assertIn(entry.reference, entry.thumbnail_div)
+
+
+class TestTagRemovalCopy(unittest.TestCase):
+
+    def _create_notebook(self):
+        import nbformat
+        nb = nbformat.v4.new_notebook()
+        for i in range(10):
+            cell = nbformat.v4.new_code_cell(
+                'plot()', metadata={'tags': ['remove'] if i % 3 else []})
+            cell.outputs.append(nbformat.v4.new_output(
+                'display_data', data={'image/png': str(i) * 1000000}))
+            nb.cells.append(cell)
+        nb.cells[1].metadata['tags'] = ['remove-input']
+        nb.cells[3].outputs[0].metadata['tags'] = ['remove-output']
+        return nb
+
+    def _remove_tags(self, nb):
+        from nbconvert.preprocessors import TagRemovePreprocessor
+        tp = TagRemovePreprocessor(
+            remove_cell_tags={'remove'}, remove_input_tags={'remove-input'},
+            remove_single_output_tags={'remove-output'})
+        tp.preprocess(nb, {})
+        return nb
+
+    def test_copy(self):
+        """Test copying the notebook for the tag removal"""
+        from copy import deepcopy
+        import sphinx_nbexamples as sne
+        nb = self._create_notebook()
+        ref = deepcopy(nb)
+        removed = self._remove_tags(sne.copy_notebook_structure(nb))
+        self.assertEqual(nb, ref, msg='Original notebook has been modified')
+        self.assertEqual(removed, self._remove_tags(deepcopy(nb)))
+        self.assertIs(removed.cells[0].outputs[0], nb.cells[0].outputs[0])
+
+    @unittest.skipIf(six.PY2, 'tracemalloc requires python 3')
+    def test_memory(self):
+        """Test that the outputs are not copied for the tag removal"""
+        import tracemalloc
+        import sphinx_nbexamples as sne
+        nb = self._create_notebook()
+        tracemalloc.start()
+        try:
+            self._remove_tags(sne.copy_notebook_structure(nb))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # the outputs have a size of 10MB
+        self.assertLess(peak, 1000000)
+
+
+class TestOutputLimiter(unittest.TestCase):
+
+    def _output(self, outs, msg, display_id, cell_index):
+        """Mimic the output method of the ExecutePreprocessor"""
+        from nbformat.v4 import output_from_msg
+        out = output_from_msg(msg)
+        outs.append(out)
+        return out
+
+    def _stream(self, text):
+        return {'header': {'msg_type': 'stream'}, 'parent_header': {},
+                'content': {'name': 'stdout', 'text': text}}
+
+    def _display(self, data):
+        return {'header': {'msg_type': 'display_data'}, 'parent_header': {},
+                'content': {'data': data, 'metadata': {}}}
+
+    def test_stream(self):
+        """Test the truncation of a stream output"""
+        from sphinx_nbexamples import OutputLimiter
+        limiter = OutputLimiter(self._output, max_output_size=100)
+        outs = []
+        for i in range(100):
+            limiter(outs, self._stream('line %i\n' % i), None, 0)
+        self.assertEqual(len(outs), 14)
+        text = ''.join(out.text for out in outs)
+        self.assertEqual(len(text), 100 + len(OutputLimiter.TRUNCATED))
+        self.assertTrue(text.endswith(OutputLimiter.TRUNCATED))
+        # a new cell should not be truncated
+        outs = []
+        limiter(outs, self._stream('line\n'), None, 1)
+        self.assertEqual(outs[0].text, 'line\n')
+
+    def test_notebook(self):
+        """Test the limit for the entire notebook"""
+        from sphinx_nbexamples import OutputLimiter
+        limiter = OutputLimiter(self._output, max_notebook_output_size=100)
+        outs = []
+        limiter(outs, self._stream('a' * 60), None, 0)
+        limiter(outs, self._display({'text/plain': 'b' * 60,
+                                     'text/html': 'c' * 60,
+                                     'image/png': 'd' * 60}), None, 1)
+        self.assertEqual(outs[0].text, 'a' * 60)
+        self.assertEqual(outs[1].data['text/plain'],
+                         'b' * 40 + OutputLimiter.TRUNCATED)
+        self.assertNotIn('text/html', outs[1].data)
+        self.assertEqual(outs[1].data['image/png'], 'd' * 60)
+        # the following outputs are truncated
+        limiter(outs, self._stream('e'), None, 2)
+        limiter(outs, self._stream('f'), None, 2)
+        self.assertEqual(len(outs), 3)
+        self.assertEqual(outs[2].text, OutputLimiter.TRUNCATED)
+
+    def test_clear_output(self):
+        """Test that cleared outputs do not count for the limits"""
+        from sphinx_nbexamples import OutputLimiter
+
+        def output(outs, msg, display_id, cell_index):
+            # mimic the delayed clearing of ``clear_output(wait=True)``
+            outs[:] = []
+            return self._output(outs, msg, display_id, cell_index)
+
+        limiter = OutputLimiter(output, max_output_size=100,
+                                max_notebook_output_size=150)
+        outs = []
+        for i in range(10):
+            limiter(outs, self._stream(str(i) * 60), None, 0)
+        self.assertEqual(len(outs), 1)
+        self.assertEqual(outs[0].text, '9' * 60)
+        self.assertEqual(limiter.notebook_output_size, 60)
+        # clear the outputs immediately
+        limiter = OutputLimiter(self._output, max_output_size=100)
+        outs = []
+        limiter(outs, self._stream('a' * 80), None, 0)
+        limiter(outs, self._stream('b' * 80), None, 0)
+        self.assertTrue(outs[-1].text.endswith(OutputLimiter.TRUNCATED))
+        outs[:] = []
+        limiter(outs, self._stream('c' * 80), None, 0)
+        self.assertEqual([out.text for out in outs], ['c' * 80])
+
+
+class TestExternalHtml(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_externalize(self):
+        """Test moving large html outputs into separate files"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        nb = nbformat.v4.new_notebook(metadata={'language_info': {
+            'name': 'python', 'file_extension': '.py'}})
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Title'))
+        for html in ['<b>small</b>', '<b>%s</b>' % ('large' * 100)]:
+            cell = nbformat.v4.new_code_cell('show()')
+            cell.outputs.append(nbformat.v4.new_output(
+                'display_data', data={'text/html': html,
+                                      'text/plain': 'plot'}))
+            nb.cells.append(cell)
+        infile = osp.join(self.tmp_dir, 'example_html.ipynb')
+        nbformat.write(nb, infile)
+        outdir = osp.join(self.tmp_dir, 'out')
+        os.makedirs(outdir)
+        nbp = sne.NotebookProcessor(
+            infile, osp.join(outdir, 'example_html.ipynb'),
+            preprocess=False, clear=False, external_html_size=100)
+        with open(nbp.get_out_file()) as f:
+            rst = f.read()
+        self.assertIn('<b>small</b>', rst)
+        self.assertNotIn('large', rst)
+        self.assertIn('src="external/example_html_0.html"', rst)
+        with open(osp.join(outdir, 'external', 'example_html_0.html')) as f:
+            self.assertIn('large' * 100, f.read())
+        # the downloadable notebook should still contain the outputs
+        nb = nbformat.read(nbp.outfile, nbformat.current_nbformat)
+        self.assertIn('large' * 100, nb.cells[2].outputs[0].data['text/html'])
+
+    def test_externalize_bokeh_widgets(self):
+        """Test the bokeh widget assets in the externalized outputs"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        nb = nbformat.v4.new_notebook(metadata={'language_info': {
+            'name': 'python', 'file_extension': '.py'}})
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Title'))
+        cell = nbformat.v4.new_code_cell('show(widgetbox(slider))')
+        cell.outputs.append(nbformat.v4.new_output(
+            'display_data', data={
+                'text/html': '<div class="bk-widget">%s</div>' % ('w' * 200),
+                'text/plain': 'widget'}))
+        nb.cells.append(cell)
+        infile = osp.join(self.tmp_dir, 'example_widget.ipynb')
+        nbformat.write(nb, infile)
+        outdir = osp.join(self.tmp_dir, 'out')
+        os.makedirs(outdir)
+        sne.NotebookProcessor(
+            infile, osp.join(outdir, 'example_widget.ipynb'),
+            preprocess=False, clear=False, external_html_size=100,
+            insert_bokeh_widgets='2.3.0')
+        with open(osp.join(outdir, 'external',
+                           'example_widget_0.html')) as f:
+            html = f.read()
+        head = html[:html.index('</head>')]
+        self.assertIn(sne.NotebookProcessor.BOKEH_WIDGETS_STYLE_SHEET.format(
+            version='2.3.0'), head)
+        self.assertIn(sne.NotebookProcessor.BOKEH_WIDGETS_JS.format(
+            version='2.3.0'), head)
+        self.assertIn('w' * 200, html)
+
+
+class TestBokehAssets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _create_notebook(self, mimetype):
+        import nbformat
+        nb = nbformat.v4.new_notebook(metadata={'language_info': {
+            'name': 'python', 'file_extension': '.py'}})
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Title\n\nbokeh'))
+        cell = nbformat.v4.new_code_cell('show(p)')
+        cell.outputs.append(nbformat.v4.new_output(
+            'display_data', data={mimetype: {}, 'text/plain': 'plot'}))
+        nb.cells.append(cell)
+        return nb
+
+    def test_per_page(self):
+        """Test marking the notebooks with bokeh outputs"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        outdir = osp.join(self.tmp_dir, 'out')
+        os.makedirs(outdir)
+        for name, mimetype, marked in [
+                ('example_bokeh', 'application/vnd.bokehjs_exec.v0+json',
+                 True),
+                ('example_other', 'application/json', False)]:
+            nb = self._create_notebook(mimetype)
+            self.assertEqual(sne.has_bokeh_output(nb), marked)
+            infile = osp.join(self.tmp_dir, name + '.ipynb')
+            nbformat.write(nb, infile)
+            nbp = sne.NotebookProcessor(
+                infile, osp.join(outdir, name + '.ipynb'), preprocess=False,
+                clear=False, insert_bokeh='2.3.0', bokeh_per_page=True)
+            with open(nbp.get_out_file()) as f:
+                rst = f.read()
+            # the assets are added to the html page and not to the rst file
+            self.assertNotIn('bokeh-2.3.0', rst)
+            self.assertEqual(rst.startswith(sne.NotebookProcessor.BOKEH_FIELD),
+                             marked)
+
+    def test_static_dir(self):
+        """Test the usage of local copies of the bokeh files"""
+        import sphinx_nbexamples as sne
+        with open(osp.join(self.tmp_dir, 'bokeh-2.3.0.min.js'), 'w'):
+            pass
+        css_files, js_files = sne.get_bokeh_assets(
+            {'insert_bokeh': '2.3.0', 'insert_bokeh_widgets': '2.3.0'},
+            self.tmp_dir)
+        self.assertEqual(js_files, ['bokeh-2.3.0.min.js'])
+        self.assertEqual(len(css_files), 1)
+        self.assertTrue(css_files[0].startswith('http'))
+
+
+class TestImageOptimization(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _process(self, name, metadata={}, **kwargs):
+        import base64
+        import io
+        import nbformat
+        from PIL import Image
+        import sphinx_nbexamples as sne
+        buf = io.BytesIO()
+        Image.new('RGB', (1200, 600), (255, 0, 0)).save(buf, 'PNG')
+        nb = nbformat.v4.new_notebook(metadata=dict(metadata, language_info={
+            'name': 'python', 'file_extension': '.py'}))
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Title'))
+        cell = nbformat.v4.new_code_cell('plot()')
+        cell.outputs.append(nbformat.v4.new_output(
+            'display_data', data={
+                'image/png': base64.b64encode(buf.getvalue()).decode('ascii'),
+                'text/plain': 'figure'}))
+        nb.cells.append(cell)
+        infile = osp.join(self.tmp_dir, name + '.ipynb')
+        nbformat.write(nb, infile)
+        outdir = osp.join(self.tmp_dir, 'out')
+        if not osp.exists(outdir):
+            os.makedirs(outdir)
+        return sne.NotebookProcessor(
+            infile, osp.join(outdir, name + '.ipynb'), preprocess=False,
+            clear=False, **kwargs)
+
+    def test_optimize(self):
+        """Test downsampling the images"""
+        from PIL import Image
+        cache_dir = osp.join(self.tmp_dir, 'cache')
+        nbp = self._process('example_image', optimize_images={
+            'max_size': (300, 300), 'cache_dir': cache_dir})
+        self.assertEqual(len(nbp.pictures), 1)
+        self.assertEqual(Image.open(nbp.pictures[0]).size, (300, 150))
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        # the second notebook with the same image and settings uses the cache
+        cache_file = osp.join(cache_dir, os.listdir(cache_dir)[0])
+        Image.new('RGB', (30, 15), (255, 0, 0)).save(cache_file, 'PNG')
+        mtime = os.stat(cache_file).st_mtime
+        nbp = self._process('example_image2', optimize_images={
+            'max_size': (300, 300), 'cache_dir': cache_dir})
+        self.assertEqual(Image.open(nbp.pictures[0]).size, (30, 15))
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(os.stat(cache_file).st_mtime, mtime)
+        # another format needs a new entry
+        nbp = self._process('example_image3', optimize_images={
+            'max_size': (300, 300), 'cache_dir': cache_dir, 'format': 'webp'})
+        self.assertTrue(nbp.pictures[0].endswith('.webp'))
+        with open(nbp.get_out_file()) as f:
+            self.assertIn(osp.basename(nbp.pictures[0]), f.read())
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_opt_out(self):
+        """Test disabling the optimization in the notebook metadata"""
+        from PIL import Image
+        nbp = self._process('example_image', {'optimize_images': False},
+                            optimize_images={'max_size': (300, 300)})
+        self.assertEqual(Image.open(nbp.pictures[0]).size, (1200, 600))
+
+
+class TestFigureSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_figure_settings(self):
+        """Test the hidden cell with the figure settings"""
+        import nbformat
+        from PIL import Image
+        import sphinx_nbexamples as sne
+        nb = nbformat.v4.new_notebook(metadata={
+            'language_info': {'name': 'python', 'file_extension': '.py'},
+            'figure_settings': {'dpi': 20}})
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Title'))
+        nb.cells.append(nbformat.v4.new_code_cell(
+            '%matplotlib inline\n'
+            'import matplotlib.pyplot as plt\n'
+            'plt.figure(figsize=(4, 2))\n'
+            'plt.plot([1, 2])'))
+        nb.cells.append(nbformat.v4.new_code_cell(
+            'from IPython.display import HTML\n'
+            'HTML("<b>html</b>")'))
+        infile = osp.join(self.tmp_dir, 'example_figure.ipynb')
+        nbformat.write(nb, infile)
+        outdir = osp.join(self.tmp_dir, 'out')
+        os.makedirs(outdir)
+        nbp = sne.NotebookProcessor(
+            infile, osp.join(outdir, 'example_figure.ipynb'), clear=False,
+            figure_settings={'formats': ['png'], 'dpi': 100,
+                             'mimetypes': ['text/plain', 'image/png']})
+        nb = nbformat.read(nbp.outfile, nbformat.current_nbformat)
+        # the setup cell has been removed
+        self.assertEqual(len(nb.cells), 3)
+        self.assertNotIn('text/html', nb.cells[2].outputs[0].data)
+        # the dpi of the notebook metadata has been used (the figure is 4
+        # inches wide but cropped)
+        self.assertLessEqual(Image.open(nbp.pictures[-1]).size[0], 80)
+
+    def test_without_code_cells(self):
+        """Test the setup cell for notebooks without code cells"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        outdir = osp.join(self.tmp_dir, 'out')
+        os.makedirs(outdir)
+        for name, cells in [('markdown', [nbformat.v4.new_markdown_cell(
+                                '# Title')]),
+                            ('empty', [])]:
+            nb = nbformat.v4.new_notebook(metadata={'language_info': {
+                'name': 'python', 'file_extension': '.py'}})
+            nb.cells.extend(cells)
+            infile = osp.join(self.tmp_dir, 'example_%s.ipynb' % name)
+            nbformat.write(nb, infile)
+            nbp = sne.NotebookProcessor(
+                infile, osp.join(outdir, 'example_%s.ipynb' % name),
+                figure_settings={'dpi': 100})
+            nb = nbformat.read(nbp.outfile, nbformat.current_nbformat)
+            self.assertEqual(nb.cells, cells)
+
+
+class TestMarkdownReadme(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+        self.readme = osp.join(self.tmp_dir, 'README.md')
+        with open(self.readme, 'w') as f:
+            f.write('# Examples\n\nThis is [a link](https://www.google.de/).')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _test_converter(self, converter):
+        import sphinx_nbexamples as sne
+        cache_dir = osp.join(self.tmp_dir, 'cache')
+        rst = sne.markdown2rst(self.readme, converter, cache_dir)
+        self.assertIn('`a link <https://www.google.de/>`_', rst)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        # the file is also written into another cache directory
+        cache_dir2 = osp.join(self.tmp_dir, 'cache2')
+        self.assertEqual(sne.markdown2rst(self.readme, converter, cache_dir2),
+                         rst)
+        self.assertEqual(os.listdir(cache_dir2), os.listdir(cache_dir))
+        # the second call uses the cache
+        with open(glob.glob(osp.join(cache_dir, '*'))[0], 'w') as f:
+            f.write('cached')
+        self.assertEqual(sne.markdown2rst(self.readme, converter, cache_dir),
+                         'cached')
+
+    @unittest.skipIf(RSTRenderer is None, 'mistune>=3.0 is required')
+    def test_mistune(self):
+        """Test the conversion with mistune"""
+        self._test_converter('mistune')
+
+    @unittest.skipIf(shutil.which('pandoc') is None, 'pandoc is missing')
+    def test_pandoc(self):
+        """Test the conversion with pandoc"""
+        self._test_converter('pandoc')
+
+
+class TestGalleryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+        for d in ['', 'sub', '.ipynb_checkpoints', 'no_readme']:
+            os.makedirs(osp.join(self.tmp_dir, 'raw', d), exist_ok=True)
+            for f in ['README.rst', 'example_a.ipynb']:
+                if d != 'no_readme' or f != 'README.rst':
+                    with open(osp.join(self.tmp_dir, 'raw', d, f), 'w'):
+                        pass
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index(self):
+        """Test the discovery of the notebooks"""
+        import sphinx_nbexamples as sne
+        raw = osp.join(self.tmp_dir, 'raw') + osp.sep
+        gallery = sne.Gallery(
+            examples_dirs=raw, gallery_dirs=osp.join(self.tmp_dir, 'out'),
+            preprocess=False, dont_clear=raw + 'example_a.ipynb')
+        self.assertEqual(sorted(gallery.index),
+                         sorted([raw, raw + 'no_readme', raw + 'sub']))
+        self.assertEqual(list(gallery.iter_notebooks()),
+                         [raw + 'example_a.ipynb',
+                          osp.join(raw, 'sub', 'example_a.ipynb')])
+        self.assertFalse(gallery.is_preprocessed(raw + 'example_a.ipynb'))
+        self.assertFalse(gallery.is_cleared(raw + 'example_a.ipynb'))
+        self.assertTrue(gallery.is_cleared(
+            osp.join(raw, 'sub', 'example_a.ipynb')))
+
+
+class NotebookDirTest(unittest.TestCase):
+    """Base class for tests with a small gallery that is not executed"""
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+        self.raw = osp.join(self.tmp_dir, 'raw') + osp.sep
+        self.out = osp.join(self.tmp_dir, 'out') + osp.sep
+        os.makedirs(self.raw)
+        with open(self.raw + 'README.rst', 'w') as f:
+            f.write('Gallery\n=======\n')
+        self.write_notebooks()
+
+    def write_notebooks(self):
+        """Write the notebooks (and other files) into the examples directory
+        """
+        import nbformat
+        for name in ['a', 'b']:
+            nb = nbformat.v4.new_notebook(metadata={'language_info': {
+                'name': 'python', 'file_extension': '.py'}})
+            nb.cells.append(nbformat.v4.new_markdown_cell('# Title ' + name))
+            nbformat.write(nb, self.raw + 'example_%s.ipynb' % name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _gallery(self):
+        import sphinx_nbexamples as sne
+        return sne.Gallery(examples_dirs=self.raw, gallery_dirs=self.out,
+                           preprocess=False)
+
+
+class TestBackgroundThread(NotebookDirTest):
+
+    class App(object):
+        """Minimal sphinx application for :meth:`Gallery.start_background`
+        """
+
+        def __init__(self, srcdir):
+            self.srcdir = srcdir
+            self.events = {}
+            self.env = self
+
+        def path2doc(self, fname):
+            return osp.splitext(osp.relpath(fname, self.srcdir))[0]
+
+        def connect(self, event, func):
+            self.events[event] = func
+
+    def _start(self, **kwargs):
+        import sphinx_nbexamples as sne
+        app = self.App(self.tmp_dir)
+        gallery = sne.Gallery(examples_dirs=self.raw, gallery_dirs=self.out,
+                              background=True, **kwargs)
+        gallery.start_background(app)
+        return app, gallery
+
+    def test_linkgalleries(self):
+        """Test that documents with the linkgalleries directive wait for the
+        gallery"""
+        app, gallery = self._start()
+        app.events['source-read'](
+            app, 'index', ['Title\n=====\n\n.. linkgalleries::\n'])
+        self.assertIsNone(gallery._thread)
+        self.assertEqual(sorted(map(osp.basename, glob.glob(
+            self.out + 'example_*.ipynb'))),
+            ['example_a.ipynb', 'example_b.ipynb'])
+
+    def test_stop(self):
+        """Test that the remaining notebooks are not processed after an error
+        of the build"""
+        app, gallery = self._start(kernel_lookahead=1)
+        app.events['build-finished'](app, ValueError('build failed'))
+        self.assertIsNone(gallery._thread)
+        self.assertIsNone(gallery._prewarmer)
+        self.assertLessEqual(
+            len(glob.glob(self.out + 'example_*.ipynb')), 1)
+
+    def test_outdated_docs(self):
+        """Test that only the rewritten documents are outdated in incremental
+        mode"""
+        import nbformat
+
+        def outdated():
+            app, gallery = self._start(incremental=True)
+            gallery.wait()
+            return app.events['env-get-outdated'](
+                app, app.env, set(), set(), set())
+
+        self.assertEqual(outdated(),
+                         {'out/example_a', 'out/example_b', 'out/index'})
+        self.assertEqual(outdated(), set())
+        nb = nbformat.read(self.raw + 'example_a.ipynb', 4)
+        nb.cells.append(nbformat.v4.new_markdown_cell('Changed'))
+        nbformat.write(nb, self.raw + 'example_a.ipynb')
+        self.assertEqual(outdated(), {'out/example_a', 'out/index'})
+
+
+class TestManifest(NotebookDirTest):
+
+    def test_manifest(self):
+        """Test the manifest and the removal of orphaned files"""
+        import sphinx_nbexamples as sne
+        self._gallery().process_directories()
+        manifest = sne.Gallery.read_manifest(self.out)
+        self.assertEqual(manifest['label'], 'gallery_' + self.out.replace(
+            osp.sep, '_')[:-1])
+        self.assertEqual(list(manifest['entries']),
+                         [osp.normpath(self.raw + 'example_a.ipynb'),
+                          osp.normpath(self.raw + 'example_b.ipynb')])
+        entry = manifest['entries'][osp.normpath(self.raw + 'example_a.ipynb')]
+        self.assertEqual(entry['rst_file'],
+                         osp.normpath(self.out + 'example_a.rst'))
+        self.assertIn(entry['rst_file'], entry['files'])
+
+        gallery = self._gallery()
+        self.assertEqual(gallery.get_changes(),
+                         {'added': [], 'changed': [], 'removed': []})
+
+        # rename a notebook
+        os.rename(self.raw + 'example_b.ipynb', self.raw + 'example_c.ipynb')
+        gallery = self._gallery()
+        self.assertEqual(gallery.get_changes(), {
+            'added': [self.raw + 'example_c.ipynb'], 'changed': [],
+            'removed': [osp.normpath(self.raw + 'example_b.ipynb')]})
+        gallery.process_directories()
+        self.assertFalse(osp.exists(self.out + 'example_b.rst'))
+        self.assertFalse(osp.exists(self.out + 'example_b.ipynb'))
+        self.assertTrue(osp.exists(self.out + 'example_c.rst'))
+        self.assertTrue(osp.exists(self.out + 'index.rst'))
+
+    def test_environment(self):
+        """Test the kernel and environment fingerprint in the manifest"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        nbfile = self.raw + 'example_a.ipynb'
+        nb = nbformat.read(nbfile, nbformat.current_nbformat)
+        nb.metadata['kernelspec'] = {'name': 'python3',
+                                     'display_name': 'Python 3'}
+        nbformat.write(nb, nbfile)
+        self._gallery().process_directories()
+        record = sne.Gallery.read_manifest(self.out)['entries'][
+            osp.normpath(nbfile)]
+        self.assertEqual(record['kernel'], 'python3')
+        # the fingerprint is only needed for incremental builds
+        self.assertNotIn('environment', record)
+        gallery = self._gallery()
+        gallery.incremental = True
+        gallery.process_directories()
+        record = sne.Gallery.read_manifest(self.out)['entries'][
+            osp.normpath(nbfile)]
+        self.assertEqual(record['kernel'], 'python3')
+        self.assertEqual(record['environment'],
+                         sne.environment_fingerprint('python3'))
+
+    def test_cache_dir(self):
+        """Test the default directories of the caches"""
+        import sphinx_nbexamples as sne
+        cache_dir = osp.join(self.tmp_dir, 'cache')
+        gallery = sne.Gallery(examples_dirs=self.raw, gallery_dirs=self.out,
+                              cache_dir=cache_dir, optimize_images=True,
+                              snapshots=True)
+        self.assertEqual(gallery._nbp_kws['optimize_images']['cache_dir'],
+                         osp.join(cache_dir, 'images'))
+        self.assertEqual(gallery._nbp_kws['snapshots'].cache_dir,
+                         osp.join(cache_dir, 'snapshots'))
+
+    def test_corrupt_manifest(self):
+        """Test that a corrupt manifest is treated as missing"""
+        import sphinx_nbexamples as sne
+        self._gallery().process_directories()
+        with open(self.out + sne.Gallery.MANIFEST_FILE, 'w') as f:
+            f.write('{"entries": [')
+        self.assertEqual(sne.Gallery.read_manifest(self.out)['entries'], {})
+        self._gallery().process_directories()
+        self.assertIn(osp.normpath(self.raw + 'example_a.ipynb'),
+                      sne.Gallery.read_manifest(self.out)['entries'])
+
+
+class TestBuilderPolicy(NotebookDirTest):
+
+    def test_policies(self):
+        """Test the default policies of the builders"""
+        import sphinx_nbexamples as sne
+        get = sne.Gallery.get_builder_policy
+        self.assertEqual(get('html'), {'execute': True, 'thumbnails': True,
+                                       'html_assets': True})
+        self.assertEqual(get('latex', 'latex'), {
+            'execute': True, 'thumbnails': False, 'html_assets': False})
+        self.assertEqual(get('linkcheck', '')['execute'], 'cached')
+        self.assertEqual(
+            get('latex', 'latex', {'latex': {'execute': False}})['execute'],
+            False)
+
+    def test_cached(self):
+        """Test the reuse of the files of the last build"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        self._gallery().process_directories()
+        for name in ['a', 'b']:
+            os.utime(self.out + 'example_%s.rst' % name, (0, 0))
+        nb = nbformat.read(self.raw + 'example_b.ipynb', 4)
+        nb.cells.append(nbformat.v4.new_markdown_cell('Changed'))
+        nbformat.write(nb, self.raw + 'example_b.ipynb')
+
+        gallery = self._gallery()
+        gallery.set_builder_policy(
+            sne.Gallery.get_builder_policy('linkcheck', 'linkcheck'))
+        gallery.process_directories()
+        # the unchanged notebook is not processed again
+        self.assertEqual(os.stat(self.out + 'example_a.rst').st_mtime, 0)
+        self.assertNotEqual(os.stat(self.out + 'example_b.rst').st_mtime, 0)
+        with open(self.out + 'example_b.rst') as f:
+            self.assertIn('Changed', f.read())
+        self.assertEqual(
+            list(sne.Gallery.read_manifest(self.out)['entries']),
+            [osp.normpath(self.raw + 'example_a.ipynb'),
+             osp.normpath(self.raw + 'example_b.ipynb')])
+
+
+class TestExternalOutputs(NotebookDirTest):
+
+    def _write_notebook(self, html):
+        import nbformat
+        nb = nbformat.v4.new_notebook(metadata={'language_info': {
+            'name': 'python', 'file_extension': '.py'}})
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Title'))
+        cell = nbformat.v4.new_code_cell('show()')
+        cell.outputs.append(nbformat.v4.new_output(
+            'display_data', data={'text/html': html, 'text/plain': 'plot'}))
+        nb.cells.append(cell)
+        nbformat.write(nb, self.raw + 'example_html.ipynb')
+
+    def _build(self, process_examples=True):
+        """Process the gallery and call :func:`copy_external_outputs` with a
+        minimal sphinx application"""
+        from types import SimpleNamespace
+        import sphinx_nbexamples as sne
+        config = {'examples_dirs': self.raw, 'gallery_dirs': self.out,
+                  'preprocess': False, 'external_html_size': 100}
+        if process_examples:
+            sne.Gallery(**config).process_directories()
+        app = SimpleNamespace(
+            srcdir=self.tmp_dir, outdir=osp.join(self.tmp_dir, 'build'),
+            builder=SimpleNamespace(format='html'),
+            config=SimpleNamespace(process_examples=process_examples,
+                                   example_gallery_config=config))
+        sne.copy_external_outputs(app, None)
+        return osp.join(self.tmp_dir, 'build', 'out', 'external',
+                        'example_html_0.html')
+
+    def test_copy(self):
+        """Test copying the externalized outputs and removing stale ones"""
+        self._write_notebook('<b>%s</b>' % ('large' * 100))
+        target = self._build()
+        self.assertTrue(osp.exists(target))
+        os.remove(target)
+        self._build(process_examples=False)
+        self.assertFalse(osp.exists(target))
+        self._build()
+        self.assertTrue(osp.exists(target))
+        # the output is no longer externalized
+        self._write_notebook('<b>small</b>')
+        self._build()
+        self.assertFalse(osp.exists(target))
+        self.assertFalse(osp.exists(self.out + 'external/example_html_0.html'))
+
+    def test_keep_policy_files(self):
+        """Test that a latex build keeps the files of the html build"""
+        import base64
+        import io
+        import nbformat
+        from PIL import Image
+        import sphinx_nbexamples as sne
+        self._write_notebook('<b>%s</b>' % ('large' * 100))
+        buf = io.BytesIO()
+        Image.new('RGB', (200, 100), (255, 0, 0)).save(buf, 'PNG')
+        fname = self.raw + 'example_html.ipynb'
+        nb = nbformat.read(fname, 4)
+        nb.cells[1].outputs.append(nbformat.v4.new_output(
+            'display_data', data={
+                'image/png': base64.b64encode(buf.getvalue()).decode('ascii'),
+                'text/plain': 'figure'}))
+        nbformat.write(nb, fname)
+        config = {'examples_dirs': self.raw, 'gallery_dirs': self.out,
+                  'preprocess': False, 'external_html_size': 100}
+        sne.Gallery(**config).process_directories()
+        record = sne.Gallery.read_manifest(self.out)['entries'][
+            osp.normpath(fname)]
+        thumb_file = record['thumb_file']
+        external = osp.normpath(self.out + 'external/example_html_0.html')
+        self.assertIn(thumb_file, record['files'])
+        self.assertIn(external, record['files'])
+
+        gallery = sne.Gallery(**config)
+        gallery.set_builder_policy(
+            sne.Gallery.get_builder_policy('latex', 'latex'))
+        gallery.process_directories()
+        self.assertTrue(osp.exists(thumb_file))
+        self.assertTrue(osp.exists(external))
+        record = sne.Gallery.read_manifest(self.out)['entries'][
+            osp.normpath(fname)]
+        self.assertIn(thumb_file, record['files'])
+        self.assertIn(external, record['files'])
+
+
+class TestWalkDirectory(NotebookDirTest):
+
+    @unittest.skipIf(not hasattr(os, 'symlink'), 'Symbolic links required')
+    def test_symlink_loop(self):
+        """Test that symbolic links to directories are not followed"""
+        import sphinx_nbexamples as sne
+        os.symlink(self.raw, self.raw + 'loop')
+        dirs = [d for d, subdirs, files in sne.walk_directory(self.raw)]
+        self.assertEqual(dirs, [self.raw])
+        self._gallery().process_directories()
+        self.assertTrue(osp.exists(self.out + 'example_a.rst'))
+        self.assertFalse(osp.exists(osp.join(self.out, 'loop')))
+
+
+class TestNotebookFilter(NotebookDirTest):
+
+    def tearDown(self):
+        os.environ.pop('SPHINX_NBEXAMPLES_EXCLUDE', None)
+        super(TestNotebookFilter, self).tearDown()
+
+    def test_is_selected(self):
+        """Test the include and exclude patterns"""
+        import sphinx_nbexamples as sne
+        a, b = self.raw + 'example_a.ipynb', self.raw + 'example_b.ipynb'
+        gallery = sne.Gallery(examples_dirs=self.raw, gallery_dirs=self.out,
+                              include=['*_a.ipynb'])
+        self.assertTrue(gallery.is_selected(a))
+        self.assertFalse(gallery.is_selected(b))
+        self.assertFalse(gallery.is_preprocessed(b))
+        os.environ['SPHINX_NBEXAMPLES_EXCLUDE'] = 'example_a*,other'
+        gallery = sne.Gallery(examples_dirs=self.raw, gallery_dirs=self.out)
+        self.assertFalse(gallery.is_selected(a))
+        self.assertTrue(gallery.is_selected(b))
+
+    def test_placeholder(self):
+        """Test the placeholders of the notebooks that are not processed"""
+        import sphinx_nbexamples as sne
+        gallery = self._gallery()
+        gallery.include = ['example_a.ipynb']
+        gallery.process_directories()
+        with open(self.out + 'example_b.rst') as f:
+            rst = f.read()
+        self.assertIn('.. _gallery_%s:' % (
+            self.out + 'example_b.ipynb').replace(osp.sep, '_').lower(), rst)
+        self.assertIn('Title b\n=======', rst)
+        self.assertFalse(osp.exists(self.out + 'example_b.ipynb'))
+        with open(self.out + 'index.rst') as f:
+            self.assertIn('    example_b\n', f.read())
+        manifest = sne.Gallery.read_manifest(self.out)
+        self.assertTrue(manifest['entries'][osp.normpath(
+            self.raw + 'example_b.ipynb')]['placeholder'])
+
+        # the files of the last build are reused
+        self._gallery().process_directories()
+        gallery = self._gallery()
+        gallery.exclude = ['example_b.ipynb']
+        gallery.process_directories()
+        self.assertTrue(osp.exists(self.out + 'example_b.ipynb'))
+        with open(self.out + 'example_b.rst') as f:
+            self.assertNotIn('has not been processed', f.read())
+
+
+class TestIncremental(NotebookDirTest):
+
+    def _change_notebook(self, name):
+        import nbformat
+        fname = self.raw + 'example_%s.ipynb' % name
+        nb = nbformat.read(fname, 4)
+        # a code cell does not change the description in the index
+        nb.cells.append(nbformat.v4.new_code_cell('# Changed'))
+        nbformat.write(nb, fname)
+
+    def test_write_if_changed(self):
+        """Test writing unicode text only if it changed"""
+        import io
+        import sphinx_nbexamples as sne
+        fname = self.raw + 'unicode.txt'
+        self.assertTrue(sne._write_if_changed(fname, u'\u00e4\u20ac'))
+        with io.open(fname, encoding='utf-8') as f:
+            self.assertEqual(f.read(), u'\u00e4\u20ac')
+        self.assertFalse(sne._write_if_changed(fname, u'\u00e4\u20ac'))
+        self.assertTrue(sne._write_if_changed(fname, b'bytes'))
+
+    def test_incremental(self):
+        """Test that only the changed notebooks are processed"""
+        gallery = self._gallery()
+        gallery.incremental = True
+        gallery.process_directories()
+        for fname in ['example_a.rst', 'example_b.rst', 'index.rst',
+                      '.nbexamples_manifest.json']:
+            os.utime(self.out + fname, (0, 0))
+        gallery = self._gallery()
+        gallery.incremental = True
+        gallery.process_directories()
+        # nothing changed
+        for fname in ['example_a.rst', 'example_b.rst', 'index.rst',
+                      '.nbexamples_manifest.json']:
+            self.assertEqual(os.stat(self.out + fname).st_mtime, 0, fname)
+        self._change_notebook('b')
+        gallery.process_directories()
+        self.assertEqual(os.stat(self.out + 'example_a.rst').st_mtime, 0)
+        self.assertEqual(os.stat(self.out + 'index.rst').st_mtime, 0)
+        with open(self.out + 'example_b.rst') as f:
+            self.assertIn('Changed', f.read())
+
+    def test_prewarm_outdated(self):
+        """Test that only the kernels of executed notebooks are started"""
+        import sphinx_nbexamples as sne
+        queues = []
+        init = sne.KernelPrewarmer.__init__
+
+        def init_prewarmer(prewarmer, queue, *args, **kwargs):
+            queues.append(list(queue))
+            init(prewarmer, queue, *args, **kwargs)
+
+        def process(**kwargs):
+            sne.Gallery(examples_dirs=self.raw, gallery_dirs=self.out,
+                        kernel_lookahead=2, **kwargs).process_directories()
+            return queues.pop()
+
+        sne.KernelPrewarmer.__init__ = init_prewarmer
+        try:
+            self.assertEqual(process(include=['example_a.ipynb']),
+                             [self.raw + 'example_a.ipynb'])
+            # example_b only has a placeholder yet
+            self.assertEqual(process(incremental=True),
+                             [self.raw + 'example_b.ipynb'])
+            self.assertEqual(process(incremental=True), [])
+        finally:
+            sne.KernelPrewarmer.__init__ = init
+
+    def test_watch(self):
+        """Test the watch mode"""
+        import threading
+        gallery = self._gallery()
+        gallery.process_directories()
+        stop = threading.Event()
+        changes = []
+
+        def callback(changed):
+            changes.append(changed)
+            stop.set()
+
+        thread = threading.Thread(target=gallery.watch, kwargs=dict(
+            interval=0.05, debounce=0.1, callback=callback, stop=stop))
+        thread.start()
+        try:
+            self._change_notebook('a')
+            # the first scan of the watcher might already include the change,
+            # so we set clearly later modification times until it is noticed
+            fname = self.raw + 'example_a.ipynb'
+            mtime = os.stat(fname).st_mtime
+            for i in range(1, 60):
+                os.utime(fname, (mtime + 10 * i, mtime + 10 * i))
+                if stop.wait(0.5):
+                    break
+            thread.join(30)
+        finally:
+            stop.set()
+        self.assertEqual(changes, [[self.raw + 'example_a.ipynb']])
+        with open(self.out + 'example_a.rst') as f:
+            self.assertIn('Changed', f.read())
+
+
+class TestScratchDir(NotebookDirTest):
+
+    def setUp(self):
+        super(TestScratchDir, self).setUp()
+        self.scratch = osp.join(self.tmp_dir, 'scratch')
+        os.makedirs(self.scratch)
+
+    def write_notebooks(self):
+        import nbformat
+        with open(self.raw + 'data.txt', 'w') as f:
+            f.write('data')
+        nb = nbformat.v4.new_notebook()
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Scratch'))
+        nb.cells.append(nbformat.v4.new_code_cell(
+            "import os\n"
+            "with open('data.txt') as f:\n"
+            "    content = f.read()\n"
+            "with open('result.txt', 'w') as f:\n"
+            "    f.write(content + ' ' + os.getcwd())"))
+        nbformat.write(nb, self.raw + 'example_scratch.ipynb')
+
+    def test_scratch_dir(self):
+        """Test the execution in a scratch directory"""
+        import sphinx_nbexamples as sne
+        nbfile = self.raw + 'example_scratch.ipynb'
+        sne.Gallery(
+            examples_dirs=self.raw, gallery_dirs=self.out,
+            scratch_dir=self.scratch,
+            other_supplementary_files={nbfile: ['data.txt']},
+            output_files={nbfile: ['*.txt']},
+            track_dependencies=True).process_directories()
+        with open(self.out + 'result.txt') as f:
+            content, cwd = f.read().split()
+        self.assertEqual(content, 'data')
+        self.assertEqual(osp.dirname(osp.realpath(cwd)),
+                         osp.realpath(self.scratch))
+        # nothing is written into the source directory and the scratch
+        # directory is removed
+        self.assertFalse(osp.exists(self.raw + 'result.txt'))
+        self.assertEqual(os.listdir(self.scratch), [])
+        manifest = sne.Gallery.read_manifest(self.out)
+        record = manifest['entries'][osp.normpath(nbfile)]
+        self.assertIn(osp.normpath(self.out + 'result.txt'), record['files'])
+        # the linked file in the scratch directory is recorded as the file in
+        # the source directory
+        self.assertEqual(list(record['dependencies']),
+                         [osp.realpath(self.raw + 'data.txt')])
+
+    def test_prewarmed_kernel(self):
+        """Test that a pre-started kernel runs in the scratch directory"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        nbfile = self.raw + 'example_scratch.ipynb'
+        nb = nbformat.read(nbfile, nbformat.current_nbformat)
+        nb.metadata['kernelspec'] = {'name': 'python3',
+                                     'display_name': 'Python 3'}
+        nb.cells[-1].source = nb.cells[-1].source.replace(
+            'result.txt', 'result_2.txt')
+        # the kernel of the second notebook is started in advance
+        nbfile = self.raw + 'example_scratch_2.ipynb'
+        nbformat.write(nb, nbfile)
+        cwds = []
+        start_kernel = sne.KernelPrewarmer.start_kernel
+
+        def start(infile, cwd=None):
+            cwds.append(cwd)
+            return start_kernel(infile, cwd)
+
+        sne.KernelPrewarmer.start_kernel = staticmethod(start)
+        try:
+            sne.Gallery(
+                examples_dirs=self.raw, gallery_dirs=self.out,
+                scratch_dir=self.scratch, kernel_lookahead=1,
+                other_supplementary_files={
+                    self.raw + 'example_scratch.ipynb': ['data.txt'],
+                    nbfile: ['data.txt']},
+                output_files={nbfile: ['*.txt']}).process_directories()
+        finally:
+            sne.KernelPrewarmer.start_kernel = staticmethod(start_kernel)
+        with open(self.out + 'result_2.txt') as f:
+            content, cwd = f.read().split()
+        self.assertEqual(content, 'data')
+        self.assertEqual(len(cwds), 1)
+        self.assertEqual(osp.realpath(cwd), osp.realpath(cwds[0]))
+        self.assertEqual(osp.dirname(osp.realpath(cwd)),
+                         osp.realpath(self.scratch))
+        self.assertEqual(os.listdir(self.scratch), [])
+
+
+class TestDependencies(NotebookDirTest):
+
+    def write_notebooks(self):
+        import nbformat
+        with open(self.raw + 'data.csv', 'w') as f:
+            f.write('1,2,3')
+        with open(self.raw + 'helper.py', 'w') as f:
+            f.write('def read(fname):\n    with open(fname) as f:\n'
+                    '        return f.read()\n')
+        nb = nbformat.v4.new_notebook()
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Dependencies'))
+        nb.cells.append(nbformat.v4.new_code_cell(
+            "import helper\n"
+            "print(helper.read('data.csv'))\n"
+            "with open('written.txt', 'w') as f:\n"
+            "    f.write('output')"))
+        nbformat.write(nb, self.raw + 'example_deps.ipynb')
+
+    def _gallery(self):
+        import sphinx_nbexamples as sne
+        return sne.Gallery(examples_dirs=self.raw, gallery_dirs=self.out,
+                           track_dependencies=True)
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'requires audit hooks')
+    def test_dependencies(self):
+        """Test the recorded dependencies of a notebook"""
+        import sphinx_nbexamples as sne
+        nbfile = self.raw + 'example_deps.ipynb'
+        self._gallery().process_directories()
+        record = sne.Gallery.read_manifest(self.out)['entries'][
+            osp.normpath(nbfile)]
+        self.assertEqual(
+            sorted(record['dependencies']),
+            [osp.realpath(self.raw + 'data.csv'),
+             osp.realpath(self.raw + 'helper.py')])
+        self.assertEqual(record['environment'],
+                         sne.environment_fingerprint())
+        # the hidden cells are removed
+        with open(self.out + 'example_deps.rst') as f:
+            rst = f.read()
+        self.assertNotIn('addaudithook', rst)
+        self.assertNotIn('nbexamples-dependencies', rst)
+        self.assertIn('1,2,3', rst)
+
+        self.assertEqual(self._gallery().get_changes()['changed'], [])
+        with open(self.raw + 'data.csv', 'w') as f:
+            f.write('4,5,6,7')
+        self.assertEqual(self._gallery().get_changes()['changed'], [nbfile])
+
+    @unittest.skipIf(sys.platform.startswith('win'), 'requires sh')
+    def test_kernel_environment(self):
+        """Test the fingerprint of the environment of another kernel"""
+        import json
+        import sphinx_nbexamples as sne
+        # a kernel whose interpreter does not see the site-packages
+        kernel_dir = osp.join(self.tmp_dir, 'kernels', 'nbexamples-test')
+        os.makedirs(kernel_dir)
+        executable = osp.join(self.tmp_dir, 'python')
+        with open(executable, 'w') as f:
+            f.write('#!/bin/sh\nexec %s -S "$@"\n' % sys.executable)
+        os.chmod(executable, 0o755)
+        with open(osp.join(kernel_dir, 'kernel.json'), 'w') as f:
+            json.dump({'argv': [executable, '-m', 'ipykernel_launcher',
+                                '-f', '{connection_file}'],
+                       'display_name': 'Test', 'language': 'python'}, f)
+        jupyter_path = os.environ.get('JUPYTER_PATH')
+        os.environ['JUPYTER_PATH'] = self.tmp_dir
+        try:
+            fingerprint = sne.environment_fingerprint('nbexamples-test')
+        finally:
+            sne._environment.pop('nbexamples-test', None)
+            if jupyter_path is None:
+                del os.environ['JUPYTER_PATH']
+            else:
+                os.environ['JUPYTER_PATH'] = jupyter_path
+        self.assertEqual(fingerprint, subprocess.check_output(
+            [executable, '-c', sne.FINGERPRINT_CODE + 'print(fingerprint)']
+            ).decode('ascii').strip())
+        self.assertNotEqual(fingerprint, sne.environment_fingerprint())
+
+
+class TestNormalization(unittest.TestCase):
+
+    def _png(self, **text):
+        from PIL import Image, PngImagePlugin
+        info = PngImagePlugin.PngInfo()
+        for key, val in text.items():
+            info.add_text(key, val)
+        buf = six.BytesIO()
+        Image.new('RGB', (4, 4)).save(buf, 'png', pnginfo=info)
+        return buf.getvalue()
+
+    def test_normalize_png(self):
+        """Test the removal of the PNG text chunks"""
+        import sphinx_nbexamples as sne
+        self.assertNotEqual(self._png(date='1'), self._png(date='2'))
+        self.assertEqual(sne.normalize_png(self._png(date='1')),
+                         sne.normalize_png(self._png(date='2')))
+        self.assertEqual(sne.normalize_png(self._png()), self._png())
+        self.assertEqual(sne.normalize_png(b'no png'), b'no png')
+
+    def test_normalize_notebook(self):
+        """Test the normalization of the volatile notebook data"""
+        import base64
+        import nbformat
+        import sphinx_nbexamples as sne
+        nb = nbformat.v4.new_notebook()
+        widget_key = 'application/vnd.jupyter.widget-state+json'
+        nb.metadata.widgets = {widget_key: {'state': {
+            'abc123': {'state': {'children': ['IPY_MODEL_def456']}},
+            'def456': {'state': {}}}}}
+        nb.cells.append(nbformat.v4.new_code_cell(
+            'x', execution_count=5,
+            metadata={'execution': {'iopub.status.busy': '2020-01-01'}},
+            outputs=[
+                nbformat.v4.new_output(
+                    'stream', text='<object object at 0x7f3b2c1d0e80>'),
+                nbformat.v4.new_output('display_data', data={
+                    'image/png': base64.b64encode(
+                        self._png(date='1')).decode('ascii'),
+                    'application/vnd.jupyter.widget-view+json': {
+                        'model_id': 'abc123'}})]))
+        nb.cells.append(nbformat.v4.new_code_cell(
+            'y', execution_count=7, outputs=[nbformat.v4.new_output(
+                'execute_result', data={'text/plain': '2020-01-01'},
+                execution_count=7)]))
+        nbp = object.__new__(sne.NotebookProcessor)
+        nbp.normalize_outputs = sne.NotebookProcessor.NORMALIZE_RULES + [
+            (r'\d{4}-\d\d-\d\d', 'YYYY-MM-DD')]
+        nbp.normalize_notebook(nb)
+        cell1, cell2 = nb.cells
+        self.assertNotIn('execution', cell1.metadata)
+        self.assertEqual([cell1.execution_count, cell2.execution_count],
+                         [1, 2])
+        self.assertEqual(cell2.outputs[0].execution_count, 2)
+        self.assertEqual(cell2.outputs[0].data['text/plain'], 'YYYY-MM-DD')
+        self.assertEqual(cell1.outputs[0].text, '<object object at 0x...>')
+        self.assertEqual(
+            base64.b64decode(cell1.outputs[1].data['image/png']),
+            self._png())
+        model_id = cell1.outputs[1].data[
+            'application/vnd.jupyter.widget-view+json']['model_id']
+        state = nb.metadata.widgets[widget_key]['state']
+        self.assertIn(model_id, state)
+        self.assertNotIn('abc123', state)
+        self.assertEqual(
+            state[model_id]['state']['children'],
+            ['IPY_MODEL_' + [key for key in state if key != model_id][0]])
+
+    def test_deterministic_rst(self):
+        """Test that the rst file does not change between two executions"""
+        import nbformat
+        import sphinx_nbexamples as sne
+        tmp_dir = mkdtemp(prefix='tmp_nbexamples_')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        raw = osp.join(tmp_dir, 'raw') + osp.sep
+        out = osp.join(tmp_dir, 'out') + osp.sep
+        os.makedirs(raw)
+        with open(raw + 'README.rst', 'w') as f:
+            f.write('Gallery\n=======\n')
+        nb = nbformat.v4.new_notebook()
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Normalized'))
+        nb.cells.append(nbformat.v4.new_code_cell('print(object())'))
+        nbformat.write(nb, raw + 'example_normalized.ipynb')
+        kws = dict(examples_dirs=raw, gallery_dirs=out,
+                   normalize_outputs=True)
+        sne.Gallery(**kws).process_directories()
+        os.utime(out + 'example_normalized.rst', (0, 0))
+        sne.Gallery(**kws).process_directories()
+        self.assertEqual(os.stat(out + 'example_normalized.rst').st_mtime, 0)
+        with open(out + 'example_normalized.rst') as f:
+            self.assertIn('<object object at 0x...>', f.read())
+
+
+class TestSnapshots(NotebookDirTest):
+
+    def setUp(self):
+        super(TestSnapshots, self).setUp()
+        self.cache_dir = osp.join(self.tmp_dir, 'cache')
+
+    def write_notebooks(self):
+        self.counter = osp.join(self.tmp_dir, 'counter.txt')
+        self._write_notebook('print(y * 10)')
+
+    def _write_notebook(self, last_cell, middle_cell='y = x + 1'):
+        import nbformat
+        nb = nbformat.v4.new_notebook()
+        nb.cells.append(nbformat.v4.new_markdown_cell('# Snapshots'))
+        # all variables must be picklable to create a snapshot
+        nb.cells.append(nbformat.v4.new_code_cell(
+            "open(%r, 'a').write('executed\\n')\n"
+            "x = 1" % self.counter))
+        nb.cells.append(nbformat.v4.new_code_cell(middle_cell))
+        nb.cells.append(nbformat.v4.new_code_cell(last_cell))
+        nbformat.write(nb, self.raw + 'example_snapshots.ipynb')
+
+    def _process(self, **kwargs):
+        import nbformat
+        import sphinx_nbexamples as sne
+        sne.Gallery(examples_dirs=self.raw, gallery_dirs=self.out,
+                    snapshots={'cache_dir': self.cache_dir}, clear=False,
+                    **kwargs).process_directories()
+        with open(self.counter) as f:
+            executed = len(f.readlines())
+        nb = nbformat.read(self.out + 'example_snapshots.ipynb', 4)
+        return executed, nb.cells[-1]
+
+    def test_snapshots(self):
+        """Test the execution from the first modified cell"""
+        executed, cell = self._process()
+        self.assertEqual(executed, 1)
+        self.assertEqual(cell.outputs[0].text.strip(), '20')
+        execution_count = cell.execution_count
+
+        # only the last cell is executed again
+        self._write_notebook('print(y * 100)')
+        executed, cell = self._process()
+        self.assertEqual(executed, 1)
+        self.assertEqual(cell.outputs[0].text.strip(), '200')
+        self.assertEqual(cell.execution_count, execution_count)
+
+        # nothing is executed for an unchanged notebook
+        executed, cell = self._process()
+        self.assertEqual(executed, 1)
+        self.assertEqual(cell.outputs[0].text.strip(), '200')
+
+    def test_failed_restore(self):
+        """Test the full execution if the snapshot cannot be restored"""
+        self._process()
+        for fname in glob.glob(osp.join(self.cache_dir, '*.pkl')):
+            with open(fname, 'wb') as f:
+                f.write(b'corrupted')
+        self._write_notebook('print(y * 100)')
+        executed, cell = self._process()
+        self.assertEqual(executed, 2)
+        self.assertEqual(cell.outputs[0].text.strip(), '200')
+
+    def test_scratch_dir(self):
+        """Test that the snapshots are not used in a scratch directory"""
+        scratch_dir = osp.join(self.tmp_dir, 'scratch')
+        os.makedirs(scratch_dir)
+        self._write_notebook("print(open('tmp.txt').read())",
+                             "open('tmp.txt', 'w').write('1')")
+        self._process(scratch_dir=scratch_dir)
+        self._write_notebook("print(open('tmp.txt').read() * 2)",
+                             "open('tmp.txt', 'w').write('1')")
+        executed, cell = self._process(scratch_dir=scratch_dir)
+        self.assertEqual(executed, 2)
+        self.assertEqual([output.output_type for output in cell.outputs],
+                         ['stream'])
+        self.assertEqual(cell.outputs[0].text.strip(), '11')
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'requires audit hooks')
+    def test_dependencies(self):
+        """Test the dependencies of the cells that are not executed"""
+        import sphinx_nbexamples as sne
+        with open(self.raw + 'data.csv', 'w') as f:
+            f.write('2')
+        read_data = "y = int(open('data.csv').read())"
+        self._write_notebook('print(y * 10)', read_data)
+        self._process(track_dependencies=True)
+        self._write_notebook('print(y * 100)', read_data)
+        executed, cell = self._process(track_dependencies=True)
+        self.assertEqual(executed, 1)
+        self.assertEqual(cell.outputs[0].text.strip(), '200')
+        # the file read by the restored cells is kept and the snapshots are
+        # not recorded
+        record = sne.Gallery.read_manifest(self.out)['entries'][
+            osp.normpath(self.raw + 'example_snapshots.ipynb')]
+        self.assertEqual(list(record['dependencies']),
+                         [osp.realpath(self.raw + 'data.csv')])
+
+        # the snapshots after reading the modified file are not used
+        with open(self.raw + 'data.csv', 'w') as f:
+            f.write('30')
+        executed, cell = self._process(track_dependencies=True)
+        self.assertEqual(cell.outputs[0].text.strip(), '3000')
+
+    def test_prune(self):
+        """Test the size limit of the snapshot cache"""
+        import sphinx_nbexamples as sne
+        self._process()
+        cache = sne.SnapshotCache(self.cache_dir, max_size=0)
+        cache.prune()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
 class TestWarnings(BaseTest):
 
     def setUp(self):
@@ -270,6 +1807,7 @@ class TestLinkGalleries(BaseTest):
         with open(html_path) as f:
             html = f.read()
         self.assertIn(osp.basename(thumbnail), html)
+        self.assertIn('<div class="sphx-glr-thumbContainer">', html)
 
         # test with new thumbnail to test the linkgalleries with it's own
         # project
@@ -283,6 +1821,210 @@ class TestLinkGalleries(BaseTest):
                         msg='None of %s found in %s' % (thumbnails, html))
 
 
+class TestLinkIndex(unittest.TestCase):
+
+    def _directive(self):
+        import sphinx_nbexamples as sne
+
+        class Env(object):
+            pass
+
+        directive = object.__new__(sne.LinkGalleriesDirective)
+        directive.env = Env()
+        return directive
+
+    def test_remote_labels(self):
+        """Test the prefix lookup of the gallery labels"""
+        import sphinx_nbexamples as sne
+        refs = OrderedDict((key, None) for key in [
+            'gallery_examples_example_b.ipynb', 'other_label',
+            'gallery_examples_sub_example_a.ipynb',
+            'gallery_examples_example_a.ipynb', 'gallery_examples',
+            'gallery_other_example_c.ipynb'])
+        directive = self._directive()
+        self.assertEqual(
+            directive.get_remote_labels('pkg', refs, 'gallery_examples'),
+            ['gallery_examples_example_b.ipynb',
+             'gallery_examples_sub_example_a.ipynb',
+             'gallery_examples_example_a.ipynb'])
+        self.assertEqual(
+            directive.get_remote_labels('pkg', refs, 'gallery_other'),
+            ['gallery_other_example_c.ipynb'])
+        self.assertEqual(
+            directive.get_remote_labels('pkg', refs, 'gallery_missing'), [])
+        # the index is cached in the environment until it is cleared
+        self.assertIn(('remote', 'pkg'),
+                      directive.env.nbexamples_link_index)
+        sne.clear_link_index(None, directive.env)
+        self.assertFalse(hasattr(directive.env, 'nbexamples_link_index'))
+
+
+class TestThumbnailCache(unittest.TestCase):
+    """Test the cache for the thumbnails of remote galleries"""
+
+    def setUp(self):
+        from six.moves.BaseHTTPServer import (
+            HTTPServer, BaseHTTPRequestHandler)
+        import threading
+        self.tmpdir = mkdtemp(prefix='nbexamples')
+        self.requests = requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                requests.append(self.path)
+                if 'missing' in self.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                content = b'thumbnail of ' + self.path.encode('utf-8')
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%i/_images/' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.stop_server()
+        shutil.rmtree(self.tmpdir)
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def test_revalidation(self):
+        """Test that cached files are revalidated once per build"""
+        import sphinx_nbexamples as sne
+        urls = [self.url + 'a_thumb.png', self.url + 'b_thumb.png']
+        cache = sne.ThumbnailCache(self.tmpdir)
+        files = cache.get_files(urls)
+        with open(files[0], 'rb') as f:
+            self.assertEqual(f.read(), b'thumbnail of /_images/a_thumb.png')
+        self.assertEqual(len(self.requests), 2)
+        # no new request within the same build
+        self.assertEqual(cache.get_files(urls), files)
+        self.assertEqual(len(self.requests), 2)
+        # a new build revalidates the files and gets a 304
+        cache = sne.ThumbnailCache(self.tmpdir)
+        self.assertEqual(cache.get_files(urls), files)
+        self.assertEqual(len(self.requests), 4)
+        self.assertTrue(all(map(osp.exists, files)))
+
+    def test_offline(self):
+        """Test that the cache is used when the server cannot be reached"""
+        import sphinx_nbexamples as sne
+        url = self.url + 'a_thumb.png'
+        fname, = sne.ThumbnailCache(self.tmpdir).get_files([url])
+        self.stop_server()
+        cache = sne.ThumbnailCache(self.tmpdir, timeout=1)
+        self.assertEqual(cache.get_file(url), fname)
+        self.assertIsNone(cache.get_file(self.url + 'missing_thumb.png'))
+
+    def test_failed(self):
+        """Test that failed downloads are not repeated within a build"""
+        import pickle
+        import sphinx_nbexamples as sne
+        url = self.url + 'missing_thumb.png'
+        cache = sne.ThumbnailCache(self.tmpdir)
+        self.assertIsNone(cache.get_file(url))
+        self.assertIsNone(cache.get_file(url))
+        self.assertEqual(len(self.requests), 1)
+        # the cache can be pickled with the sphinx environment
+        cache = pickle.loads(pickle.dumps(cache))
+        self.assertIsNone(cache.get_file(url))
+        self.assertEqual(len(self.requests), 1)
+        self.assertTrue(cache.get_file(self.url + 'a_thumb.png'))
+
+    def test_eviction(self):
+        """Test that the least recently used files are removed"""
+        import sphinx_nbexamples as sne
+        urls = [self.url + '%s_thumb.png' % c for c in 'abc']
+        # every file has 31 bytes
+        cache = sne.ThumbnailCache(self.tmpdir, max_size=70)
+        files = [cache.get_file(url) for url in urls]
+        cache.save()
+        self.assertFalse(osp.exists(files[0]))
+        self.assertTrue(osp.exists(files[1]))
+        self.assertTrue(osp.exists(files[2]))
+        self.assertEqual(sorted(sne.ThumbnailCache(self.tmpdir).index),
+                         urls[1:])
+
+
+class TestGalleryThumbnailNode(unittest.TestCase):
+
+    def setUp(self):
+        self.src_dir = mkdtemp(prefix='tmp_nbexamples_')
+        gallery = osp.join(self.src_dir, 'gallery')
+        os.makedirs(osp.join(gallery, 'images', 'thumb'))
+        with open(osp.join(self.src_dir, 'conf.py'), 'w') as f:
+            f.write("project = 'test'\n"
+                    "extensions = ['sphinx_nbexamples', "
+                    "'sphinx.ext.intersphinx']\n"
+                    "process_examples = False\n"
+                    "exclude_patterns = ['build']\n")
+        with open(osp.join(self.src_dir, 'index.rst'), 'w') as f:
+            f.write('Test\n====\n\n.. toctree::\n\n    gallery/index\n\n'
+                    '.. linkgalleries::\n    :width: 160\n\n'
+                    '    test gallery\n')
+        with open(osp.join(gallery, 'index.rst'), 'w') as f:
+            f.write('.. _gallery_gallery_example_a.ipynb:\n\n'
+                    'Example\n=======\n')
+        with open(osp.join(gallery, 'example_a.ipynb'), 'w'):
+            pass
+        shutil.copyfile(
+            osp.join(osp.dirname(sphinx_supp), '..', 'sphinx_nbexamples',
+                     '_static', 'no_image.png'),
+            osp.join(gallery, 'images', 'thumb',
+                     'gallery_gallery_example_a.ipynb_thumb.png'))
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+
+    def _build(self, buildername):
+        cwd = os.getcwd()
+        os.chdir(self.src_dir)
+        out_dir = osp.join(self.src_dir, 'build', buildername)
+        try:
+            Sphinx(srcdir=self.src_dir, confdir=self.src_dir, outdir=out_dir,
+                   doctreedir=osp.join(self.src_dir, 'build', 'doctrees'),
+                   buildername=buildername).build()
+        finally:
+            os.chdir(cwd)
+        return out_dir
+
+    def test_html(self):
+        """Test the thumbnail container in the html output"""
+        out_dir = self._build('html')
+        with open(osp.join(out_dir, 'index.html')) as f:
+            html = f.read()
+        self.assertIn('<div class="sphx-glr-thumbContainer">', html)
+        self.assertIn('gallery_gallery_example_a.ipynb_thumb.png', html)
+        self.assertIn('href="gallery/index.html#', html)
+
+    def test_latex(self):
+        """Test the figure of the thumbnail in the latex output"""
+        out_dir = self._build('latex')
+        with open(glob.glob(osp.join(out_dir, '*.tex'))[0]) as f:
+            tex = f.read()
+        self.assertIn('gallery_gallery_example_a.ipynb_thumb', tex)
+        self.assertIn('\\caption{', tex)
+
+
 def _test_url(url, *args, **kwargs):
     if six.PY3:
         from urllib import request